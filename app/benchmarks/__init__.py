@@ -0,0 +1,3 @@
+"""
+Offline benchmarks of the ShopAssist pipeline. Run `python -m benchmarks.run` from the `app` directory.
+"""
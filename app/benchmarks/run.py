@@ -0,0 +1,610 @@
+"""
+run.py
+======
+
+End-to-end benchmarks of the ShopAssist pipeline, run offline against the stub LLM backend.
+
+Suites:
+- `stage2`: Loads synthetic catalogues of 1k, 10k and 100k rows and times `compare_laptops_with_user` and
+  `recommendation_validation` for random user profiles, then times scoring again with the precomputed profile
+  table (`stage2.get_profile_table`) and reports its build time and memory, and the write and load time of
+  the binary catalogue.
+- `conversation`: Runs complete stage 1 -> 2 -> 3 conversations through the `DialogueEngine` against the
+  stub backend with injected latency, and reports turn latencies and the calls and tokens per turn
+  (with `--stream`, the replies are streamed and the time to the first token is reported too), and the size and
+  the save and restore time of the final session records (`shopassist.services.session_store`), and the batch
+  sizes, queue waits and cache hits of the moderation batcher (`--moderation-max-batch 1` turns batching off).
+- `enrichment`: Runs `create_laptop_feature.add_laptop_feature_col` on a synthetic `laptop_data.csv`
+  (with and without the rule-based fast path) and reports its throughput.
+- `startup`: Starts fresh interpreters and reports the `python -X importtime` time of the entry points (with the
+  slowest packages and any heavy dependency that should have stayed lazy), and the cold start time to a loaded
+  catalogue from the CSV and from the binary snapshot.
+
+Every suite reports p50 / p95 / p99 latencies (or throughput) and, from a separate traced pass, its peak memory. The results are written as JSON
+together with the git commit they were measured on; `--compare` prints the change against an earlier result file.
+
+Usage (from the `app` directory):
+    `python -m benchmarks.run`
+    `python -m benchmarks.run --suites stage2 --sizes 1000 10000 100000 --output results.json`
+    `python -m benchmarks.run --compare baseline.json`
+"""
+
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import collections
+import platform
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+import numpy as np
+from benchmarks.synthetic import CONVERSATIONS, random_profiles, write_catalogue
+from shopassist.services import stage1, stage2
+from shopassist.services.backend import set_backend
+from shopassist.services.catalogue_store import binary_path, write_binary_catalogue
+from shopassist.services.moderation import DEFAULT_BATCH_WINDOW, DEFAULT_MAX_BATCH
+from shopassist.services.session_store import MemorySessionStore, decode_record, encode_record
+from shopassist.services.stage3 import PresentationCache
+from shopassist.services.stub_backend import StubBackend
+from shopassist.services.upstream import get_upstream_stats, reset_upstream
+
+
+SUITES = ('stage2', 'conversation', 'enrichment', 'startup')
+
+# The modules a process imports to serve: the notebook's stage 2, the dialogue engine and the HTTP service
+STARTUP_MODULES = ('shopassist.services.stage2', 'shopassist.services.dialogue', 'shopassist.services.server')
+
+# Dependencies that must only be imported on the code paths that need them
+LAZY_DEPENDENCIES = ('pandas', 'openai', 'httpx')
+
+# Run in a fresh interpreter: imports stage 2, loads the catalogue, and reports both times
+COLD_START_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from shopassist.services import stage2
+imported = time.perf_counter()
+stage2.get_catalogue()
+loaded = time.perf_counter()
+print(json.dumps({'import_s': imported - start, 'load_s': loaded - imported,
+                  'lazy_dependencies_imported': [name for name in %r if name in sys.modules]}))
+""" % (LAZY_DEPENDENCIES,)
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+
+def summarise(samples):
+    """
+    Summarises a list of durations (in seconds) as milliseconds.
+
+    Returns:
+        dict: Number of samples, mean, p50, p95, p99 and max latency in milliseconds.
+    """
+    values = np.asarray(samples, dtype=float) * 1000
+    if not len(values):
+        return {'count': 0}
+    p50, p95, p99 = np.percentile(values, (50, 95, 99))
+    return {'count': int(len(values)),
+            'mean_ms': round(float(values.mean()), 4),
+            'p50_ms': round(float(p50), 4),
+            'p95_ms': round(float(p95), 4),
+            'p99_ms': round(float(p99), 4),
+            'max_ms': round(float(values.max()), 4)}
+
+
+def peak_memory(function):
+    """
+    Runs `function` under `tracemalloc` and returns its peak traced memory in MB.
+
+    Tracing slows Python code down several times, so the suites measure memory in a separate pass
+    from the one they time.
+    """
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 2 ** 20, 2)
+
+
+@contextlib.contextmanager
+def workspace(directory):
+    """
+    Runs the block with `directory` as the working directory, so the pipeline's relative `data/` paths point
+    at the synthetic files.
+    """
+    previous = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def bench_stage2(root, sizes=DEFAULT_SIZES, queries=200, seed=0, trace_memory=True):
+    """
+    Times stage 2 over synthetic catalogues of each size.
+
+    Returns:
+        dict: Per catalogue size, the load time, latency summaries of scoring, validation and both together,
+              the peak memory of loading the catalogue and answering a query, the write and load time of the
+              binary catalogue, and the build time, memory and scoring latency of the profile table.
+    """
+    profiles = random_profiles(queries, seed=seed)
+    results = {}
+
+    def load_and_query():
+        stage2.get_catalogue(reload=True)
+        stage2.recommendation_validation(stage2.compare_laptops_with_user(profiles[0]))
+
+    for rows in sizes:
+        directory = os.path.join(root, 'stage2_{0}'.format(rows))
+        write_catalogue(os.path.join(directory, 'data'), rows, seed=seed)
+        result = {}
+
+        with workspace(directory):
+            start = time.perf_counter()
+            stage2.get_catalogue(reload=True)
+            result['catalogue_load_s'] = round(time.perf_counter() - start, 4)
+
+            scoring, validation, total = [], [], []
+            for profile in profiles:
+                start = time.perf_counter()
+                top_3_laptops = stage2.compare_laptops_with_user(profile)
+                scored = time.perf_counter()
+                stage2.recommendation_validation(top_3_laptops)
+                validated = time.perf_counter()
+                scoring.append(scored - start)
+                validation.append(validated - scored)
+                total.append(validated - start)
+
+            if trace_memory:
+                result['peak_memory_mb'] = peak_memory(load_and_query)
+
+            previous = stage2.set_profile_table_mode('eager')
+            try:
+                start = time.perf_counter()
+                table = stage2.get_profile_table()
+                build = time.perf_counter() - start
+                table_scoring = []
+                for profile in profiles:
+                    start = time.perf_counter()
+                    stage2.compare_laptops_with_user(profile)
+                    table_scoring.append(time.perf_counter() - start)
+            finally:
+                stage2.set_profile_table_mode(previous)
+            result['profile_table'] = {'build_s': round(build, 4),
+                                       'memory_mb': round(table.memory_usage()['bytes'] / 2 ** 20, 2),
+                                       'compare_laptops_with_user': summarise(table_scoring)}
+
+            # Measured last, since `get_catalogue` prefers the binary catalogue once it exists
+            start = time.perf_counter()
+            write_binary_catalogue(stage2.get_catalogue(), binary_path(stage2.UPDATED_DATA_PATH))
+            written = time.perf_counter()
+            stage2.get_catalogue(reload=True)
+            result['binary_catalogue'] = {'write_s': round(written - start, 4),
+                                          'load_s': round(time.perf_counter() - written, 4)}
+
+        result.update(compare_laptops_with_user=summarise(scoring),
+                      recommendation_validation=summarise(validation),
+                      total=summarise(total))
+        results[str(rows)] = result
+        print("stage2 {0:>7} rows: load {1:.3f} s, p50 {2[p50_ms]:.3f} ms, p99 {2[p99_ms]:.3f} ms, "
+              "peak {3} MB".format(rows, result['catalogue_load_s'], result['total'], result.get('peak_memory_mb')))
+        print("stage2 {0:>7} rows: profile table built in {1[build_s]:.3f} s, {1[memory_mb]} MB, scoring p50 "
+              "{2[p50_ms]:.3f} ms (without: {3[p50_ms]:.3f} ms)".format(
+                  rows, result['profile_table'], result['profile_table']['compare_laptops_with_user'],
+                  result['compare_laptops_with_user']))
+        print("stage2 {0:>7} rows: binary catalogue written in {1[write_s]:.3f} s, loaded in {1[load_s]:.4f} s".format(
+            rows, result['binary_catalogue']))
+
+    return results
+
+
+async def _run_conversations(engine, sessions, concurrency, stream=False):
+    """
+    Runs `sessions` scripted conversations, at most `concurrency` at a time (streaming the replies if `stream`).
+
+    Returns:
+        tuple[list, list, list]: The `TurnResult.timings` of every turn, one list of turn stages per session, and
+                                 the final `SessionState` of every session.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+    on_token = (lambda delta: None) if stream else None
+
+    async def conversation(index):
+        async with semaphore:
+            state, _ = await engine.start_session()
+            stages = []
+            for message in CONVERSATIONS[index % len(CONVERSATIONS)]:
+                result = await engine.handle_turn(state, message, on_token=on_token)
+                timings.append(result.timings)
+                stages.append(result.stage)
+            return stages, state
+
+    finished = await asyncio.gather(*(conversation(index) for index in range(sessions)))
+    return timings, [stages for stages, _ in finished], [state for _, state in finished]
+
+
+def bench_session_store(states):
+    """
+    Times saving the sessions to a `MemorySessionStore` and restoring them, as the HTTP service does every turn.
+
+    Returns:
+        dict: Record sizes, and the encode (`to_record()` + `encode_record()`) and decode (`decode_record()`,
+              then `SessionState.from_record()`) latency summaries.
+    """
+    from shopassist.services.dialogue import SessionState
+
+    store = MemorySessionStore()
+    sizes, encode, decode, restore = [], [], [], []
+    for state in states:
+        start = time.perf_counter()
+        data = encode_record(state.to_record())
+        encode.append(time.perf_counter() - start)
+        sizes.append(len(data))
+        store.put(state.session_id, state.to_record())
+
+        start = time.perf_counter()
+        record = decode_record(data)
+        decode.append(time.perf_counter() - start)
+        SessionState.from_record(record)
+        restore.append(time.perf_counter() - start)
+
+    return {'sessions': len(states),
+            'record_bytes': {'mean': round(float(np.mean(sizes)), 1), 'max': int(np.max(sizes))},
+            'store_bytes': store.stats()['bytes'],
+            'encode': summarise(encode),
+            'decode': summarise(decode),
+            'decode_and_restore': summarise(restore)}
+
+
+def bench_conversation(root, sessions=200, concurrency=50, latency=0.05, jitter=0.02, rows=1000, seed=0,
+                       trace_memory=True, stream=False, moderation_window=DEFAULT_BATCH_WINDOW,
+                       moderation_max_batch=DEFAULT_MAX_BATCH):
+    """
+    Runs simulated conversations through stages 1 -> 3 against the stub backend.
+
+    Returns:
+        dict: Turn latency summaries (overall and per step), throughput, chat completion calls,
+              moderation calls and tokens per turn, the hit rate of the stage 3 presentation cache, the upstream
+              call metrics (`upstream.get_upstream_stats()`), the moderation batcher metrics
+              (`DialogueEngine.moderation_stats()`), and the peak memory of the run. With `stream`, the steps include the time to the first token of the reply
+              (`completion_first_token`).
+    """
+    directory = os.path.join(root, 'conversation')
+    write_catalogue(os.path.join(directory, 'data'), rows, seed=seed)
+
+    from shopassist.services.dialogue import DialogueEngine
+
+    presentation_cache = PresentationCache()
+    engines = []
+
+    def run(backend):
+        previous = set_backend(backend)
+        presentation_cache.clear()
+        try:
+            engine = DialogueEngine(presentation_cache=presentation_cache, moderation_batch_window=moderation_window,
+                                    moderation_max_batch=moderation_max_batch)
+            engines.append(engine)
+            return asyncio.run(_run_conversations(engine, sessions, concurrency, stream))
+        finally:
+            set_backend(previous)
+
+    # The scripted conversations give the budget in their third message, so the stub outputs the profile then
+    backend = StubBackend(latency=latency, jitter=jitter, profile_after=3)
+    result = {'sessions': sessions, 'concurrency': concurrency, 'latency_s': latency, 'jitter_s': jitter,
+              'stream': stream, 'moderation_window_s': moderation_window,
+              'moderation_max_batch': moderation_max_batch}
+
+    with workspace(directory):
+        stage2.get_catalogue(reload=True)
+        usage_before = stage1.get_api_usage()
+        reset_upstream()
+        start = time.perf_counter()
+        timings, stages, states = run(backend)
+        elapsed = time.perf_counter() - start
+        session_store = bench_session_store(states)
+        usage = {key: value - usage_before[key] for key, value in stage1.get_api_usage().items()}
+        cache_stats = presentation_cache.stats()
+        upstream_stats = get_upstream_stats()
+        moderation_stats = engines[0].moderation_stats()
+
+        if trace_memory:
+            result['peak_memory_mb'] = peak_memory(
+                lambda: run(StubBackend(latency=latency, jitter=jitter, profile_after=3)))
+
+    calls = backend.stats()
+    turns = len(timings)
+    steps = sorted({step for turn in timings for step in turn if step != 'total'})
+
+    result.update(turns=turns,
+                  completed_sessions=sum(stage[-1] == 'recommendation' for stage in stages),
+                  wall_time_s=round(elapsed, 4),
+                  turns_per_s=round(turns / elapsed, 2),
+                  turn=summarise([turn['total'] for turn in timings]),
+                  steps={step: summarise([turn[step] for turn in timings if step in turn]) for step in steps},
+                  chat_calls_per_turn=round(usage['calls'] / turns, 3),
+                  moderation_calls_per_turn=round(calls.get('moderation', 0) / turns, 3),
+                  prompt_tokens_per_turn=round(usage['prompt_tokens'] / turns, 1),
+                  completion_tokens_per_turn=round(usage['completion_tokens'] / turns, 1),
+                  retries=usage['retries'],
+                  calls_by_kind=calls,
+                  presentation_cache=cache_stats,
+                  moderation=moderation_stats,
+                  upstream=upstream_stats,
+                  session_store=session_store)
+    print("conversation: {0} turns, p50 {1[p50_ms]:.1f} ms, p99 {1[p99_ms]:.1f} ms, {2} chat calls/turn, "
+          "{3:.0f} tokens/turn, peak {4} MB".format(
+              turns, result['turn'], result['chat_calls_per_turn'],
+              result['prompt_tokens_per_turn'] + result['completion_tokens_per_turn'], result.get('peak_memory_mb')))
+    print("conversation: peak upstream calls in flight: {0} chat, {1} moderation".format(
+        upstream_stats.get('chat', {}).get('peak_in_flight', 0),
+        upstream_stats.get('moderation', {}).get('peak_in_flight', 0)))
+    print("conversation: presentation cache hit rate {0[hit_rate]:.1%} ({0[hits]} of {1} presentations)".format(
+        cache_stats, cache_stats['hits'] + cache_stats['misses']))
+    print("conversation: {0[requests]} moderation checks in {0[batches]} calls (mean batch {0[mean_batch_size]}, "
+          "max {0[max_batch_size]}), cache hit rate {0[cache_hit_rate]:.1%}, queue wait p50 {1} ms, p99 {2} ms".format(
+              moderation_stats, moderation_stats['queue_wait_ms'].get('p50'), moderation_stats['queue_wait_ms'].get('p99')))
+    print("conversation: session records {0[record_bytes][mean]:.0f} bytes, encode p50 {1:.1f} us, "
+          "decode p50 {2:.1f} us, decode and restore p50 {3:.1f} us".format(
+              session_store, session_store['encode']['p50_ms'] * 1000, session_store['decode']['p50_ms'] * 1000,
+              session_store['decode_and_restore']['p50_ms'] * 1000))
+    if 'completion_first_token' in result['steps']:
+        print("conversation: time to first token p50 {0[p50_ms]:.1f} ms, p99 {0[p99_ms]:.1f} ms".format(
+            result['steps']['completion_first_token']))
+    return result
+
+
+def parse_importtime(report):
+    """
+    Parses the `python -X importtime` report of a process.
+
+    Returns:
+        dict: For every imported module, its own and its cumulative import time in seconds.
+    """
+    modules = {}
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(own) / 1e6, int(cumulative) / 1e6)
+    return modules
+
+
+def _python(code, directory, importtime=False):
+    """
+    Runs `code` in a fresh interpreter in `directory`, with the `app` directory on its path and the catalogue
+    snapshot setting cleared.
+
+    Returns:
+        tuple[subprocess.CompletedProcess, float]: The finished process and its wall time in seconds.
+    """
+    import shopassist
+    app = os.path.dirname(os.path.dirname(os.path.abspath(shopassist.__file__)))
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (app, os.environ.get('PYTHONPATH')))))
+    environment.pop(stage2.CATALOGUE_SNAPSHOT_ENV_VAR, None)
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    start = time.perf_counter()
+    process = subprocess.run(command, cwd=directory, env=environment, capture_output=True, text=True, check=True)
+    return process, time.perf_counter() - start
+
+
+def bench_startup(root, rows=1000, seed=0, repeats=5):
+    """
+    Measures the cold start of a process.
+
+    Returns:
+        dict: Per entry point (`STARTUP_MODULES`), the median import time, the packages that took longest to
+              import in the median run, and the `LAZY_DEPENDENCIES` it imported; per catalogue source ('csv' and
+              'snapshot'), the median time to import stage 2, to load the catalogue, and of the whole process.
+    """
+    directory = os.path.join(root, 'startup')
+    write_catalogue(os.path.join(directory, 'data'), rows, seed=seed)
+    results = {'rows': rows, 'repeats': repeats, 'imports': {}, 'cold_start': {}}
+
+    for module in STARTUP_MODULES:
+        runs = sorted((modules[module][1], modules) for modules in
+                      (parse_importtime(_python('import ' + module, directory, importtime=True)[0].stderr)
+                       for _ in range(repeats)))
+        total, modules = runs[len(runs) // 2]
+        packages = collections.Counter()
+        for name, (own, _) in modules.items():
+            packages[name.split('.')[0]] += own
+        result = results['imports'][module] = {
+            'import_ms': round(total * 1000, 2),
+            'slowest_packages_ms': {name: round(seconds * 1000, 2) for name, seconds in packages.most_common(8)},
+            'lazy_dependencies_imported': [name for name in LAZY_DEPENDENCIES if name in modules]}
+        print("startup: import {0} {1} ms ({2}); lazy dependencies imported: {3}".format(
+            module, result['import_ms'],
+            ', '.join('{0} {1} ms'.format(name, ms) for name, ms in list(result['slowest_packages_ms'].items())[:4]),
+            ', '.join(result['lazy_dependencies_imported']) or 'none'))
+
+    for source in ('csv', 'snapshot'):
+        if source == 'snapshot':
+            with workspace(directory):
+                write_binary_catalogue(stage2.get_catalogue(reload=True), binary_path(stage2.UPDATED_DATA_PATH))
+        runs = []
+        for _ in range(repeats):
+            process, wall = _python(COLD_START_SCRIPT, directory)
+            runs.append(dict(json.loads(process.stdout.strip().splitlines()[-1]), process_s=wall))
+        median = lambda key: round(float(np.median([run[key] for run in runs])) * 1000, 2)
+        result = results['cold_start'][source] = {
+            'import_ms': median('import_s'), 'load_ms': median('load_s'), 'process_ms': median('process_s'),
+            'lazy_dependencies_imported': sorted({name for run in runs for name in run['lazy_dependencies_imported']})}
+        print("startup: cold start from the {0}: import {1[import_ms]} ms, catalogue load {1[load_ms]} ms, "
+              "process {1[process_ms]} ms; lazy dependencies imported: {2}".format(
+                  source, result, ', '.join(result['lazy_dependencies_imported']) or 'none'))
+
+    return results
+
+
+def bench_enrichment(root, rows=500, workers=8, latency=0.05, seed=0, trace_memory=True):
+    """
+    Measures the throughput of `add_laptop_feature_col` against the stub backend, with and without the rules.
+
+    Returns:
+        dict: For each mode ('llm_only', 'rules'), the wall time, rows per second, LLM calls, tokens and peak memory.
+    """
+    from shopassist.services.create_laptop_feature import add_laptop_feature_col
+
+    results = {'rows': rows, 'workers': workers, 'latency_s': latency}
+    for mode, use_rules in (('llm_only', False), ('rules', True)):
+        directory = os.path.join(root, 'enrichment_{0}'.format(mode))
+        write_catalogue(os.path.join(directory, 'data'), rows, seed=seed)
+
+        def run():
+            previous = set_backend(StubBackend(latency=latency))
+            try:
+                add_laptop_feature_col(workers=workers, cache_path=None, use_rules=use_rules)
+            finally:
+                set_backend(previous)
+
+        result = {}
+        # The enrichment prints its progress; keep the benchmark output readable
+        with open(os.devnull, 'w') as devnull, workspace(directory), contextlib.redirect_stdout(devnull):
+            usage_before = stage1.get_api_usage()
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            usage = {key: value - usage_before[key] for key, value in stage1.get_api_usage().items()}
+
+            if trace_memory:
+                result['peak_memory_mb'] = peak_memory(run)
+
+        result.update(wall_time_s=round(elapsed, 4),
+                      rows_per_s=round(rows / elapsed, 2),
+                      llm_calls=usage['calls'],
+                      tokens=usage['prompt_tokens'] + usage['completion_tokens'])
+        results[mode] = result
+        print("enrichment ({0}): {1} rows/s, {2} LLM calls, peak {3} MB".format(
+            mode, result['rows_per_s'], result['llm_calls'], result.get('peak_memory_mb')))
+
+    return results
+
+
+def git_commit():
+    """
+    Returns the commit the benchmarks ran on (with a '-dirty' suffix for uncommitted changes), or `None`.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def _flatten(results, prefix=''):
+    """
+    Flattens nested results into {'suite.size.metric': value} for comparison.
+    """
+    flat = {}
+    for key, value in results.items():
+        name = prefix + str(key)
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(current, baseline):
+    """
+    Prints the relative change of every latency, throughput and memory metric against a baseline result file.
+    """
+    current_values = _flatten(current['results'])
+    baseline_values = _flatten(baseline['results'])
+    print("\nChange against {0} ({1}):".format(baseline.get('commit'), baseline.get('timestamp')))
+    for name in sorted(current_values):
+        if name not in baseline_values or not name.endswith(('_ms', '_s', 'per_s', 'per_turn', '_mb')):
+            continue
+        if name.endswith(('latency_s', 'jitter_s')):
+            continue  # Benchmark parameters, not measurements
+        old, new = baseline_values[name], current_values[name]
+        change = (new - old) / old * 100 if old else float('nan')
+        print("  {0:<70} {1:>12.4f} -> {2:>12.4f} ({3:+.1f}%)".format(name, old, new, change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ShopAssist pipeline offline.")
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=list(SUITES),
+                        help="suites to run (default: all)")
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(DEFAULT_SIZES),
+                        help="catalogue sizes of the stage 2 suite")
+    parser.add_argument('--queries', type=int, default=200,
+                        help="user profiles scored per catalogue size")
+    parser.add_argument('--sessions', type=int, default=200,
+                        help="simulated conversations")
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help="conversations in flight at a time")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="simulated duration of each stub LLM call, in seconds")
+    parser.add_argument('--stream', action='store_true',
+                        help="stream the replies of the conversation suite and report the time to the first token")
+    parser.add_argument('--moderation-window', type=float, default=DEFAULT_BATCH_WINDOW,
+                        help="seconds a moderation batch of the conversation suite waits for other sessions")
+    parser.add_argument('--moderation-max-batch', type=int, default=DEFAULT_MAX_BATCH,
+                        help="maximum texts per moderation call of the conversation suite (1 disables batching)")
+    parser.add_argument('--enrichment-rows', type=int, default=500,
+                        help="rows enriched by the enrichment suite")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="concurrent LLM calls of the enrichment suite")
+    parser.add_argument('--startup-repeats', type=int, default=5,
+                        help="fresh interpreters started per measurement of the startup suite")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true',
+                        help="skip the (slow) traced passes that measure peak memory")
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help="file the results are written to")
+    parser.add_argument('--compare', default=None,
+                        help="earlier result file to compare against")
+    args = parser.parse_args(argv)
+
+    report = {'commit': git_commit(),
+              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': sys.version.split()[0],
+              'platform': platform.platform(),
+              'arguments': vars(args),
+              'results': {}}
+
+    with tempfile.TemporaryDirectory(prefix='shopassist-bench-') as root:
+        if 'stage2' in args.suites:
+            report['results']['stage2'] = bench_stage2(root, args.sizes, args.queries, args.seed,
+                                                       trace_memory=not args.no_memory)
+        if 'conversation' in args.suites:
+            report['results']['conversation'] = bench_conversation(root, args.sessions, args.concurrency,
+                                                                   args.latency, seed=args.seed,
+                                                                   trace_memory=not args.no_memory,
+                                                                   stream=args.stream,
+                                                                   moderation_window=args.moderation_window,
+                                                                   moderation_max_batch=args.moderation_max_batch)
+        if 'enrichment' in args.suites:
+            report['results']['enrichment'] = bench_enrichment(root, args.enrichment_rows, args.workers,
+                                                               args.latency, seed=args.seed,
+                                                               trace_memory=not args.no_memory)
+        if 'startup' in args.suites:
+            report['results']['startup'] = bench_startup(root, seed=args.seed, repeats=args.startup_repeats)
+
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print("Results written to {0}".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(report, json.load(file))
+
+    return report
+
+
+if __name__ == "__main__":
+
+    main()
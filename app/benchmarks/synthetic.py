@@ -0,0 +1,136 @@
+"""
+synthetic.py
+============
+
+Synthetic laptop catalogues, user profiles and conversations for the benchmarks.
+
+The catalogues have the columns of `laptop_data.csv` (and `updated_laptop.csv` with `laptop_feature`), with
+values drawn from the same vocabulary as the real dataset, so the pipeline parses them exactly like real data.
+Everything is generated from a seed, so every run benchmarks the same data.
+
+Key Functionality:
+- `make_catalogue()`: Builds a catalogue of any size as a DataFrame.
+- `write_catalogue()`: Writes it as `laptop_data.csv` and `updated_laptop.csv` in a data directory.
+- `random_profiles()`: Draws user profiles in the format returned by `dictionary_present`.
+- `CONVERSATIONS`: Scripted user messages for simulated stage 1 -> 3 conversations.
+"""
+
+
+import os
+import numpy as np
+import pandas as pd
+from shopassist.utils.features import FEATURE_KEYS, LEVELS
+
+
+BRANDS = ('Dell', 'HP', 'Lenovo', 'ASUS', 'Acer', 'MSI', 'Apple')
+CORES = (('i3', 'Intel'), ('i5', 'Intel'), ('i7', 'Intel'), ('i9', 'Intel'),
+         ('Ryzen 5', 'AMD'), ('Ryzen 7', 'AMD'), ('M1', 'Apple'))
+RAM_SIZES = ('8GB', '12GB', '16GB', '32GB', '64GB')
+GPUS = ('Intel UHD', 'Intel Iris', 'AMD Radeon', 'NVIDIA GTX', 'NVIDIA RTX')
+RESOLUTIONS = ('1366x768', '1920x1080', '2560x1600', '3840x2160')
+DISPLAY_TYPES = ('LCD', 'IPS', 'OLED', 'Retina')
+
+# Scripted user messages of simulated conversations; the last message is a stage 3 follow-up question
+CONVERSATIONS = (
+    ("Hi, I am a video editor", "I travel a lot and carry my laptop", "my max budget is 1.5 lakh inr",
+     "Which of these has the best display?"),
+    ("I want a laptop for gaming", "I mostly play at my desk at home", "around 90,000 INR",
+     "Which one is the lightest?"),
+    ("I am a student and need a laptop for browsing and office work", "I commute to college every day",
+     "my budget is 50k", "Which one has the longest battery life?"),
+    ("I am a developer working on data pipelines", "I work from home", "1,20,000 rupees",
+     "Which one is the fastest?"),
+)
+
+
+def make_catalogue(rows, seed=0, with_features=True):
+    """
+    Builds a synthetic laptop catalogue.
+
+    Args:
+        rows (int): Number of laptops.
+        seed (int): Seed of the random generator.
+        with_features (bool): Add the `laptop_feature` column (as `updated_laptop.csv` has it).
+
+    Returns:
+        pd.DataFrame: The catalogue.
+    """
+    rng = np.random.default_rng(seed)
+
+    def pick(values):
+        return np.asarray(values, dtype=object)[rng.integers(0, len(values), rows)]
+
+    brands = pick(BRANDS)
+    cores = rng.integers(0, len(CORES), rows)
+    ram = pick(RAM_SIZES)
+    gpu = pick(GPUS)
+    resolution = pick(RESOLUTIONS)
+    display = pick(DISPLAY_TYPES)
+    weight = np.round(rng.uniform(1.0, 3.3, rows), 2)
+    prices = rng.integers(25, 300, rows) * 1000
+    clock = np.round(rng.uniform(1.6, 3.6, rows), 1)
+
+    laptop_df = pd.DataFrame({
+        'Brand': brands,
+        'Model Name': ['Model {0}'.format(index) for index in range(rows)],
+        'Core': [CORES[index][0] for index in cores],
+        'CPU Manufacturer': [CORES[index][1] for index in cores],
+        'Clock Speed': ['{0} GHz'.format(value) for value in clock],
+        'RAM Size': ram,
+        'Storage Type': pick(('SSD', 'HDD')),
+        'Display Type': display,
+        'Display Size': pick(('13.3"', '14"', '15.6"', '17.3"')),
+        'Graphics Processor': gpu,
+        'Screen Resolution': resolution,
+        'OS': pick(('Windows 10', 'Windows 11', 'macOS', 'Linux')),
+        'Laptop Weight': ['{0} kg'.format(value) for value in weight],
+        'Special Features': pick(('Backlit Keyboard', 'Fingerprint Reader', 'Touchscreen', 'Thunderbolt')),
+        'Warranty': pick(('1 year', '2 years', '3 years')),
+        'Average Battery Life': ['{0} hours'.format(value) for value in rng.integers(4, 16, rows)],
+        'Price': ['{0:,}'.format(value) for value in prices],
+    })
+    laptop_df['Description'] = [
+        "The {0} {1} has an {2} {3} processor clocked at {4}, {5} of RAM and a {6} {7} display. "
+        "It comes with {8} graphics and weighs {9}. It is priced at {10}.".format(*values)
+        for values in zip(laptop_df['Brand'], laptop_df['Model Name'], laptop_df['CPU Manufacturer'],
+                          laptop_df['Core'], laptop_df['Clock Speed'], laptop_df['RAM Size'],
+                          laptop_df['Display Type'], laptop_df['Screen Resolution'],
+                          laptop_df['Graphics Processor'], laptop_df['Laptop Weight'], laptop_df['Price'])]
+
+    if with_features:
+        levels = rng.integers(0, len(LEVELS), (rows, len(FEATURE_KEYS)))
+        laptop_df['laptop_feature'] = [str({key: LEVELS[level] for key, level in zip(FEATURE_KEYS, row)})
+                                       for row in levels.tolist()]
+    return laptop_df
+
+
+def write_catalogue(data_dir, rows, seed=0):
+    """
+    Writes a synthetic `laptop_data.csv` and `updated_laptop.csv` to a data directory.
+
+    Returns:
+        tuple[str, str]: The paths of the raw and the enriched catalogue.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    laptop_df = make_catalogue(rows, seed=seed)
+    raw_path = os.path.join(data_dir, 'laptop_data.csv')
+    updated_path = os.path.join(data_dir, 'updated_laptop.csv')
+    laptop_df.drop(columns=['laptop_feature']).to_csv(raw_path, index=False)
+    laptop_df.to_csv(updated_path, index=False)
+    return raw_path, updated_path
+
+
+def random_profiles(count, seed=0):
+    """
+    Draws user profiles in the format returned by `dictionary_present`.
+
+    Returns:
+        list[dict]: `count` profiles with the five feature levels and a budget between 30,000 and 2,50,000.
+    """
+    rng = np.random.default_rng(seed)
+    profiles = []
+    for _ in range(count):
+        profile = {key: LEVELS[rng.integers(0, len(LEVELS))] for key in FEATURE_KEYS}
+        profile['Budget'] = str(int(rng.integers(30, 250)) * 1000)
+        profiles.append(profile)
+    return profiles
@@ -0,0 +1,354 @@
+"""
+backend.py
+==========
+
+The LLM backend used by every stage of the pipeline.
+
+`stage1` (and through it `stage2`, `helper.product_map_layer` and `create_laptop_feature`) and the asynchronous
+dialogue engine never call `openai` directly; they send their requests to the current backend. The default
+backend forwards them to the OpenAI API; the stub backend in `shopassist.services.stub_backend` answers them
+locally, so the whole pipeline can run offline for load tests and benchmarks.
+
+Key Components:
+- `LLMBackend`: The interface: `chat_completion()` and `moderation()`, plus their async counterparts and the
+  streaming `chat_completion_stream()` / `achat_completion_stream()`.
+- `OpenAIBackend`: Sends the requests to the OpenAI API through one pooled, keep-alive HTTP client per process
+  (and one for async calls), with the remaining time of the current deadline (`shopassist.services.upstream`)
+  as the timeout of every request. `pool_stats()` reports the connections of the pools.
+- `get_backend()` / `set_backend()`: The process-wide backend. The default is chosen by the
+  `SHOPASSIST_LLM_BACKEND` environment variable ('openai' or 'stub').
+- `create_backend()`: Creates a backend by name.
+
+Responses have the shape of the OpenAI responses (`response.choices[0].message.content`, `response.usage`,
+`response.results[0].flagged`), so the stage functions handle every backend the same way. Streamed completions
+are iterables of OpenAI-shaped chunks (`chunk.choices[0].delta.content`, and `chunk.usage` on the last chunk).
+"""
+
+
+import os
+import asyncio
+import threading
+from types import SimpleNamespace
+from shopassist.services.upstream import remaining_time
+
+
+BACKEND_ENV_VAR = 'SHOPASSIST_LLM_BACKEND'
+STUB_LATENCY_ENV_VAR = 'SHOPASSIST_STUB_LATENCY'
+
+BACKENDS = ('openai', 'stub')
+
+# Connection pool of the OpenAI clients: sized for the dialogue engine's default concurrency (64 chat and 64
+# moderation calls), with idle connections kept open for reuse
+DEFAULT_MAX_CONNECTIONS = 128
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 64
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+DEFAULT_CONNECT_TIMEOUT = 5.0
+
+# Timeout of a request made without a deadline
+DEFAULT_REQUEST_TIMEOUT = 60.0
+
+
+def completion_chunks(completion):
+    """
+    Converts a complete chat completion into the chunks of a streamed one: one chunk with the whole content,
+    then a final chunk with the usage and no choices.
+    """
+    content = completion.choices[0].message.content
+    model = getattr(completion, 'model', None)
+    return [SimpleNamespace(model=model, usage=None,
+                            choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=content),
+                                                     finish_reason='stop')]),
+            SimpleNamespace(model=model, usage=getattr(completion, 'usage', None), choices=[])]
+
+
+class LLMBackend:
+    """
+    Interface of an LLM backend.
+
+    Subclasses implement `chat_completion()` and `moderation()`. The async counterparts run the blocking calls
+    in a worker thread unless a subclass provides native async versions.
+    """
+
+    name = 'base'
+
+    def chat_completion(self, **request):
+        """
+        Creates a chat completion.
+
+        Args:
+            **request: The keyword arguments of `chat.completions.create` (model, messages, response_format, seed).
+
+        Returns:
+            The completion, with `choices[0].message.content` and `usage`.
+        """
+        raise NotImplementedError
+
+    def moderation(self, text):
+        """
+        Classifies a text, or a list of texts in one request, with the moderation endpoint.
+
+        Args:
+            text (str or list[str]): The input(s).
+
+        Returns:
+            The moderation response, with one result per input (`results[i].flagged`).
+        """
+        raise NotImplementedError
+
+    def chat_completion_stream(self, **request):
+        """
+        Creates a chat completion whose content is returned in chunks as it is generated.
+
+        The default implementation waits for the whole completion and returns it as a single chunk.
+
+        Returns:
+            iterable: Chunks with `choices[0].delta.content`; the last chunk has `usage` and no choices.
+        """
+        return completion_chunks(self.chat_completion(**request))
+
+    async def achat_completion(self, **request):
+        """
+        Async counterpart of `chat_completion()`.
+        """
+        return await asyncio.to_thread(self.chat_completion, **request)
+
+    async def achat_completion_stream(self, **request):
+        """
+        Async counterpart of `chat_completion_stream()`.
+
+        Returns:
+            async iterable: The chunks.
+        """
+        completion = await self.achat_completion(**request)
+
+        async def chunks():
+            for chunk in completion_chunks(completion):
+                yield chunk
+        return chunks()
+
+    async def amoderation(self, text):
+        """
+        Async counterpart of `moderation()`.
+        """
+        return await asyncio.to_thread(self.moderation, text)
+
+    def pool_stats(self):
+        """
+        Reports the connection pools of the backend.
+
+        Returns:
+            dict: Per pool, the open and idle connections and the pool's limit. Empty for backends without one.
+        """
+        return {}
+
+    def close(self):
+        """
+        Releases the backend's connections.
+        """
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    Sends requests to the OpenAI API.
+
+    The clients are created on first use with their own connection pool, so every call of the process reuses the
+    same keep-alive connections. A process forked after that (e.g. a worker of a pre-forked server) creates new
+    clients instead of sharing the parent's sockets. The SDK's own retries are disabled: retries are made by
+    `stage1` and the dialogue engine within the deadline of the call.
+    """
+
+    name = 'openai'
+
+    def __init__(self, client=None, async_client=None, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 max_keepalive_connections=DEFAULT_MAX_KEEPALIVE_CONNECTIONS, keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, timeout=DEFAULT_REQUEST_TIMEOUT):
+        """
+        Args:
+            client (openai.OpenAI, optional): The client for blocking calls. Created on first use if omitted.
+            async_client (openai.AsyncOpenAI, optional): The client for async calls. Created on first use if omitted.
+            max_connections (int): Maximum number of connections of each pool.
+            max_keepalive_connections (int): Maximum number of idle connections kept open.
+            keepalive_expiry (float): Seconds an idle connection is kept open.
+            connect_timeout (float): Timeout of establishing a connection, in seconds.
+            timeout (float): Timeout of a request made without a deadline, in seconds.
+        """
+        self._client = client
+        self._async_client = async_client
+        self._http_client = None
+        self._async_http_client = None
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _check_fork(self):
+        """
+        Drops the clients created by a parent process; their connections belong to the parent.
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if self._http_client is not None:
+                        self._client = self._http_client = None
+                    if self._async_http_client is not None:
+                        self._async_client = self._async_http_client = None
+                    self._pid = os.getpid()
+
+    def _http_options(self):
+        import httpx
+        return dict(limits=httpx.Limits(max_connections=self.max_connections,
+                                        max_keepalive_connections=self.max_keepalive_connections,
+                                        keepalive_expiry=self.keepalive_expiry),
+                    timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout))
+
+    @property
+    def client(self):
+        self._check_fork()
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import httpx
+                    import openai
+                    self._http_client = httpx.Client(**self._http_options())
+                    self._client = openai.OpenAI(api_key=openai.api_key, http_client=self._http_client,
+                                                 max_retries=0)
+        return self._client
+
+    @property
+    def async_client(self):
+        self._check_fork()
+        if self._async_client is None:
+            with self._lock:
+                if self._async_client is None:
+                    import httpx
+                    import openai
+                    self._async_http_client = httpx.AsyncClient(**self._http_options())
+                    self._async_client = openai.AsyncOpenAI(api_key=openai.api_key,
+                                                            http_client=self._async_http_client, max_retries=0)
+        return self._async_client
+
+    def _timeout(self):
+        """
+        The timeout of the next request: the time left until the current deadline, or the default timeout.
+        """
+        remaining = remaining_time()
+        if remaining is None:
+            return self.timeout
+        return max(0.001, min(remaining, self.timeout))
+
+    def chat_completion(self, **request):
+        return self.client.chat.completions.create(timeout=self._timeout(), **request)
+
+    def chat_completion_stream(self, **request):
+        return self.client.chat.completions.create(stream=True, stream_options={'include_usage': True},
+                                                   timeout=self._timeout(), **request)
+
+    def moderation(self, text):
+        return self.client.moderations.create(input=text, timeout=self._timeout())
+
+    async def achat_completion(self, **request):
+        return await self.async_client.chat.completions.create(timeout=self._timeout(), **request)
+
+    async def achat_completion_stream(self, **request):
+        return await self.async_client.chat.completions.create(stream=True, stream_options={'include_usage': True},
+                                                               timeout=self._timeout(), **request)
+
+    async def amoderation(self, text):
+        return await self.async_client.moderations.create(input=text, timeout=self._timeout())
+
+    def pool_stats(self):
+        """
+        Reports the connections of the blocking ('sync') and async ('async') pools created so far.
+
+        The counts are read from the pool of the `httpx` transport, which is not a public interface; they are
+        left out if it changes.
+        """
+        stats = {}
+        for name, http_client in (('sync', self._http_client), ('async', self._async_http_client)):
+            if http_client is None:
+                continue
+            stats[name] = {'max_connections': self.max_connections,
+                           'max_keepalive_connections': self.max_keepalive_connections}
+            pool = getattr(getattr(http_client, '_transport', None), '_pool', None)
+            connections = getattr(pool, 'connections', None)
+            if connections is not None:
+                connections = list(connections)
+                stats[name].update(connections=len(connections),
+                                   idle=sum(1 for connection in connections if connection.is_idle()))
+        return stats
+
+    def close(self):
+        """
+        Closes the blocking client's connections. The async client is closed with `aclose()`.
+        """
+        with self._lock:
+            if self._http_client is not None:
+                self._http_client.close()
+                self._client = self._http_client = None
+
+    async def aclose(self):
+        """
+        Closes the async client's connections.
+        """
+        if self._async_http_client is not None:
+            await self._async_http_client.aclose()
+            self._async_client = self._async_http_client = None
+
+
+def create_backend(name=None, **options):
+    """
+    Creates a backend by name.
+
+    Args:
+        name (str, optional): 'openai' or 'stub'. Defaults to the `SHOPASSIST_LLM_BACKEND` environment variable,
+                              or 'openai'.
+        **options: Keyword arguments of the backend class (e.g. `latency` for the stub). For the stub, the
+                   latency defaults to the `SHOPASSIST_STUB_LATENCY` environment variable (seconds).
+
+    Returns:
+        LLMBackend: The new backend.
+    """
+    name = (name or os.environ.get(BACKEND_ENV_VAR) or 'openai').strip().lower()
+
+    if name == 'openai':
+        return OpenAIBackend(**options)
+
+    if name == 'stub':
+        from shopassist.services.stub_backend import StubBackend
+        if 'latency' not in options and os.environ.get(STUB_LATENCY_ENV_VAR):
+            options['latency'] = float(os.environ[STUB_LATENCY_ENV_VAR])
+        return StubBackend(**options)
+
+    raise ValueError("Unknown LLM backend {0!r}; expected one of {1}".format(name, BACKENDS))
+
+
+_BACKEND = None
+
+
+def get_backend():
+    """
+    Returns the process-wide backend, creating it from the environment on first use.
+    """
+    global _BACKEND
+    if _BACKEND is None:
+        _BACKEND = create_backend()
+    return _BACKEND
+
+
+def set_backend(backend):
+    """
+    Replaces the process-wide backend.
+
+    Args:
+        backend (LLMBackend or str): A backend, or the name of one to create.
+
+    Returns:
+        LLMBackend: The previous backend (or `None`), so it can be restored.
+    """
+    global _BACKEND
+    previous = _BACKEND
+    _BACKEND = create_backend(backend) if isinstance(backend, str) else backend
+    return previous
@@ -0,0 +1,376 @@
+"""
+catalogue.py
+============
+
+This module holds the in-memory laptop catalogue used by Stage 2 to score laptops against a user's requirements.
+
+The catalogue is loaded once per process from `updated_laptop.csv`. Prices are kept as an integer array and the five
+feature levels of every laptop are encoded as a small int8 matrix (`low`=0, `medium`=1, `high`=2, unknown=-1), so scoring a
+user profile is a single vectorised comparison instead of a row-by-row loop.
+
+Queries go through a price index: the laptops are also stored sorted by price, so a price range (the budget, and an
+optional floor) is a binary-search slice of the index. Within the slice, laptops are scored in blocks from the most
+expensive down, and the search stops as soon as `k` laptops with the best possible score have been found, so the
+common "top k under budget B for profile P" query costs O(log n + block) instead of a pass over the catalogue.
+
+Key Functionality:
+- `LaptopCatalogue.from_csv()`: Builds the catalogue from the enriched CSV file.
+- `LaptopCatalogue.from_arrays()`: Wraps precomputed arrays (e.g. the memory-mapped binary catalogue of
+  `shopassist.services.catalogue_store`) without copying or re-indexing them.
+- `LaptopCatalogue.score()`: Scores every laptop against the user's requirements.
+- `LaptopCatalogue.price_range()`: Binary-searches the price index for a price range.
+- `LaptopCatalogue.query()`: Selects the best `k` laptops in a price range (optionally of given brands).
+- `LaptopCatalogue.top_k()`: `query()` with the user's budget as the price ceiling.
+- `LaptopCatalogue.to_json()`: Serialises selected laptops (with their scores) to the JSON records format used by Stage 3.
+- `LaptopCatalogue.sku()` / `find_skus()`: The stable id of a laptop (brand and model name), and the rows of given ids.
+
+Dependencies:
+- numpy: For the price array, the feature-level matrix and vectorised scoring.
+- pandas: For reading the CSV file (imported only then, so loading the binary catalogue does not pay for it).
+"""
+
+
+import json
+import math
+import numpy as np
+from shopassist.utils.features import FEATURE_KEYS, LEVEL_MAP, parse_laptop_feature
+
+
+# Laptops scored per step of a query; every further step doubles it, so a full scan still takes O(log n) steps
+QUERY_BLOCK = 1024
+
+
+def parse_price(value):
+    """
+    Converts a price such as '55,000', '55000' or 55000 into an integer.
+    """
+    return int(str(value).replace(',', '').split()[0])
+
+
+def parse_budget(user_req_dict):
+    """
+    Extracts the budget from the user's requirements as an integer.
+
+    Args:
+        user_req_dict (dict): The user's requirements. `Budget` may be a number or a string such as '1,50,000 INR'.
+
+    Returns:
+        int: The budget, or 0 if it is missing.
+    """
+    return parse_price(user_req_dict.get('Budget', '0'))
+
+
+def encode_levels(laptop_values):
+    """
+    Encodes a feature dictionary as a row of levels in `FEATURE_KEYS` order (unknown values become -1).
+    """
+    return [LEVEL_MAP.get(laptop_values.get(key, None), -1) for key in FEATURE_KEYS]
+
+
+class LaptopCatalogue:
+    """
+    An immutable, pre-parsed laptop catalogue.
+
+    Attributes:
+        columns (list[str]): Names of the product columns, in file order (without `laptop_feature`).
+        records (list[dict]): Product details of every laptop, with `Price` as an integer.
+        prices (np.ndarray): int64 array of prices, aligned with `records`.
+        levels (np.ndarray): int8 matrix of shape (5, n) with one row of levels per feature, in `FEATURE_KEYS` order.
+                             Feature-major storage keeps each comparison a contiguous pass over memory.
+        price_order (np.ndarray): Row indices sorted by increasing price (equal prices: later rows first), so
+                                  walking it backwards visits laptops by decreasing price, then catalogue order.
+        sorted_prices (np.ndarray): `prices` in `price_order`, for binary search.
+        sorted_levels (np.ndarray): `levels` with the columns in `price_order`.
+        brands (tuple[str]): The distinct brands (lower case); `sorted_brands` holds each laptop's index into it,
+                             in `price_order` (-1 without a brand).
+    """
+
+    def __init__(self, columns, records, prices, levels):
+        """
+        Args:
+            columns (list[str]): Names of the product columns.
+            records (list[dict]): Product details of every laptop.
+            prices (array-like): Price of every laptop.
+            levels (array-like): Feature levels of every laptop, shape (n, 5).
+        """
+        self.columns = list(columns)
+        self.records = records
+        self.prices = np.asarray(prices, dtype=np.int64)
+        levels = np.asarray(levels, dtype=np.int8).reshape(len(self.prices), len(FEATURE_KEYS))
+        self.levels = np.ascontiguousarray(levels.T)
+        self._build_index()
+
+    def _build_index(self):
+        """
+        Builds the price index and the brand codes from `prices`, `levels` and `records`.
+        """
+        records = self.records
+        rows = np.arange(len(self.prices))
+        self.price_order = np.lexsort((-rows, self.prices))
+        self.sorted_prices = self.prices[self.price_order]
+        self.sorted_levels = np.ascontiguousarray(self.levels[:, self.price_order])
+
+        brand_names = [str(record.get('Brand') or '').strip().lower() for record in records]
+        self.brands = tuple(sorted(set(brand_names) - {''}))
+        codes = {brand: code for code, brand in enumerate(self.brands)}
+        brand_codes = np.array([codes.get(brand, -1) for brand in brand_names], dtype=np.int32)
+        self.sorted_brands = brand_codes[self.price_order]
+
+    def __len__(self):
+        return len(self.records)
+
+    @classmethod
+    def from_arrays(cls, columns, records, prices, levels, price_order, sorted_prices, sorted_levels, brands,
+                    sorted_brands):
+        """
+        Builds a catalogue from precomputed arrays, used as they are (they may be read-only memory maps).
+
+        Args:
+            columns (list[str]): Names of the product columns.
+            records (sequence of dict): Product details of every laptop.
+            prices, levels, price_order, sorted_prices, sorted_levels, brands, sorted_brands: The attributes of the
+                same name, as `__init__` computes them (`levels` and `sorted_levels` of shape (5, n)).
+
+        Returns:
+            LaptopCatalogue: The catalogue.
+        """
+        catalogue = cls.__new__(cls)
+        catalogue.columns = list(columns)
+        catalogue.records = records
+        catalogue.prices = prices
+        catalogue.levels = levels
+        catalogue.price_order = price_order
+        catalogue.sorted_prices = sorted_prices
+        catalogue.sorted_levels = sorted_levels
+        catalogue.brands = tuple(brands)
+        catalogue.sorted_brands = sorted_brands
+        return catalogue
+
+    @classmethod
+    def from_frame(cls, laptop_df, feature_parser=None):
+        """
+        Builds a catalogue from a DataFrame with the columns of `updated_laptop.csv`.
+
+        Args:
+            laptop_df (pd.DataFrame): The enriched laptop dataset.
+            feature_parser (callable, optional): Converts a `laptop_feature` value into a feature dictionary.
+                                                 Defaults to the strict local parser.
+
+        Returns:
+            LaptopCatalogue: The parsed catalogue.
+        """
+        if feature_parser is None:
+            feature_parser = lambda value: parse_laptop_feature(value) or {}
+
+        product_df = laptop_df.drop('laptop_feature', axis=1)
+        prices = [parse_price(price) for price in product_df['Price']]
+
+        records = product_df.to_dict(orient='records')
+        for record, price in zip(records, prices):
+            for column, value in record.items():
+                if isinstance(value, float) and math.isnan(value):
+                    record[column] = None  # Keeping the records JSON-serialisable
+            record['Price'] = price
+
+        levels = [encode_levels(feature_parser(value)) for value in laptop_df['laptop_feature']]
+
+        return cls(product_df.columns, records, prices, levels)
+
+    @classmethod
+    def from_csv(cls, path, feature_parser=None):
+        """
+        Reads `updated_laptop.csv` and builds a catalogue from it. See `from_frame`.
+        """
+        # pandas is only needed to parse the CSV; the binary catalogue is read without it
+        import pandas as pd
+        return cls.from_frame(pd.read_csv(path), feature_parser=feature_parser)
+
+    @staticmethod
+    def _requirements(user_req_dict):
+        """
+        Converts the user's requirements into (feature row, minimum level) pairs and a constant score.
+
+        A laptop earns one point for every requirement (except `Budget`) whose level it meets or exceeds,
+        exactly as in the original row-by-row comparison. Requirements that are not one of the five features
+        are compared against a missing laptop value.
+        """
+        requirements = []
+        constant = 0
+        for key, user_value in user_req_dict.items():
+            if key == 'Budget':
+                continue  # Skipping budget comparison
+            user_mapping = LEVEL_MAP.get(user_value, -1)
+            if key in FEATURE_KEYS:
+                requirements.append((FEATURE_KEYS.index(key), user_mapping))
+            elif user_mapping <= -1:
+                constant += 1  # A missing laptop value (-1) still meets an unknown user value (-1)
+        return requirements, constant
+
+    @staticmethod
+    def _score_levels(levels, requirements, constant):
+        """
+        Scores the laptops of a (5, m) level matrix.
+        """
+        scores = np.full(levels.shape[1], constant, dtype=np.int8)
+        for row, user_mapping in requirements:
+            scores += levels[row] >= user_mapping
+        return scores
+
+    def score(self, user_req_dict):
+        """
+        Scores every laptop against the user's requirements (see `_requirements`).
+
+        Args:
+            user_req_dict (dict): The user's requirements.
+
+        Returns:
+            np.ndarray: int8 array with the score of every laptop, in catalogue order.
+        """
+        return self._score_levels(self.levels, *self._requirements(user_req_dict))
+
+    def price_range(self, min_price=None, max_price=None):
+        """
+        Binary-searches the price index.
+
+        Args:
+            min_price (int, optional): Lowest price included.
+            max_price (int, optional): Highest price included.
+
+        Returns:
+            tuple[int, int]: The slice `[start, end)` of `price_order` with the laptops in the range.
+        """
+        start = 0 if min_price is None else int(np.searchsorted(self.sorted_prices, min_price, side='left'))
+        end = len(self) if max_price is None else int(np.searchsorted(self.sorted_prices, max_price, side='right'))
+        return start, max(start, end)
+
+    def _brand_codes(self, brands):
+        """
+        Returns the codes of the requested brands (case-insensitive) that exist in the catalogue.
+        """
+        wanted = {str(brand).strip().lower() for brand in brands}
+        return np.array([code for code, brand in enumerate(self.brands) if brand in wanted], dtype=np.int32)
+
+    def query(self, user_req_dict=None, k=3, max_price=None, min_price=None, brands=None):
+        """
+        Selects the best `k` laptops in a price range.
+
+        Laptops are ranked by score (descending), then by closeness to `max_price` (the most expensive first,
+        since every candidate is at or below it), then by catalogue order, so results are deterministic.
+
+        The price range is a binary-search slice of the price index. The slice is scored in blocks from its most
+        expensive end; each block is twice as large as the previous one, and the search stops once `k` laptops
+        with the best possible score have been found, since no cheaper laptop can then rank above them.
+
+        Args:
+            user_req_dict (dict, optional): The user's requirements. `Budget` is ignored; pass it as `max_price`.
+            k (int): Number of laptops to return.
+            max_price (int, optional): Highest price (e.g. the budget). Defaults to no ceiling.
+            min_price (int, optional): Lowest price. Defaults to no floor.
+            brands (iterable of str, optional): Only laptops of these brands (case-insensitive).
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Row indices of the selected laptops and their scores, best first.
+        """
+        empty = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int8)
+        start, end = self.price_range(min_price, max_price)
+        if k <= 0 or start >= end:
+            return empty
+
+        brand_codes = None
+        if brands is not None:
+            brand_codes = self._brand_codes(brands)
+            if len(brand_codes) == 0:
+                return empty
+
+        requirements, constant = self._requirements(user_req_dict or {})
+        best_possible = constant + len(requirements)
+
+        positions, ranks = [], []
+        found_best = 0
+        block = max(QUERY_BLOCK, k)
+        while end > start and found_best < k:
+            block_start = max(start, end - block)
+            block_positions = np.arange(block_start, end)
+            block_scores = self._score_levels(self.sorted_levels[:, block_start:end], requirements, constant)
+            if brand_codes is not None:
+                keep = np.isin(self.sorted_brands[block_start:end], brand_codes)
+                block_positions, block_scores = block_positions[keep], block_scores[keep]
+
+            # One int64 key per laptop: the score, then the position in the price index (higher = closer to the ceiling)
+            positions.append(block_positions)
+            ranks.append(block_scores.astype(np.int64) * len(self) + block_positions)
+            found_best += int(np.count_nonzero(block_scores == best_possible))
+            end = block_start
+            block *= 2
+
+        positions = np.concatenate(positions)
+        ranks = np.concatenate(ranks)
+        k = min(k, len(ranks))
+        if k == 0:
+            return empty
+
+        best = np.argpartition(-ranks, k - 1)[:k] if k < len(ranks) else np.arange(len(ranks))
+        best = best[np.argsort(-ranks[best])]
+        selected = self.price_order[positions[best]]
+        return selected, (ranks[best] // len(self)).astype(np.int8)
+
+    def top_k(self, user_req_dict, k=3, min_price=None, brands=None):
+        """
+        Selects the best `k` laptops within the user's budget. See `query()` for the ranking.
+
+        Args:
+            user_req_dict (dict): The user's requirements, including `Budget`.
+            k (int): Number of laptops to return.
+            min_price (int, optional): Lowest price.
+            brands (iterable of str, optional): Only laptops of these brands.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Row indices of the selected laptops and their scores, best first.
+        """
+        return self.query(user_req_dict, k=k, max_price=parse_budget(user_req_dict), min_price=min_price,
+                          brands=brands)
+
+    def to_json(self, indices, scores):
+        """
+        Serialises the selected laptops and their scores as JSON records.
+
+        Args:
+            indices (np.ndarray): Row indices of the laptops.
+            scores (np.ndarray): Score of each laptop.
+
+        Returns:
+            str: A JSON array of laptop records, each with an additional `Score` key.
+        """
+        top_laptops = [dict(self.records[index], Score=int(score)) for index, score in zip(indices, scores)]
+        return json.dumps(top_laptops, separators=(',', ':'))
+
+    def sku(self, row):
+        """
+        Returns the stable id of a laptop, its brand and model name (`'Dell|Inspiron 15'`), which survives
+        catalogue refreshes that move its row.
+        """
+        record = self.records[row]
+        return '{0}|{1}'.format(str(record.get('Brand') or '').strip(), str(record.get('Model Name') or '').strip())
+
+    def find_skus(self, skus, rows=None):
+        """
+        Finds laptops by id.
+
+        Args:
+            skus (list[str]): Ids returned by `sku()`.
+            rows (list[int], optional): The rows the laptops had when their ids were taken. Rows that still hold
+                                        the same laptop are used directly; the others are looked up in an index
+                                        of all ids, built on first use.
+
+        Returns:
+            list: The row of every id, or `None` for laptops no longer in the catalogue.
+        """
+        found = []
+        for position, sku in enumerate(skus):
+            row = rows[position] if rows is not None else None
+            if row is None or not 0 <= row < len(self) or self.sku(row) != sku:
+                if getattr(self, '_sku_rows', None) is None:
+                    self._sku_rows = {self.sku(index): index for index in range(len(self))}
+                row = self._sku_rows.get(sku)
+            found.append(row)
+        return found
@@ -0,0 +1,353 @@
+"""
+catalogue_store.py
+==================
+
+A compact, typed binary format for the enriched laptop catalogue, memory-mapped by Stage 2.
+
+`updated_laptop.csv` stores `Price` as comma-formatted text and `laptop_feature` as a stringified Python dictionary,
+so every process that loads it re-parses both for every laptop. The binary catalogue stores what Stage 2 actually
+uses, already parsed and indexed, as a directory of NumPy `.npy` files next to the CSV (`updated_laptop.npcat`):
+- `prices.npy` (int64) and `levels.npy` (int8, one row per feature), plus the price index of `LaptopCatalogue`
+  (`price_order.npy`, `sorted_prices.npy`, `sorted_levels.npy`, `sorted_brands.npy`).
+- The product columns: numeric columns as typed arrays, text columns as int32 codes into a deduplicated string
+  table (`strings.npy`, the UTF-8 bytes of all strings, and `string_offsets.npy`).
+- `meta.json`: format version, row count, column names and kinds, and the brand vocabulary.
+
+Loading maps the files read-only (`np.load(mmap_mode='r')`) instead of parsing them, so startup costs a few
+milliseconds whatever the catalogue size, and worker processes share the same page-cache pages. Product records
+are decoded from the columns only when a laptop is recommended (`ColumnarRecords`).
+
+The catalogue path is a symbolic link to the current version of the directory (a hidden sibling,
+`.updated_laptop.npcat.v<time>-<pid>`), and a new catalogue is published by atomically replacing the link, so readers
+see either the old or the new catalogue, never a missing or partly written one. A reader resolves the link once and
+reads all files from that version; the previous version is kept until the next replacement, and a reader that
+still loses its version retries with the current one. The CSV remains the
+interchange format: `create_laptop_feature.py --binary` writes both, and `export_csv()` converts back.
+
+Key Functionality:
+- `binary_path()`: The binary catalogue that belongs to a CSV path.
+- `write_binary_catalogue()`: Writes a `LaptopCatalogue` in the binary format.
+- `read_binary_catalogue()`: Memory-maps a binary catalogue as a `LaptopCatalogue`.
+- `export_csv()`: Writes a binary catalogue back to the CSV format of `updated_laptop.csv`.
+
+Usage (from the `app` directory):
+    `python -m shopassist.services.catalogue_store data/updated_laptop.csv`
+    `python -m shopassist.services.catalogue_store data/updated_laptop.npcat --export-csv exported.csv`
+"""
+
+
+import os
+import json
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from shopassist.services.catalogue import LaptopCatalogue
+from shopassist.utils.features import FEATURE_KEYS, LEVELS
+
+
+BINARY_SUFFIX = '.npcat'
+FORMAT_NAME = 'shopassist-catalogue'
+FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+
+# Catalogue versions are stored next to the catalogue path as `.<name>.v<publication time in ns>-<pid>`
+VERSION_MARKER = '.v'
+
+# Arrays of `LaptopCatalogue` stored as they are
+INDEX_ARRAYS = ('prices', 'levels', 'price_order', 'sorted_prices', 'sorted_levels', 'sorted_brands')
+
+
+def binary_path(csv_path):
+    """
+    Returns the path of the binary catalogue belonging to a CSV file (`data/updated_laptop.csv` ->
+    `data/updated_laptop.npcat`).
+    """
+    return os.path.splitext(csv_path)[0] + BINARY_SUFFIX
+
+
+def _column_kind(values):
+    """
+    Chooses how a product column is stored: 'int' (all integers), 'float' (numbers, with missing values as NaN)
+    or 'str' (anything else; missing values are kept as missing).
+    """
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, (int, np.integer)) and not isinstance(value, bool) for value in values):
+        return 'int'
+    if present and all(isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool)
+                       for value in present):
+        return 'float'
+    return 'str'
+
+
+def _string_table(strings):
+    """
+    Encodes strings as one UTF-8 byte array and the offsets of each string in it.
+    """
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded], dtype=np.int64)
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _replace_directory(temp_directory, directory):
+    """
+    Publishes a fully written directory as the new version of the catalogue.
+
+    `directory` is a symbolic link to the current version (a hidden sibling directory named after the time it was
+    published), so replacing the link is a single atomic rename: the path always resolves to a complete catalogue.
+    The previous version is kept, for readers that resolved the link just before it was replaced; older ones are
+    removed. Processes that already mapped the files of a removed version keep reading them.
+    """
+    parent, name = os.path.split(os.path.abspath(directory))
+    prefix = '.' + name + VERSION_MARKER
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(temp_directory, 0o777 & ~umask)
+    version = '{0}{1:020d}-{2}'.format(prefix, time.time_ns(), os.getpid())
+    os.rename(temp_directory, os.path.join(parent, version))
+
+    if os.path.islink(directory):
+        previous = os.path.basename(os.readlink(directory))
+    elif os.path.isdir(directory):
+        # A catalogue written before versions were used becomes the previous version
+        previous = '{0}{1:020d}-legacy'.format(prefix, 0)
+        os.rename(directory, os.path.join(parent, previous))
+    else:
+        previous = None
+
+    link = os.path.join(parent, '.' + name + '.link.' + version[len(prefix):])
+    os.symlink(version, link)
+    try:
+        os.replace(link, directory)
+    except BaseException:
+        os.remove(link)
+        raise
+
+    # Versions are named in publication order; only those older than the previous one are removed
+    oldest_kept = min(previous or version, version)
+    for entry in os.listdir(parent):
+        if entry.startswith(prefix) and entry < oldest_kept:
+            shutil.rmtree(os.path.join(parent, entry), ignore_errors=True)
+
+
+def write_binary_catalogue(catalogue, directory):
+    """
+    Writes a catalogue in the binary format, replacing the directory as a whole.
+
+    Args:
+        catalogue (LaptopCatalogue): The catalogue (e.g. `LaptopCatalogue.from_csv('data/updated_laptop.csv')`).
+        directory (str): The output directory, conventionally `binary_path(csv_path)`.
+
+    Returns:
+        str: The directory.
+    """
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    temp_directory = tempfile.mkdtemp(prefix='.' + os.path.basename(directory) + '.tmp.', dir=parent)
+    try:
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(temp_directory, name + '.npy'), np.ascontiguousarray(getattr(catalogue, name)))
+
+        strings, string_codes, columns = [], {}, []
+        for index, column in enumerate(catalogue.columns):
+            if column == 'Price':
+                columns.append({'name': column, 'kind': 'price'})
+                continue
+            values = [record.get(column) for record in catalogue.records]
+            kind = _column_kind(values)
+            if kind == 'int':
+                data = np.asarray(values, dtype=np.int64)
+            elif kind == 'float':
+                data = np.asarray([np.nan if value is None else value for value in values], dtype=np.float64)
+            else:
+                data = np.empty(len(values), dtype=np.int32)
+                for row, value in enumerate(values):
+                    if value is None:
+                        data[row] = -1
+                        continue
+                    value = str(value)
+                    if value not in string_codes:
+                        string_codes[value] = len(strings)
+                        strings.append(value)
+                    data[row] = string_codes[value]
+            np.save(os.path.join(temp_directory, 'column_{0}.npy'.format(index)), data)
+            columns.append({'name': column, 'kind': kind})
+
+        blob, offsets = _string_table(strings)
+        np.save(os.path.join(temp_directory, 'strings.npy'), blob)
+        np.save(os.path.join(temp_directory, 'string_offsets.npy'), offsets)
+
+        meta = {'format': FORMAT_NAME, 'version': FORMAT_VERSION, 'rows': len(catalogue),
+                'feature_keys': list(FEATURE_KEYS), 'levels': list(LEVELS),
+                'columns': columns, 'brands': list(catalogue.brands), 'strings': len(strings)}
+        # `meta.json` is written last; a directory without it is incomplete
+        with open(os.path.join(temp_directory, META_FILE), 'w') as file:
+            json.dump(meta, file, indent=1)
+            file.flush()
+            os.fsync(file.fileno())
+
+        _replace_directory(temp_directory, directory)
+    except BaseException:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        raise
+    return directory
+
+
+class ColumnarRecords:
+    """
+    The product records of a binary catalogue, decoded from the column arrays on access.
+
+    Behaves like the `records` list of a CSV-loaded catalogue: `records[row]` is a dict of the product columns.
+    """
+
+    def __init__(self, columns, arrays, prices, strings, offsets):
+        """
+        Args:
+            columns (list[dict]): Name and kind of every column (`meta.json`).
+            arrays (list[np.ndarray]): The array of every column (`None` for `Price`).
+            prices (np.ndarray): The prices.
+            strings (np.ndarray): UTF-8 bytes of the string table.
+            offsets (np.ndarray): Start of every string in `strings`, plus the end of the last one.
+        """
+        self._columns = [(column['name'], column['kind'], array) for column, array in zip(columns, arrays)]
+        self._prices = prices
+        self._strings = strings
+        self._offsets = offsets
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self._prices)
+
+    def _string(self, code):
+        value = self._decoded.get(code)
+        if value is None:
+            value = self._strings[self._offsets[code]:self._offsets[code + 1]].tobytes().decode('utf-8')
+            self._decoded[code] = value
+        return value
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[index] for index in range(*row.indices(len(self)))]
+        record = {}
+        for name, kind, array in self._columns:
+            if kind == 'price':
+                record[name] = int(self._prices[row])
+            elif kind == 'int':
+                record[name] = int(array[row])
+            elif kind == 'float':
+                value = float(array[row])
+                record[name] = None if math.isnan(value) else value
+            else:
+                code = int(array[row])
+                record[name] = None if code < 0 else self._string(code)
+        return record
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def value_counts(self, name):
+        """
+        Counts the values of a column without decoding the records.
+
+        Returns:
+            dict: The number of laptops with each value (`None` for missing values).
+        """
+        for column, kind, array in self._columns:
+            if column != name:
+                continue
+            if kind == 'price':
+                array = self._prices
+            values, counts = np.unique(np.asarray(array), return_counts=True)
+            if kind == 'str':
+                return {None if code < 0 else self._string(int(code)): int(count)
+                        for code, count in zip(values.tolist(), counts.tolist())}
+            if kind == 'float':
+                return {None if math.isnan(value) else value: int(count)
+                        for value, count in zip(values.tolist(), counts.tolist())}
+            return dict(zip(values.tolist(), counts.tolist()))
+        return {None: len(self)}
+
+
+def read_binary_catalogue(directory, mmap=True):
+    """
+    Loads a binary catalogue.
+
+    Args:
+        directory (str): The catalogue directory.
+        mmap (bool): Memory-map the arrays read-only (the default) instead of reading them into memory.
+
+    Returns:
+        LaptopCatalogue: The catalogue.
+    """
+    try:
+        return _read_version(os.path.realpath(directory), mmap)
+    except FileNotFoundError:
+        # The version the link pointed to was removed while it was being read: read the current one
+        return _read_version(os.path.realpath(directory), mmap)
+
+
+def _read_version(directory, mmap):
+    """
+    Loads the files of one version of a binary catalogue.
+    """
+    with open(os.path.join(directory, META_FILE)) as file:
+        meta = json.load(file)
+    if meta.get('format') != FORMAT_NAME or meta.get('version') != FORMAT_VERSION:
+        raise ValueError("{0} is not a version {1} ShopAssist catalogue".format(directory, FORMAT_VERSION))
+    if tuple(meta['feature_keys']) != FEATURE_KEYS or tuple(meta['levels']) != LEVELS:
+        raise ValueError("{0} was written for different features or levels".format(directory))
+
+    mmap_mode = 'r' if mmap else None
+
+    def load(name):
+        return np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+
+    arrays = {name: load(name) for name in INDEX_ARRAYS}
+    columns = meta['columns']
+    column_arrays = [None if column['kind'] == 'price' else load('column_{0}'.format(index))
+                     for index, column in enumerate(columns)]
+    records = ColumnarRecords(columns, column_arrays, arrays['prices'], load('strings'), load('string_offsets'))
+
+    return LaptopCatalogue.from_arrays([column['name'] for column in columns], records, brands=meta['brands'],
+                                       **arrays)
+
+
+def export_csv(directory, path):
+    """
+    Writes a binary catalogue in the CSV format of `updated_laptop.csv` (with the `laptop_feature` column).
+
+    Returns:
+        str: The CSV path.
+    """
+    import pandas as pd
+
+    catalogue = read_binary_catalogue(directory)
+    laptop_df = pd.DataFrame(list(catalogue.records), columns=catalogue.columns)
+    laptop_df['Price'] = ['{0:,}'.format(price) for price in catalogue.prices.tolist()]
+    laptop_df['laptop_feature'] = [str({key: LEVELS[level] for key, level in zip(FEATURE_KEYS, row) if level >= 0})
+                                   for row in np.asarray(catalogue.levels).T.tolist()]
+    laptop_df.to_csv(path, index=False)
+    return path
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Convert between updated_laptop.csv and the binary catalogue.")
+    parser.add_argument('source', help="an enriched CSV to convert, or a binary catalogue directory to export")
+    parser.add_argument('--output', default=None,
+                        help="output path (default: the binary catalogue next to the CSV)")
+    parser.add_argument('--export-csv', default=None,
+                        help="write the binary catalogue SOURCE to this CSV file")
+    args = parser.parse_args()
+
+    if args.export_csv:
+        print("Exported {0}".format(export_csv(args.source, args.export_csv)))
+    else:
+        from shopassist.services.stage2 import parse_stored_features
+        output = args.output or binary_path(args.source)
+        write_binary_catalogue(LaptopCatalogue.from_csv(args.source, feature_parser=parse_stored_features), output)
+        print("Wrote {0}".format(output))
@@ -1,20 +1,34 @@
 """
 create_laptop_feature.py
 
-This module processes the laptop dataset by extracting and mapping key product features 
-from the `Description` column and appending them as a new column `laptop_feature` in the dataset. 
+This module processes the laptop dataset by extracting and mapping key product features
+from the `Description` column and appending them as a new column `laptop_feature` in the dataset.
 It prepares the dataset for further steps in the pipeline, such as product comparison and recommendations.
 
 Key Functionality:
 - Reads the raw laptop dataset from a CSV file (`laptop_data.csv`).
-- Extracts features such as GPU Intensity, Display Quality, Portability, Multitasking, 
+- Extracts features such as GPU Intensity, Display Quality, Portability, Multitasking,
   Processing Speed, and Budget using the `product_map_layer` helper function.
+- Classifies features directly from the structured columns (CPU, RAM, weight, GPU, display) with the rules in
+  `spec_rules`; the LLM is only consulted for laptops with features the rules cannot decide.
+- Runs the extraction concurrently on a bounded pool of worker threads, with an optional rate limit.
+- Checkpoints every finished row to disk, so an interrupted run resumes where it stopped.
+- Caches every classification by description, prompt version and model, so re-enriching a catalogue only
+  calls the LLM for descriptions it has not seen before.
 - Creates a new column, `laptop_feature`, containing these extracted features as Python dictionaries.
 - Saves the processed dataset to a new CSV file (`updated_laptop.csv`) for use in later stages of the pipeline.
+  The file is replaced atomically, so readers never see a partially written dataset.
+- Refreshes an existing dataset incrementally (`refresh_laptop_feature_col`): only new or changed laptops are
+  enriched and delisted ones are dropped.
+- Optionally writes the binary catalogue (`updated_laptop.npcat`) next to the CSV, which Stage 2 memory-maps
+  instead of parsing the CSV (see `shopassist.services.catalogue_store`).
 
 Files:
 - Input: `data/laptop_data.csv` - The raw dataset with laptop descriptions.
 - Output: `data/updated_laptop.csv` - The updated dataset with the `laptop_feature` column.
+- Output (`--binary`): `data/updated_laptop.npcat` - The same catalogue in the binary format.
+- Checkpoint: `data/laptop_feature_checkpoint.jsonl` - Rows finished so far; removed once the output is written.
+- Cache: `data/product_map_cache.sqlite` - Persistent `product_map_layer` results shared by all runs.
 
 Dependencies:
 - pandas: Used for reading, manipulating, and saving datasets.
@@ -24,30 +38,471 @@ Usage:
 Run this script once to process the dataset:
     `python create_laptop_feature.py`
 
+Concurrency and rate limit can be tuned from the command line:
+    `python create_laptop_feature.py --workers 16 --rate-limit 20`
+
+To compare the rules with the LLM's classifications in an existing `updated_laptop.csv`:
+    `python create_laptop_feature.py --agreement-report`
+
+To refresh an existing `updated_laptop.csv` after the raw catalogue changed, enriching only new or changed laptops:
+    `python create_laptop_feature.py --refresh`
+
+To also write the binary catalogue loaded by Stage 2:
+    `python create_laptop_feature.py --refresh --binary`
+
+To run the enrichment offline against the local stub backend (e.g. to measure throughput), with 0.5 s per call:
+    `python create_laptop_feature.py --backend stub --stub-latency 0.5 --no-cache`
+
 The updated dataset will be saved and ready for use in subsequent stages of the ShopAssist pipeline.
 """
 
 
 import os
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import itertools
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import pandas as pd
-from shopassist.utils.helper import product_map_layer
+from shopassist.services.stage1 import get_api_usage
+from shopassist.services.backend import BACKENDS, create_backend, set_backend
+from shopassist.services.catalogue import LaptopCatalogue
+from shopassist.services.catalogue_store import binary_path, write_binary_catalogue
+from shopassist.services.stage2 import parse_stored_features
+from shopassist.utils.cache import FeatureCache, DEFAULT_MAX_ENTRIES
+from shopassist.utils.features import FEATURE_KEYS, normalise_features
+from shopassist.utils.helper import product_map_layer, product_map_cache_key
+from shopassist.utils.spec_rules import rule_based_features, agreement_report
 
 
 DATA_PATH = os.path.join('data', 'laptop_data.csv')
 UPDATED_DATA_PATH = os.path.join('data', 'updated_laptop.csv')
+CHECKPOINT_PATH = os.path.join('data', 'laptop_feature_checkpoint.jsonl')
+CACHE_PATH = os.path.join('data', 'product_map_cache.sqlite')
+
+DEFAULT_WORKERS = 8
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter that spaces calls evenly so that at most `rate` calls start per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        Blocks until the caller's slot is due.
+        """
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def description_fingerprint(description):
+    """
+    Returns a short, stable fingerprint of a laptop description.
+    """
+    return hashlib.sha1(str(description).encode('utf-8')).hexdigest()
+
+
+def load_checkpoint(checkpoint_path, descriptions):
+    """
+    Reads the rows finished by an earlier run.
+
+    Rows are only reused if their description is unchanged, so a checkpoint written for a different
+    dataset is ignored rather than misapplied.
+
+    Args:
+        checkpoint_path (str): Path of the JSON-lines checkpoint file.
+        descriptions (list[str]): The descriptions of the current dataset.
+
+    Returns:
+        dict: Row index to extracted features for every reusable row.
+    """
+    finished = {}
+    if not os.path.exists(checkpoint_path):
+        return finished
+
+    with open(checkpoint_path, 'r') as checkpoint:
+        for line in checkpoint:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # Skipping a line cut short by a crash
+            row = entry.get('row')
+            if isinstance(row, int) and 0 <= row < len(descriptions) \
+                    and entry.get('fingerprint') == description_fingerprint(descriptions[row]):
+                finished[row] = entry['laptop_feature']
+
+    return finished
+
+
+def enrich_descriptions(descriptions, workers=DEFAULT_WORKERS, rate_limit=None,
+                        checkpoint_path=CHECKPOINT_PATH, cache=None, progress_every=50, accept=None):
+    """
+    Runs `product_map_layer` over many descriptions concurrently and checkpoints every finished row.
+
+    At most twice `workers` rows are queued at a time, and on an interruption (Ctrl-C or an unexpected error) the
+    queued rows are cancelled, so no LLM calls are made whose results would not reach the checkpoint.
+
+    Args:
+        descriptions (list[str]): The laptop descriptions to classify.
+        workers (int): Maximum number of concurrent OpenAI calls.
+        rate_limit (float, optional): Maximum number of calls started per second. Unlimited if `None`.
+        checkpoint_path (str): JSON-lines file that receives one line per finished row.
+        cache (FeatureCache, optional): Persistent cache consulted before every LLM call.
+        progress_every (int): Print progress and throughput after this many finished rows.
+        accept (callable, optional): Called with a row and its extracted features; a row it rejects (e.g. an
+                                     answer missing features) counts as failed, is not checkpointed and its cached
+                                     answer is dropped, so a re-run asks the LLM again. Rows resumed from the
+                                     checkpoint are checked too.
+
+    Returns:
+        tuple[list, dict]:
+            - The extracted features, aligned with `descriptions` (`None` for rows that failed).
+            - Run statistics: rows done/failed/resumed, elapsed seconds, rows per second, tokens, retries
+              and, with a cache, its hit/miss counters.
+    """
+    descriptions = list(descriptions)
+
+    def reject(row):
+        if cache is not None:
+            cache.delete(product_map_cache_key(descriptions[row]))
+
+    finished = load_checkpoint(checkpoint_path, descriptions)
+    if accept is not None:
+        for row in [row for row, laptop_feature in finished.items() if not accept(row, laptop_feature)]:
+            del finished[row]
+            reject(row)
+    pending = [row for row in range(len(descriptions)) if row not in finished]
+    limiter = RateLimiter(rate_limit) if rate_limit else None
+
+    def classify(row):
+        description = descriptions[row]
+        # Only calls that will reach the LLM count against the rate limit
+        if limiter is not None and (cache is None or product_map_cache_key(description) not in cache):
+            limiter.wait()
+        return product_map_layer(description, cache=cache)
+
+    stats = {'rows': len(descriptions), 'resumed': len(finished), 'done': 0, 'failed': 0}
+    usage_start = get_api_usage()
+    start = time.monotonic()
+
+    def report():
+        usage = get_api_usage()
+        elapsed = time.monotonic() - start
+        stats['elapsed_s'] = round(elapsed, 2)
+        stats['rows_per_s'] = round(stats['done'] / elapsed, 2) if elapsed > 0 else 0.0
+        stats['tokens'] = (usage['prompt_tokens'] + usage['completion_tokens']
+                           - usage_start['prompt_tokens'] - usage_start['completion_tokens'])
+        stats['retries'] = usage['retries'] - usage_start['retries']
+        message = "Enriched {0}/{1} rows ({2} resumed, {3} failed) - {4} rows/s, {5} tokens, {6} retries".format(
+            stats['resumed'] + stats['done'], stats['rows'], stats['resumed'], stats['failed'],
+            stats['rows_per_s'], stats['tokens'], stats['retries'])
+        if cache is not None:
+            stats['cache'] = cache.stats()
+            message += ", cache {0} hits / {1} misses".format(stats['cache']['hits'], stats['cache']['misses'])
+        print(message)
+
+    window = 2 * max(1, workers)
+    rows = iter(pending)
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        with open(checkpoint_path, 'a') as checkpoint:
+            futures = {}
+            while True:
+                for row in itertools.islice(rows, window - len(futures)):
+                    futures[pool.submit(classify, row)] = row
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    row = futures.pop(future)
+                    try:
+                        laptop_feature = future.result()
+                    except Exception as error:
+                        stats['failed'] += 1
+                        print("Row {0} failed: {1!r}".format(row, error))
+                        continue
+                    if accept is not None and not accept(row, laptop_feature):
+                        stats['failed'] += 1
+                        reject(row)
+                        print("Row {0} failed: unusable answer {1!r}".format(row, laptop_feature))
+                        continue
+
+                    finished[row] = laptop_feature
+                    checkpoint.write(json.dumps({'row': row,
+                                                 'fingerprint': description_fingerprint(descriptions[row]),
+                                                 'laptop_feature': laptop_feature}) + '\n')
+                    checkpoint.flush()
+
+                    stats['done'] += 1
+                    if stats['done'] % progress_every == 0:
+                        report()
+    finally:
+        # Rows still queued are dropped; calls already running finish in the background
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    if stats['done'] % progress_every or not stats['done']:
+        report()
+    return [finished.get(row) for row in range(len(descriptions))], stats
+
+
+def write_csv_atomic(laptop_df, path):
+    """
+    Writes a DataFrame to CSV so that readers only ever see the old or the new file, never a partial one.
 
-def add_laptop_feature_col():
+    The data is written to a temporary file in the same directory, flushed to disk and then renamed over `path`.
+    The new file keeps the permissions of the file it replaces (or gets the default ones for a new file), rather than
+    the owner-only mode of the temporary file, so servers running as another user can still read it.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    descriptor, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=directory)
+    try:
+        with os.fdopen(descriptor, 'w', newline='') as temp_file:
+            laptop_df.to_csv(temp_file, index=False, header = True)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def write_binary(path):
+    """
+    Writes the binary catalogue of an enriched CSV next to it (`updated_laptop.npcat`).
+
+    The catalogue is read back from the CSV just written, so both files hold exactly the same data.
+    """
+    catalogue = LaptopCatalogue.from_csv(path, feature_parser=parse_stored_features)
+    directory = write_binary_catalogue(catalogue, binary_path(path))
+    print("Wrote the binary catalogue of {0} laptops to {1}".format(len(catalogue), directory))
+    return directory
+
+
+def _enrich(laptop_df, workers, rate_limit, checkpoint_path, cache_path, cache_max_entries, use_rules=True):
+    """
+    Builds the `laptop_feature` value of every laptop in `laptop_df`.
+
+    Features decided by the rules in `spec_rules` are taken from the structured columns. Only laptops with at least
+    one undecided feature are sent through `product_map_layer` (with an optional persistent cache), and the LLM's
+    answer only fills the features the rules left open. An answer that leaves any of those features open (prose,
+    misspelled keys) counts as a failure, so no partial dictionary is written. Fails if any of those laptops could
+    not be enriched.
+    """
+    laptops = laptop_df.to_dict(orient='records')
+    if use_rules:
+        rule_features = [rule_based_features(laptop) for laptop in laptops]
+    else:
+        rule_features = [dict.fromkeys(FEATURE_KEYS) for laptop in laptops]
+
+    undecided = [row for row, features in enumerate(rule_features) if None in features.values()]
+    if use_rules:
+        print("Rules classified {0} of {1} laptops; {2} need the LLM".format(
+            len(laptops) - len(undecided), len(laptops), len(undecided)))
+
+    laptop_features = [dict(features) for features in rule_features]
+    if not undecided:
+        return laptop_features
+
+    def complete(index, llm_feature):
+        features = normalise_features(llm_feature)
+        return all(level is not None or key in features for key, level in rule_features[undecided[index]].items())
+
+    cache = FeatureCache(cache_path, max_entries=cache_max_entries) if cache_path else None
+    try:
+        llm_features, stats = enrich_descriptions([laptops[row]['Description'] for row in undecided],
+                                                  workers=workers,
+                                                  rate_limit=rate_limit,
+                                                  checkpoint_path=checkpoint_path,
+                                                  cache=cache,
+                                                  accept=complete)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    if stats['failed']:
+        raise RuntimeError("{0} rows could not be enriched; re-run to resume from {1}".format(
+            stats['failed'], checkpoint_path))
+
+    compared = agreed = 0
+    for row, llm_feature in zip(undecided, llm_features):
+        if not use_rules:
+            laptop_features[row] = llm_feature
+            continue
+        llm_feature = normalise_features(llm_feature)
+        for key, level in rule_features[row].items():
+            if level is not None and key in llm_feature:
+                compared += 1
+                agreed += level == llm_feature[key]
+        merged = {key: rule_features[row][key] or llm_feature.get(key) for key in FEATURE_KEYS}
+        laptop_features[row] = {key: level for key, level in merged.items() if level is not None}
+
+    if compared:
+        print("The LLM agreed with the rules on {0} of {1} features they both classified".format(agreed, compared))
+
+    return laptop_features
+
+
+def add_laptop_feature_col(workers=DEFAULT_WORKERS, rate_limit=None, checkpoint_path=CHECKPOINT_PATH,
+                           cache_path=CACHE_PATH, cache_max_entries=DEFAULT_MAX_ENTRIES, use_rules=True, binary=False):
 
     laptop_df= pd.read_csv(DATA_PATH)
 
     ## Create a new column "laptop_feature" that contains the dictionary of the product features
-    laptop_df['laptop_feature'] = laptop_df['Description'].apply(lambda x: product_map_layer(x))
+    laptop_df['laptop_feature'] = _enrich(laptop_df, workers, rate_limit, checkpoint_path,
+                                          cache_path, cache_max_entries, use_rules)
 
-    laptop_df.to_csv(UPDATED_DATA_PATH, index=False, header = True)
+    write_csv_atomic(laptop_df, UPDATED_DATA_PATH)
+    if binary:
+        write_binary(UPDATED_DATA_PATH)
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
 
     return True
 
 
+def catalogue_keys(laptop_df):
+    """
+    Returns the stable key of every laptop: its brand and model name.
+    """
+    return (laptop_df['Brand'].astype(str).str.strip() + '|' + laptop_df['Model Name'].astype(str).str.strip()).tolist()
+
+
+def refresh_laptop_feature_col(raw_path=DATA_PATH, enriched_path=UPDATED_DATA_PATH, workers=DEFAULT_WORKERS,
+                               rate_limit=None, checkpoint_path=CHECKPOINT_PATH, cache_path=CACHE_PATH,
+                               cache_max_entries=DEFAULT_MAX_ENTRIES, use_rules=True, binary=False):
+    """
+    Incrementally refreshes the enriched dataset from a new raw catalogue.
+
+    Laptops are matched by their stable key (brand + model name) and a fingerprint of their description:
+    - Unchanged laptops keep their existing `laptop_feature`, while picking up new prices and other columns.
+    - New laptops, and laptops whose description changed, are sent through `product_map_layer`.
+    - Laptops missing from the raw catalogue (delisted) are dropped.
+    The result is written atomically, so a running recommender never reads a half-written file.
+
+    Args:
+        raw_path (str): The new raw catalogue (columns of `laptop_data.csv`).
+        enriched_path (str): The enriched catalogue to refresh (`updated_laptop.csv`). Built from scratch if missing.
+        workers, rate_limit, checkpoint_path, cache_path, cache_max_entries, use_rules: See `add_laptop_feature_col`.
+        binary (bool): Also write the binary catalogue next to `enriched_path`.
+
+    Returns:
+        dict: Number of `unchanged`, `changed`, `new` and `delisted` laptops.
+    """
+    raw_df = pd.read_csv(raw_path)
+    enriched_df = pd.read_csv(enriched_path) if os.path.exists(enriched_path) else raw_df.iloc[0:0].assign(laptop_feature=[])
+
+    # Existing features by (key, description fingerprint); a list because a model can be listed more than once
+    previous = {}
+    previous_keys = set()
+    for key, description, laptop_feature in zip(catalogue_keys(enriched_df), enriched_df['Description'],
+                                                enriched_df['laptop_feature']):
+        previous.setdefault((key, description_fingerprint(description)), []).append(laptop_feature)
+        previous_keys.add(key)
+
+    raw_keys = catalogue_keys(raw_df)
+    laptop_features = []
+    to_enrich = []
+    summary = {'unchanged': 0, 'changed': 0, 'new': 0, 'delisted': 0}
+    for row, (key, description) in enumerate(zip(raw_keys, raw_df['Description'])):
+        matches = previous.get((key, description_fingerprint(description)))
+        if matches:
+            laptop_features.append(matches.pop(0))
+            summary['unchanged'] += 1
+        else:
+            laptop_features.append(None)
+            to_enrich.append(row)
+            summary['changed' if key in previous_keys else 'new'] += 1
+
+    # Old rows whose laptop is no longer in the raw catalogue
+    listed = set(raw_keys)
+    summary['delisted'] = sum(key not in listed for key in catalogue_keys(enriched_df))
+    print("Refreshing catalogue: {unchanged} unchanged, {changed} changed, {new} new, {delisted} delisted".format(**summary))
+
+    if to_enrich:
+        enriched = _enrich(raw_df.iloc[to_enrich], workers, rate_limit, checkpoint_path,
+                           cache_path, cache_max_entries, use_rules)
+        for row, laptop_feature in zip(to_enrich, enriched):
+            laptop_features[row] = laptop_feature
+
+    raw_df['laptop_feature'] = laptop_features
+
+    write_csv_atomic(raw_df, enriched_path)
+    if binary:
+        write_binary(enriched_path)
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return summary
+
+
 if __name__ == "__main__":
 
-    add_laptop_feature_col()
+    parser = argparse.ArgumentParser(description="Add the laptop_feature column to the laptop dataset.")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="maximum number of concurrent OpenAI calls")
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help="maximum number of OpenAI calls started per second")
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH,
+                        help="checkpoint file used to resume an interrupted run")
+    parser.add_argument('--cache', default=CACHE_PATH,
+                        help="persistent product_map_layer cache (SQLite file)")
+    parser.add_argument('--cache-max-entries', type=int, default=DEFAULT_MAX_ENTRIES,
+                        help="maximum number of cached results before least recently used ones are evicted")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="call the LLM for every row")
+    parser.add_argument('--refresh', action='store_true',
+                        help="only enrich new or changed laptops and drop delisted ones")
+    parser.add_argument('--no-rules', action='store_true',
+                        help="classify every laptop with the LLM instead of the rule-based fast path")
+    parser.add_argument('--agreement-report', action='store_true',
+                        help="compare the rules with the classifications in updated_laptop.csv "
+                             "(e.g. one built with --no-rules) and exit")
+    parser.add_argument('--binary', action='store_true',
+                        help="also write the binary catalogue (updated_laptop.npcat) loaded by stage 2")
+    parser.add_argument('--backend', choices=BACKENDS, default=None,
+                        help="LLM backend (default: $SHOPASSIST_LLM_BACKEND or openai)")
+    parser.add_argument('--stub-latency', type=float, default=None,
+                        help="simulated duration of each call of the stub backend, in seconds")
+    args = parser.parse_args()
+
+    if args.backend or args.stub_latency is not None:
+        backend_name = args.backend or 'stub'
+        backend_options = {'latency': args.stub_latency} if backend_name == 'stub' and args.stub_latency is not None else {}
+        set_backend(create_backend(backend_name, **backend_options))
+
+    options = dict(workers=args.workers,
+                   rate_limit=args.rate_limit,
+                   checkpoint_path=args.checkpoint,
+                   cache_path=None if args.no_cache else args.cache,
+                   cache_max_entries=args.cache_max_entries,
+                   use_rules=not args.no_rules,
+                   binary=args.binary)
+
+    if args.agreement_report:
+        print(json.dumps(agreement_report(pd.read_csv(UPDATED_DATA_PATH)), indent=2))
+    elif args.refresh:
+        refresh_laptop_feature_col(**options)
+    else:
+        add_laptop_feature_col(**options)
@@ -0,0 +1,676 @@
+"""
+dialogue.py
+===========
+
+This module implements an asynchronous dialogue engine that serves many concurrent ShopAssist conversations
+from a single process.
+
+It follows the same stage 1 -> 2 -> 3 flow as the `dialogue_mgmt_system` loop in `main.ipynb`, but every
+upstream call is awaited on a shared LLM backend (`shopassist.services.backend`), so hundreds of sessions can
+wait on the API at the same time instead of one blocking call after another.
+
+Key Components:
+- `SessionState`: The per-session state (`conversation`, `conversation_reco`, `top_3_laptops` and the extracted user profile).
+  `to_record()` / `from_record()` convert it to and from the compact record kept by `shopassist.services.session_store`.
+- `TurnResult`: The outcome of one user turn (reply text, stage, and whether the session was flagged or closed).
+- `DialogueEngine`: Async counterparts of the stage 1 functions, with concurrency bounded per upstream endpoint,
+  and `start_session()` / `handle_turn()` driving the conversation.
+
+Within a turn, independent calls run concurrently: the user-input moderation overlaps the assistant completion
+(which is cancelled if the input is flagged), and the output moderation overlaps intent confirmation.
+Across sessions, the moderation checks submitted within a few milliseconds of each other are sent as one batched
+call (`shopassist.services.moderation.ModerationBatcher`), and short texts seen before are answered from a cache.
+Intent confirmation and profile extraction are first attempted locally (`stage1.local_profile_confirmation`),
+so most turns only call the LLM for the assistant's reply. The stage 3 presentation is served from
+`stage3.PresentationCache` when the same laptops were already presented for an equivalent profile.
+
+Every upstream call has the deadline and circuit breaker of `shopassist.services.upstream`, and a whole turn is
+bounded by `turn_deadline`. A turn that runs out of time, or finds the upstream's circuit open, returns
+`UNAVAILABLE_MESSAGE` and leaves the session where it was, so the user can send the message again.
+
+With an `on_token` callback, `handle_turn()` streams the assistant's replies (the stage 1 answer and the stage 3
+presentation) to it as they are generated, moderating them in chunks (`shopassist.services.streaming`). Tokens are
+held back until the user's input has passed moderation. The time to the first token of each streamed step is
+returned in `TurnResult.timings` (`completion_first_token`, `presentation_first_token`).
+
+Usage:
+    engine = DialogueEngine()
+    state, introduction = await engine.start_session()
+    result = await engine.handle_turn(state, "I am a video editor")
+    result = await engine.handle_turn(state, "I travel a lot", on_token=lambda delta: print(delta, end=''))
+
+Run `python -m shopassist.services.dialogue` for an interactive console session
+(`--backend stub` runs it offline against `shopassist.services.stub_backend`).
+"""
+
+
+import asyncio
+import time
+import inspect
+import uuid
+import json
+import argparse
+from tenacity import AsyncRetrying
+from shopassist.services.stage1 import (initialize_conversation,
+                                        chat_completion_request,
+                                        chat_completion_output,
+                                        intent_confirmation_request,
+                                        dictionary_present_messages,
+                                        local_profile_confirmation,
+                                        _record_usage,
+                                        _record_retry)
+from shopassist.services.stage2 import (get_catalogue,
+                                        select_laptops_for_user,
+                                        recommendation_validation)
+from shopassist.services.stage3 import (initialize_conv_reco,
+                                        initialize_conv_followup,
+                                        spec_context_message,
+                                        answer_from_specs,
+                                        presentation_key,
+                                        get_presentation_cache)
+from shopassist.utils.history import ConversationHistory, DEFAULT_HISTORY_TOKENS
+from shopassist.services.backend import BACKENDS, create_backend, get_backend
+from shopassist.services.streaming import AsyncChatStream, DEFAULT_MODERATION_CHARS
+from shopassist.services.moderation import DEFAULT_BATCH_WINDOW, DEFAULT_MAX_BATCH, ModerationBatcher
+from shopassist.services.upstream import (UpstreamUnavailable,
+                                          call_deadline,
+                                          deadline,
+                                          retry_policy,
+                                          upstream_call)
+from shopassist.utils.tracing import traced
+
+
+FLAGGED_MESSAGE = "Sorry, this message has been flagged. Please restart your conversation."
+UNAVAILABLE_MESSAGE = "Sorry, I am taking too long to answer right now. Please send your message again in a moment."
+
+DEFAULT_CHAT_CONCURRENCY = 64
+DEFAULT_MODERATION_CONCURRENCY = 64
+
+# Upper bound of a whole turn (up to five upstream calls, each with its own deadline), in seconds
+DEFAULT_TURN_DEADLINE = 60.0
+
+# Streamed between the stage 1 answer and the stage 3 presentation when one turn produces both
+REPLY_SEPARATOR = '\n\n'
+
+STAGE_INTENT = 'intent'
+STAGE_RECOMMENDATION = 'recommendation'
+STAGE_CLOSED = 'closed'
+
+SESSION_RECORD_VERSION = 1
+
+
+async def _send(on_token, delta):
+    """
+    Passes a streamed text delta to an `on_token` callback, awaiting it if it returns an awaitable.
+    """
+    result = on_token(delta)
+    if inspect.isawaitable(result):
+        await result
+
+
+class SessionState:
+    """
+    The state of one shopper's conversation.
+
+    Attributes:
+        session_id (str): Unique id of the session.
+        conversation (ConversationHistory): Stage 1 messages (system prompt, user turns and assistant replies).
+        conversation_reco (ConversationHistory or None): Stage 3 messages, created once recommendations are available.
+        top_3_laptops (str or None): JSON records of the top laptops, as returned by `compare_laptops_with_user`.
+        recommended (list or None): `[sku, row, score]` of each of the top laptops (see `LaptopCatalogue.sku()`).
+        user_profile (dict or None): The six-key profile extracted at the end of stage 1.
+        closed (bool): Whether the session has ended (exit or flagged content).
+        history_tokens (int): Token budget of each history beyond its pinned prompt messages.
+    """
+
+    def __init__(self, session_id=None, history_tokens=DEFAULT_HISTORY_TOKENS):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.history_tokens = history_tokens
+        self.conversation = ConversationHistory(initialize_conversation(), token_budget=history_tokens)
+        self.conversation_reco = None
+        self.top_3_laptops = None
+        self.recommended = None
+        self.user_profile = None
+        self.closed = False
+
+    @property
+    def stage(self):
+        """
+        The current stage: 'intent' (stage 1), 'recommendation' (stage 3) or 'closed'.
+        """
+        if self.closed:
+            return STAGE_CLOSED
+        return STAGE_INTENT if self.top_3_laptops is None else STAGE_RECOMMENDATION
+
+    def to_record(self):
+        """
+        Returns the compact record of the session, made of JSON types only.
+
+        The record holds the stage, the confirmed profile, the ids of the recommended laptops instead of their
+        details, and the history of the current stage without its prompt messages, which `from_record()` rebuilds
+        (the partial profile and the user notes of its summary, and the verbatim tail of the conversation).
+        """
+        history = self.conversation if self.top_3_laptops is None else self.conversation_reco
+        return {'v': SESSION_RECORD_VERSION,
+                'id': self.session_id,
+                'stage': self.stage,
+                'history_tokens': self.history_tokens,
+                'profile': self.user_profile,
+                'laptops': self.recommended,
+                'history': None if self.closed else history.to_state()}
+
+    @classmethod
+    def from_record(cls, record, catalogue=None):
+        """
+        Rebuilds a session from `to_record()`.
+
+        Args:
+            record (dict): The record.
+            catalogue (LaptopCatalogue, optional): The catalogue the laptop ids are looked up in. Defaults to
+                                                   `stage2.get_catalogue()`. Laptops no longer in it are dropped.
+
+        Returns:
+            SessionState: The session, sending the same messages as the one that was saved.
+        """
+        if record.get('v') != SESSION_RECORD_VERSION:
+            raise ValueError("Unsupported session record version {0}".format(record.get('v')))
+        state = cls(record['id'], history_tokens=record['history_tokens'])
+        if record['stage'] == STAGE_CLOSED:
+            state.closed = True
+            return state
+        if record['stage'] == STAGE_INTENT:
+            state.conversation = ConversationHistory.from_state(initialize_conversation(), record['history'],
+                                                                token_budget=state.history_tokens)
+            return state
+
+        catalogue = catalogue if catalogue is not None else get_catalogue()
+        laptops = record['laptops']
+        rows = catalogue.find_skus([sku for sku, _, _ in laptops], [row for _, row, _ in laptops])
+        state.recommended = [[sku, row, score] for row, (sku, _, score) in zip(rows, laptops) if row is not None]
+        state.top_3_laptops = catalogue.to_json([row for _, row, _ in state.recommended],
+                                                [score for _, _, score in state.recommended])
+        state.user_profile = record['profile']
+        state.conversation_reco = ConversationHistory.from_state(
+            initialize_conv_followup(recommendation_validation(state.top_3_laptops), state.user_profile),
+            record['history'], token_budget=state.history_tokens)
+        return state
+
+
+def recommendation_prompt(validated_reco, user_profile):
+    """
+    Returns the messages that ask for the stage 3 presentation: the recommended laptops and the user profile.
+    """
+    conversation_reco = initialize_conv_reco(validated_reco)
+    conversation_reco.append({"role": "user", "content": "This is my user profile" + str(user_profile)})
+    return conversation_reco
+
+
+class TurnResult:
+    """
+    The outcome of one user turn.
+
+    Attributes:
+        reply (str): Text to show the user.
+        stage (str): The session's stage after the turn.
+        flagged (bool): Whether the turn was stopped by moderation.
+        closed (bool): Whether the session has ended.
+        timings (dict): Wall-clock seconds spent in each step of the turn, plus the `total`.
+                        Steps that ran concurrently overlap, so the critical path is the longest chain.
+    """
+
+    def __init__(self, reply, stage, flagged=False, closed=False, timings=None):
+        self.reply = reply
+        self.stage = stage
+        self.flagged = flagged
+        self.closed = closed
+        self.timings = timings if timings is not None else {}
+
+    def to_dict(self):
+        return {'reply': self.reply, 'stage': self.stage, 'flagged': self.flagged, 'closed': self.closed,
+                'timings': self.timings}
+
+
+class DialogueEngine:
+    """
+    Serves concurrent ShopAssist sessions on a shared LLM backend (by default, an `AsyncOpenAI` client).
+
+    Each upstream endpoint (chat completions and moderation) has its own concurrency limit, so a burst of
+    sessions queues inside the process instead of overwhelming the API. Moderation checks are batched across
+    sessions; `moderation_stats()` reports the batch sizes, queue waits and cache hits.
+    """
+
+    def __init__(self, backend=None, chat_concurrency=DEFAULT_CHAT_CONCURRENCY,
+                 moderation_concurrency=DEFAULT_MODERATION_CONCURRENCY, history_tokens=DEFAULT_HISTORY_TOKENS,
+                 moderation_chars=DEFAULT_MODERATION_CHARS, presentation_cache=None,
+                 turn_deadline=DEFAULT_TURN_DEADLINE, moderation_batch_window=DEFAULT_BATCH_WINDOW,
+                 moderation_max_batch=DEFAULT_MAX_BATCH):
+        """
+        Args:
+            backend (LLMBackend, optional): The backend to use. Defaults to `backend.get_backend()`.
+            chat_concurrency (int): Maximum number of concurrent chat completion calls.
+            moderation_concurrency (int): Maximum number of concurrent (batched) moderation calls.
+            history_tokens (int): Token budget of each session's conversation history (see `ConversationHistory`).
+            moderation_chars (int): Streamed replies are moderated every `moderation_chars` characters.
+            presentation_cache (PresentationCache, optional): Cache of stage 3 presentations. Defaults to
+                                                              `stage3.get_presentation_cache()`.
+            turn_deadline (float, optional): Maximum duration of a turn in seconds (`None`: only the per-call
+                                             deadlines apply).
+            moderation_batch_window (float): Seconds a moderation batch waits for the checks of other sessions.
+            moderation_max_batch (int): Maximum number of texts per moderation call (`1` disables batching).
+        """
+        self._backend = backend
+        self.history_tokens = history_tokens
+        self.moderation_chars = moderation_chars
+        self.presentation_cache = presentation_cache if presentation_cache is not None else get_presentation_cache()
+        self.turn_deadline = turn_deadline
+        self._limits = {'chat': chat_concurrency}
+        self._semaphores = {}
+        self._moderation = None
+        self._moderation_options = dict(window=moderation_batch_window, max_batch=moderation_max_batch,
+                                        concurrency=moderation_concurrency)
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = get_backend()
+        return self._backend
+
+    @property
+    def moderation(self):
+        """
+        The `ModerationBatcher` of the engine, created on first use.
+        """
+        if self._moderation is None:
+            self._moderation = ModerationBatcher(self.backend, **self._moderation_options)
+        return self._moderation
+
+    def moderation_stats(self):
+        """
+        Returns the metrics of the moderation batcher (see `ModerationBatcher.stats()`).
+        """
+        return self.moderation.stats()
+
+    def _semaphore(self, endpoint):
+        """
+        Returns the semaphore bounding concurrent calls to an upstream endpoint.
+        """
+        if endpoint not in self._semaphores:
+            self._semaphores[endpoint] = asyncio.Semaphore(self._limits[endpoint])
+        return self._semaphores[endpoint]
+
+    @traced('dialogue.get_chat_completions')
+    @call_deadline
+    async def get_chat_completions(self, input, json_format = False):
+        """
+        Async counterpart of `stage1.get_chat_completions`, with the same retry policy and deadline.
+        """
+        async for attempt in AsyncRetrying(before_sleep=_record_retry, **retry_policy(reraise=True)):
+            with attempt:
+                async with self._semaphore('chat'):
+                    with upstream_call('chat'):
+                        chat_completion = await self.backend.achat_completion(
+                            **chat_completion_request(input, json_format))
+        return chat_completion_output(chat_completion, json_format)
+
+    @call_deadline
+    async def stream_chat_completions(self, input):
+        """
+        Async counterpart of `stage1.stream_chat_completions`. Opening the stream is retried like
+        `get_chat_completions`; the chat concurrency limit applies to opening it.
+
+        Returns:
+            AsyncChatStream: `async for` yields the text deltas.
+        """
+        started = time.perf_counter()
+        async for attempt in AsyncRetrying(before_sleep=_record_retry, **retry_policy(reraise=True)):
+            with attempt:
+                async with self._semaphore('chat'):
+                    with upstream_call('chat'):
+                        chunks = await self.backend.achat_completion_stream(**chat_completion_request(input))
+
+        async def moderate(text):
+            return await self.moderation_check(text) == 'Flagged'
+        return AsyncChatStream(chunks, moderate, 'dialogue.stream_chat_completions',
+                               moderation_chars=self.moderation_chars, on_finish=_record_usage, started=started)
+
+    @traced('dialogue.moderation_check')
+    @call_deadline
+    async def moderation_check(self, user_input):
+        """
+        Async counterpart of `stage1.moderation_check`, batched with the checks of the other sessions.
+        """
+        return "Flagged" if await self.moderation.check(user_input) else "Not Flagged"
+
+    @traced('dialogue.intent_confirmation_layer')
+    @call_deadline
+    async def intent_confirmation_layer(self, response_assistant):
+        """
+        Async counterpart of `stage1.intent_confirmation_layer`.
+        """
+        async with self._semaphore('chat'):
+            with upstream_call('chat'):
+                response = await self.backend.achat_completion(**intent_confirmation_request(response_assistant))
+        _record_usage(response)
+        return json.loads(response.choices[0].message.content)
+
+    @traced('dialogue.dictionary_present')
+    async def dictionary_present(self, response):
+        """
+        Async counterpart of `stage1.dictionary_present`.
+        """
+        return await self.get_chat_completions(dictionary_present_messages(response), json_format = True)
+
+    async def start_session(self, session_id=None):
+        """
+        Creates a session and generates the assistant's introduction.
+
+        Returns:
+            tuple[SessionState, str]: The new session and the introduction to show the user.
+        """
+        state = SessionState(session_id, history_tokens=self.history_tokens)
+        introduction = await self.get_chat_completions(state.conversation.messages())
+        return state, introduction
+
+    def _close(self, state, reply, flagged=False, timings=None):
+        state.closed = True
+        return TurnResult(reply, state.stage, flagged=flagged, closed=True, timings=timings)
+
+    async def _timed(self, timings, name, awaitable):
+        """
+        Awaits `awaitable` and records its wall-clock duration in `timings[name]` (seconds).
+        """
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            timings[name] = round(time.perf_counter() - start, 4)
+
+    async def _moderated_completion(self, timings, user_input, messages):
+        """
+        Runs the moderation of `user_input` and the completion of `messages` at the same time.
+
+        The completion is cancelled as soon as moderation flags the input.
+
+        Returns:
+            str or None: The assistant's response, or `None` if the input was flagged.
+        """
+        moderation = asyncio.create_task(
+            self._timed(timings, 'input_moderation', self.moderation_check(user_input)))
+        completion = asyncio.create_task(
+            self._timed(timings, 'completion', self.get_chat_completions(messages)))
+        try:
+            flagged = await moderation == 'Flagged'
+        except BaseException:
+            completion.cancel()
+            raise
+
+        if flagged:
+            completion.cancel()
+            await asyncio.gather(completion, return_exceptions=True)
+            return None
+        return await completion
+
+    async def _streamed(self, timings, name, messages, on_token, gate=None):
+        """
+        Streams the completion of `messages` to `on_token`, recording `timings[name]` and the time to the first
+        token passed on (`timings[name + '_first_token']`).
+
+        Args:
+            gate (asyncio.Task, optional): The moderation of the user's input. Tokens are held back until it
+                                           passes; if it flags the input, the stream is closed.
+
+        Returns:
+            AsyncChatStream or None: The consumed stream, or `None` if the input was flagged.
+        """
+        start = time.perf_counter()
+        held = []
+
+        async def emit(delta):
+            if name + '_first_token' not in timings:
+                timings[name + '_first_token'] = round(time.perf_counter() - start, 4)
+            await _send(on_token, delta)
+
+        stream = None
+        deltas = None
+        try:
+            stream = await self.stream_chat_completions(messages)
+            deltas = stream.__aiter__()
+            async for delta in deltas:
+                if gate is not None:
+                    if not gate.done():
+                        held.append(delta)
+                        continue
+                    if await gate == 'Flagged':
+                        return None
+                    gate = None
+                    for previous in held:
+                        await emit(previous)
+                await emit(delta)
+
+            if gate is not None:
+                if await gate == 'Flagged':
+                    return None
+                for previous in held:
+                    await emit(previous)
+            return stream
+        finally:
+            if gate is not None and not gate.done():
+                gate.cancel()
+            if deltas is not None:
+                await deltas.aclose()
+            timings[name] = round(time.perf_counter() - start, 4)
+
+    async def _reply(self, timings, user_input, messages, on_token):
+        """
+        Gets the assistant's reply to `user_input`, moderating the input alongside the completion.
+
+        Returns:
+            tuple[str or None, str or None]: The reply (`None` if the input was flagged), and the moderation of
+            the reply if it was already moderated while streaming ('Flagged' / 'Not Flagged'), else `None`.
+        """
+        if on_token is None:
+            return await self._moderated_completion(timings, user_input, messages), None
+
+        gate = asyncio.create_task(self._timed(timings, 'input_moderation', self.moderation_check(user_input)))
+        stream = await self._streamed(timings, 'completion', messages, on_token, gate=gate)
+        if stream is None:
+            return None, None
+        return stream.text, 'Flagged' if stream.flagged else 'Not Flagged'
+
+    @traced('dialogue.handle_turn')
+    async def handle_turn(self, state, user_input, on_token=None):
+        """
+        Processes one user message, following one iteration of `dialogue_mgmt_system`.
+
+        Stage 1 asks follow-up questions until `intent_confirmation_layer` confirms the six-key profile.
+        The profile is then extracted, scored against the catalogue (stage 2) and presented (stage 3);
+        later turns are follow-up questions about the recommended laptops.
+
+        Independent calls overlap: the user-input moderation runs alongside the assistant completion (which is
+        cancelled if the input is flagged), and the output moderation runs alongside intent confirmation.
+        The duration of every step is returned in `TurnResult.timings`.
+
+        Args:
+            state (SessionState): The session to advance.
+            user_input (str): The user's message. 'exit' ends the session.
+            on_token (callable, optional): Streams the replies: called (or awaited, if it returns an awaitable)
+                                           with every text delta. A turn that completes stage 1 streams the stage 1
+                                           answer and then the stage 3 presentation. If moderation stops a stream,
+                                           the turn ends flagged and the partial text should be replaced.
+
+        Returns:
+            TurnResult: The reply, the session's new stage and per-stage timings. If the turn exceeded
+                        `turn_deadline` or an upstream circuit is open, the reply is `UNAVAILABLE_MESSAGE` and the
+                        session is unchanged.
+        """
+        if state.closed:
+            return TurnResult('', state.stage, closed=True)
+        if user_input == 'exit':
+            return self._close(state, '')
+
+        timings = {}
+        start = time.perf_counter()
+        try:
+            with deadline(self.turn_deadline):
+                if state.top_3_laptops is None:
+                    result = await self._intent_turn(state, user_input, timings, on_token)
+                else:
+                    result = await self._recommendation_turn(state, user_input, timings, on_token)
+        except UpstreamUnavailable:
+            result = TurnResult(UNAVAILABLE_MESSAGE, state.stage, timings=timings)
+        timings['total'] = round(time.perf_counter() - start, 4)
+        return result
+
+    async def _intent_turn(self, state, user_input, timings, on_token=None):
+        """
+        Stage 1: gather requirements until the profile is confirmed, then run stages 2 and 3.
+        """
+        user_message = {"role": "user", "content": user_input}
+
+        response_assistant, moderation = await self._reply(timings, user_input,
+                                                           state.conversation.messages() + [user_message], on_token)
+        if response_assistant is None or moderation == 'Flagged':
+            return self._close(state, FLAGGED_MESSAGE, flagged=True, timings=timings)
+
+        # The session is only changed once the turn succeeded, so a turn cut short can be sent again
+        confirmation, response = local_profile_confirmation(response_assistant)
+        if moderation is not None:
+            if confirmation is None:
+                confirmation = await self._timed(timings, 'intent_confirmation',
+                                                 self.intent_confirmation_layer(response_assistant))
+        elif confirmation is not None:
+            moderation = await self._timed(timings, 'output_moderation', self.moderation_check(response_assistant))
+        else:
+            moderation, confirmation = await asyncio.gather(
+                self._timed(timings, 'output_moderation', self.moderation_check(response_assistant)),
+                self._timed(timings, 'intent_confirmation', self.intent_confirmation_layer(response_assistant)))
+        if moderation == 'Flagged':
+            return self._close(state, FLAGGED_MESSAGE, flagged=True, timings=timings)
+
+        if "No" in confirmation.get('result'):
+            state.conversation.append(user_message)
+            state.conversation.append({"role": "assistant", "content": str(response_assistant)})
+            return TurnResult(str(response_assistant), state.stage, timings=timings)
+
+        if response is None:
+            response = await self._timed(timings, 'dictionary_extraction', self.dictionary_present(response_assistant))
+
+        # Stage 2 is CPU-only; a thread keeps a first catalogue load from blocking other sessions
+        catalogue, rows, scores = await self._timed(timings, 'scoring',
+                                                    asyncio.to_thread(select_laptops_for_user, response))
+        top_3_laptops = catalogue.to_json(rows, scores)
+        validated_reco = recommendation_validation(top_3_laptops)
+
+        conversation_reco = recommendation_prompt(validated_reco, response)
+
+        if on_token is not None:
+            await _send(on_token, REPLY_SEPARATOR)
+        cache_key = presentation_key(validated_reco, response)
+        recommendation = self.presentation_cache.get(cache_key)
+        if recommendation is not None:
+            if on_token is not None:
+                await _send(on_token, recommendation)
+        else:
+            if on_token is None:
+                recommendation = await self._timed(timings, 'presentation',
+                                                   self.get_chat_completions(conversation_reco))
+                moderation = await self._timed(timings, 'presentation_moderation',
+                                               self.moderation_check(recommendation))
+            else:
+                stream = await self._streamed(timings, 'presentation', conversation_reco, on_token)
+                recommendation, moderation = stream.text, 'Flagged' if stream.flagged else 'Not Flagged'
+            if moderation == 'Flagged':
+                return self._close(state, FLAGGED_MESSAGE, flagged=True, timings=timings)
+            self.presentation_cache.put(cache_key, str(recommendation))
+
+        # Follow-up questions only resend the names of the laptops; the details they need are retrieved per question
+        conversation_reco = ConversationHistory(initialize_conv_followup(validated_reco, response),
+                                                token_budget=state.history_tokens)
+        conversation_reco.append({"role": "assistant", "content": str(recommendation)})
+        state.conversation.append(user_message)
+        state.user_profile = response
+        state.top_3_laptops = top_3_laptops
+        state.recommended = [[catalogue.sku(row), row, score] for row, score in zip(rows.tolist(), scores.tolist())]
+        state.conversation_reco = conversation_reco
+
+        return TurnResult(str(recommendation), state.stage, timings=timings)
+
+    async def _recommendation_turn(self, state, user_input, timings, on_token=None):
+        """
+        Stage 3: answer follow-up questions about the recommended laptops.
+
+        Questions that only ask which laptop is the lightest, cheapest, etc. are answered from the catalogue
+        columns; the others are sent with the laptop details that match them.
+        """
+        user_message = {"role": "user", "content": user_input}
+        products = recommendation_validation(state.top_3_laptops)
+
+        answer = answer_from_specs(user_input, products)
+        if answer is not None:
+            moderation = await self._timed(timings, 'input_moderation', self.moderation_check(user_input))
+            if moderation == 'Flagged':
+                return self._close(state, FLAGGED_MESSAGE, flagged=True, timings=timings)
+            if on_token is not None:
+                await _send(on_token, answer)
+            state.conversation_reco.append(user_message)
+            state.conversation_reco.append({"role": "assistant", "content": answer})
+            return TurnResult(answer, state.stage, timings=timings)
+
+        context = await self._timed(timings, 'retrieval',
+                                    asyncio.to_thread(spec_context_message, user_input, products))
+        response_asst_reco, moderation = await self._reply(timings, user_input,
+                                                           state.conversation_reco.messages() + [context, user_message],
+                                                           on_token)
+        if response_asst_reco is None:
+            return self._close(state, FLAGGED_MESSAGE, flagged=True, timings=timings)
+
+        if moderation is None:
+            moderation = await self._timed(timings, 'output_moderation', self.moderation_check(response_asst_reco))
+        if moderation == 'Flagged':
+            return self._close(state, FLAGGED_MESSAGE, flagged=True, timings=timings)
+
+        state.conversation_reco.append(user_message)
+        state.conversation_reco.append({"role": "assistant", "content": response_asst_reco})
+        return TurnResult(response_asst_reco, state.stage, timings=timings)
+
+
+async def run_console(engine=None, stream=True):
+    """
+    Runs one interactive session in the terminal, like the `dialogue_mgmt_system` notebook cell.
+
+    Args:
+        engine (DialogueEngine, optional): The engine. Defaults to a new `DialogueEngine`.
+        stream (bool): Print the replies as they are generated.
+    """
+    engine = engine or DialogueEngine()
+    state, introduction = await engine.start_session()
+    print(introduction + '\n')
+
+    def on_token(delta):
+        print(delta, end='', flush=True)
+
+    while not state.closed:
+        user_input = await asyncio.to_thread(input, "")
+        if not stream:
+            result = await engine.handle_turn(state, user_input)
+            if result.reply:
+                print('\n' + result.reply + '\n')
+            continue
+
+        print()
+        result = await engine.handle_turn(state, user_input, on_token=on_token)
+        if result.flagged:
+            print('\n' + result.reply + '\n')
+        elif result.reply:
+            print('\n')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run an interactive ShopAssist session in the terminal.")
+    parser.add_argument('--backend', choices=BACKENDS, default=None,
+                        help="LLM backend (default: $SHOPASSIST_LLM_BACKEND or openai)")
+    parser.add_argument('--no-stream', action='store_true', help="Print each reply once it is complete")
+    args = parser.parse_args()
+
+    asyncio.run(run_console(DialogueEngine(backend=create_backend(args.backend)), stream=not args.no_stream))
@@ -0,0 +1,290 @@
+"""
+moderation.py
+=============
+
+Cross-session micro-batching and caching of moderation calls.
+
+Every turn of every session moderates the user's input and the assistant's reply, so under load moderation is the
+largest number of requests sent upstream. The moderation endpoint classifies a list of inputs in one request:
+`ModerationBatcher` collects the texts that concurrent sessions of an event loop submit within a short window
+(`window` seconds, or until `max_batch` texts are waiting), sends them as one call and hands every caller its own
+verdict. Identical texts in a batch are sent once.
+
+Short texts that recur verbatim ("yes", "exit", the streamed chunks of a cached presentation) are answered from an
+exact-match LRU, `ModerationCache`, without a call. There is one cache per backend (`get_moderation_cache()`), so a
+verdict is only reused for the backend that gave it; it is shared by the batchers of that backend and by
+`stage1.moderation_check`.
+
+A batch is one upstream call: it has its own deadline (`upstream.CALL_DEADLINE`) and goes through the moderation
+circuit breaker, and if it fails, every text of the batch fails with the same error. A caller whose own deadline
+passes first stops waiting with `DeadlineExceeded`.
+
+Key Components:
+- `ModerationCache`: The thread-safe LRU of verdicts by text.
+- `get_moderation_cache()`: The cache of a backend.
+- `ModerationBatcher`: The micro-batcher. `check()` returns whether a text is flagged; `stats()` reports the cache
+  hits, the batch sizes and the time texts waited in the queue. With tracing enabled, every batch records a
+  'moderation.batch' span (with its number of `inputs`) and every queued text a 'moderation.queue_wait' span.
+"""
+
+
+import time
+import asyncio
+import weakref
+import threading
+import contextvars
+import collections
+from shopassist.services.upstream import DeadlineExceeded, call_deadline, remaining_time, upstream_call
+from shopassist.utils.tracing import record_span
+
+
+DEFAULT_BATCH_WINDOW = 0.01
+DEFAULT_MAX_BATCH = 32
+DEFAULT_BATCH_CONCURRENCY = 16
+
+MODERATION_CACHE_MAX_ENTRIES = 4096
+
+# Only texts up to this many characters are cached
+MODERATION_CACHE_MAX_CHARS = 200
+
+# Number of recent queue waits kept for the percentiles of `stats()`
+QUEUE_WAIT_SAMPLES = 10000
+
+
+class ModerationCache:
+    """
+    An in-memory, thread-safe LRU of moderation verdicts, keyed by the exact text.
+
+    Attributes:
+        hits (int): Number of lookups answered from the cache.
+        misses (int): Number of lookups of cacheable texts that found nothing.
+    """
+
+    def __init__(self, max_entries=MODERATION_CACHE_MAX_ENTRIES, max_chars=MODERATION_CACHE_MAX_CHARS):
+        """
+        Args:
+            max_entries (int): Maximum number of verdicts kept. `0` disables the cache.
+            max_chars (int): Longer texts are neither looked up nor stored.
+        """
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def cacheable(self, text):
+        return self.max_entries > 0 and isinstance(text, str) and len(text) <= self.max_chars
+
+    def get(self, text):
+        """
+        Looks up the verdict of a text.
+
+        Returns:
+            bool or None: Whether the text was flagged, or `None` if it is not cached.
+        """
+        if not self.cacheable(text):
+            return None
+        with self._lock:
+            flagged = self._entries.get(text)
+            if flagged is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(text)
+                self.hits += 1
+        return flagged
+
+    def put(self, text, flagged):
+        """
+        Stores the verdict of a text, evicting the least recently used ones beyond `max_entries`.
+        """
+        if not self.cacheable(text):
+            return
+        with self._lock:
+            self._entries[text] = bool(flagged)
+            self._entries.move_to_end(text)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'entries': len(self)}
+
+
+_CACHES = weakref.WeakKeyDictionary()
+_CACHES_LOCK = threading.Lock()
+
+
+def get_moderation_cache(backend):
+    """
+    Returns the moderation cache of a backend, creating it on first use.
+    """
+    with _CACHES_LOCK:
+        cache = _CACHES.get(backend)
+        if cache is None:
+            cache = _CACHES[backend] = ModerationCache()
+        return cache
+
+
+class ModerationBatcher:
+    """
+    Batches the moderation checks of the sessions of one event loop into list calls to the moderation endpoint.
+
+    Attributes:
+        requests (int): Number of texts checked.
+        cache_hits (int): Number of texts answered from the cache.
+        batches (int): Number of upstream calls sent.
+        batched (int): Number of texts that waited for a batch (the texts not answered from the cache).
+        inputs (int): Number of texts sent upstream (after de-duplication within each batch).
+    """
+
+    def __init__(self, backend, window=DEFAULT_BATCH_WINDOW, max_batch=DEFAULT_MAX_BATCH,
+                 concurrency=DEFAULT_BATCH_CONCURRENCY, cache=None):
+        """
+        Args:
+            backend (LLMBackend): The backend whose moderation endpoint is called.
+            window (float): Seconds a batch waits for more texts after its first one. `0` only batches the texts
+                            submitted before the event loop next runs its callbacks.
+            max_batch (int): A batch is sent as soon as it has this many texts. `1` disables batching.
+            concurrency (int): Maximum number of batches in flight.
+            cache (ModerationCache, optional): Defaults to the backend's cache (`get_moderation_cache()`).
+        """
+        self.backend = backend
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.cache = cache if cache is not None else get_moderation_cache(backend)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        self.requests = 0
+        self.cache_hits = 0
+        self.batches = 0
+        self.batched = 0
+        self.inputs = 0
+        self._batch_sizes = collections.Counter()
+        self._queue_waits = collections.deque(maxlen=QUEUE_WAIT_SAMPLES)
+
+    async def check(self, text):
+        """
+        Moderates a text.
+
+        Returns:
+            bool: Whether the text was flagged.
+
+        Raises:
+            DeadlineExceeded: The caller's deadline passed before the verdict arrived.
+            UpstreamUnavailable, or the backend's error: The batch call failed.
+        """
+        self.requests += 1
+        flagged = self.cache.get(text)
+        if flagged is not None:
+            self.cache_hits += 1
+            return flagged
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future, time.perf_counter()))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.window, self._flush) if self.window > 0 else loop.call_soon(self._flush)
+
+        remaining = remaining_time()
+        try:
+            return await asyncio.wait_for(future, remaining) if remaining is not None else await future
+        except TimeoutError as error:
+            if isinstance(error, DeadlineExceeded):
+                raise
+            raise DeadlineExceeded("The deadline passed while the moderation batch was pending") from None
+
+    def _flush(self):
+        """
+        Sends the pending texts as one batch.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        # The batch runs outside the context of the caller that filled it, with its own deadline
+        task = contextvars.Context().run(asyncio.get_running_loop().create_task, self._send(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @call_deadline
+    async def _send(self, pending):
+        """
+        Moderates a batch and resolves the future of every text in it.
+        """
+        waiters = collections.defaultdict(list)
+        for text, future, queued in pending:
+            waiters[text].append(future)
+        texts = list(waiters)
+
+        try:
+            async with self._semaphore:
+                sent = time.perf_counter()
+                for _, _, queued in pending:
+                    self._queue_waits.append(sent - queued)
+                    record_span('moderation.queue_wait', sent - queued)
+                self.batches += 1
+                self.batched += len(pending)
+                self.inputs += len(texts)
+                self._batch_sizes[len(pending)] += 1
+                with upstream_call('moderation'):
+                    response = await self.backend.amoderation(texts if len(texts) > 1 else texts[0])
+                record_span('moderation.batch', time.perf_counter() - sent, inputs=len(texts))
+            verdicts = [result.flagged for result in response.results]
+            if len(verdicts) != len(texts):
+                raise ValueError("The moderation endpoint returned {0} results for {1} inputs".format(
+                    len(verdicts), len(texts)))
+        except BaseException as error:
+            for futures in waiters.values():
+                for future in futures:
+                    if future.done():
+                        continue
+                    if isinstance(error, asyncio.CancelledError):
+                        future.cancel()
+                    else:
+                        future.set_exception(error)
+            if not isinstance(error, Exception):
+                raise
+            return
+
+        for text, flagged in zip(texts, verdicts):
+            self.cache.put(text, flagged)
+            for future in waiters[text]:
+                if not future.done():
+                    future.set_result(flagged)
+
+    def stats(self):
+        """
+        Returns the batcher's metrics.
+
+        Returns:
+            dict: Texts checked, cache hits and hit rate, batches, texts batched and distinct texts sent, upstream
+                  calls saved, mean and maximum batch size (texts per batch), the number of batches of each size,
+                  and the queue wait (p50, p99 and max, in ms) of the recent texts.
+        """
+        waits = sorted(self._queue_waits)
+        percentile = lambda quantile: round(waits[min(len(waits) - 1, int(quantile * len(waits)))] * 1000, 3)
+        return {'requests': self.requests,
+                'cache_hits': self.cache_hits,
+                'cache_hit_rate': round(self.cache_hits / self.requests, 4) if self.requests else 0.0,
+                'batches': self.batches,
+                'batched': self.batched,
+                'inputs': self.inputs,
+                'calls_saved': self.requests - self.batches - len(self._pending),
+                'mean_batch_size': round(self.batched / self.batches, 3) if self.batches else 0.0,
+                'max_batch_size': max(self._batch_sizes, default=0),
+                'batch_sizes': dict(sorted(self._batch_sizes.items())),
+                'queue_wait_ms': {'p50': percentile(0.50), 'p99': percentile(0.99), 'max': percentile(1.0)}
+                                 if waits else {}}
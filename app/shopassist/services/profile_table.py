@@ -0,0 +1,215 @@
+"""
+profile_table.py
+================
+
+Precomputed rankings of the laptop catalogue for every possible user profile.
+
+A stage 1 profile rates five features 'low', 'medium' or 'high', so there are only 3^5 = 243 different profiles
+(plus the budget). `ProfileRankingTable` ranks the whole catalogue once per profile: the laptops are grouped by
+score (best first) and, within a score, kept in the order of the catalogue's price index. A request then becomes a
+lookup of the profile's ranking and a budget cut: a binary search per score group (at most six) for the price
+range, after which the best `k` laptops are read off directly, in O(log n + k).
+
+Each ranking is an array of positions in the price index (2 bytes per laptop and profile for catalogues of up to
+65,536 laptops, 4 bytes beyond), built on first use (`lazy`) or for all 243 profiles up front (`eager`). When the
+catalogue changes, `rebuild()` re-ranks only the profiles that were in use; the others are ranked again on their
+first request. `memory_usage()` reports the size.
+
+A ranking is only stored for the catalogue it was computed from: a ranking that was being computed while
+`rebuild()` switched catalogues is returned to its caller but not kept. Callers that already hold a catalogue pass
+it to `query()` / `top_k()`, so the rows they get back always belong to that catalogue.
+
+Key Functionality:
+- `profile_key()`: The level vector of a profile, or `None` for profiles outside the 243 (e.g. missing features).
+- `ProfileRankingTable.query()` / `top_k()`: Same results as `LaptopCatalogue.query()` / `top_k()`.
+- `ProfileRankingTable.build()`: Ranks all 243 profiles.
+- `ProfileRankingTable.rebuild()`: Switches to a new catalogue, re-ranking the profiles in use.
+- `ProfileRankingTable.memory_usage()`: Profiles ranked and bytes held.
+"""
+
+
+import time
+import itertools
+import threading
+import numpy as np
+from shopassist.services.catalogue import parse_budget
+from shopassist.utils.features import FEATURE_KEYS, LEVELS
+
+
+# Every level vector, in `FEATURE_KEYS` order
+ALL_PROFILES = tuple(itertools.product(range(len(LEVELS)), repeat=len(FEATURE_KEYS)))
+
+
+def profile_key(user_req_dict):
+    """
+    Returns the level vector of a profile.
+
+    Args:
+        user_req_dict (dict): The user's requirements.
+
+    Returns:
+        tuple or None: The five levels in `FEATURE_KEYS` order, or `None` if a feature is missing or has a value
+                       other than 'low', 'medium' or 'high' (such profiles are scored by the catalogue directly).
+    """
+    key = []
+    for feature in FEATURE_KEYS:
+        value = user_req_dict.get(feature)
+        if value not in LEVELS:
+            return None
+        key.append(LEVELS.index(value))
+    return tuple(key)
+
+
+class ProfileRankingTable:
+    """
+    The catalogue ranked for every profile, built lazily or eagerly.
+    """
+
+    def __init__(self, catalogue, eager=False):
+        """
+        Args:
+            catalogue (LaptopCatalogue): The catalogue to rank.
+            eager (bool): Rank all 243 profiles now instead of on first use.
+        """
+        self.catalogue = catalogue
+        self._rankings = {}
+        self._lock = threading.Lock()
+        self.build_seconds = 0.0
+        if eager:
+            self.build()
+
+    def _rank(self, key, catalogue):
+        """
+        Ranks a catalogue for one level vector.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The positions in the price index grouped by score (best first), and
+                                           the start of every group (`offsets[g]:offsets[g + 1]` has score
+                                           `len(FEATURE_KEYS) - g`).
+        """
+        requirements = list(enumerate(key))
+        scores = catalogue._score_levels(catalogue.sorted_levels, requirements, 0)
+
+        # A stable sort on the negated score keeps each group in price-index order
+        dtype = np.uint16 if len(catalogue) <= np.iinfo(np.uint16).max + 1 else np.int32
+        positions = np.argsort(-scores, kind='stable').astype(dtype)
+        counts = np.bincount(scores, minlength=len(FEATURE_KEYS) + 1)[::-1]
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        return positions, offsets
+
+    def ranking(self, key, catalogue=None):
+        """
+        Returns the ranking of a level vector, building it on first use.
+
+        Args:
+            key (tuple): The level vector.
+            catalogue (LaptopCatalogue, optional): The catalogue to rank. Defaults to the table's catalogue; the
+                                                   ranking of another one is computed but not stored.
+        """
+        with self._lock:
+            current = self.catalogue
+            ranking = self._rankings.get(key)
+        if catalogue is None:
+            catalogue = current
+        if ranking is None or catalogue is not current:
+            start = time.perf_counter()
+            ranking = self._rank(key, catalogue)
+            with self._lock:
+                # `rebuild()` may have switched catalogues meanwhile
+                if self.catalogue is catalogue:
+                    self._rankings[key] = ranking
+                    self.build_seconds += time.perf_counter() - start
+        return ranking
+
+    def build(self, keys=ALL_PROFILES):
+        """
+        Ranks the given level vectors (default: all 243) that are not ranked yet.
+
+        Returns:
+            ProfileRankingTable: The table.
+        """
+        for key in keys:
+            self.ranking(key)
+        return self
+
+    def rebuild(self, catalogue):
+        """
+        Switches to a new catalogue (e.g. after `updated_laptop.csv` was refreshed).
+
+        Only the profiles that were ranked for the old catalogue are ranked again now, so a table that was used
+        lazily stays as small (and as quick to rebuild) as the set of profiles actually requested.
+
+        Returns:
+            ProfileRankingTable: The table.
+        """
+        with self._lock:
+            keys = list(self._rankings)
+            self.catalogue = catalogue
+            self._rankings = {}
+            self.build_seconds = 0.0
+        return self.build(keys)
+
+    def query(self, user_req_dict=None, k=3, max_price=None, min_price=None, brands=None, catalogue=None):
+        """
+        Selects the best `k` laptops in a price range, with the ranking and arguments of `LaptopCatalogue.query()`.
+
+        Profiles outside the 243 level vectors, and brand-filtered queries, are passed on to the catalogue.
+
+        Args:
+            catalogue (LaptopCatalogue, optional): The catalogue to select from. Defaults to the table's catalogue.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Row indices of the selected laptops in that catalogue and their scores,
+                                           best first.
+        """
+        catalogue = self.catalogue if catalogue is None else catalogue
+        user_req_dict = user_req_dict or {}
+        key = profile_key(user_req_dict)
+        if key is None or brands is not None:
+            return catalogue.query(user_req_dict, k=k, max_price=max_price, min_price=min_price, brands=brands)
+
+        # Keys other than the five features and `Budget` add the same points to every laptop
+        _, constant = catalogue._requirements(
+            {name: value for name, value in user_req_dict.items() if name not in FEATURE_KEYS})
+
+        positions, offsets = self.ranking(key, catalogue)
+        start, end = catalogue.price_range(min_price, max_price)
+
+        selected, scores = [], []
+        for group in range(len(offsets) - 1):
+            if len(selected) >= k or start >= end:
+                break
+            members = positions[offsets[group]:offsets[group + 1]]
+            low, high = np.searchsorted(members, start), np.searchsorted(members, end)
+            # The most expensive laptops within the range are closest to the budget
+            taken = members[max(low, high - (k - len(selected))):high][::-1]
+            selected.extend(taken.tolist())
+            scores.extend([len(FEATURE_KEYS) - group + constant] * len(taken))
+
+        return (catalogue.price_order[np.asarray(selected, dtype=np.int64)],
+                np.asarray(scores, dtype=np.int8))
+
+    def top_k(self, user_req_dict, k=3, min_price=None, brands=None, catalogue=None):
+        """
+        Selects the best `k` laptops within the user's budget. See `LaptopCatalogue.top_k()` and `query()`.
+        """
+        return self.query(user_req_dict, k=k, max_price=parse_budget(user_req_dict), min_price=min_price,
+                          brands=brands, catalogue=catalogue)
+
+    def memory_usage(self):
+        """
+        Reports the size of the table.
+
+        Returns:
+            dict: Profiles ranked (of 243), bytes held by the rankings, bytes per ranked profile, catalogue rows
+                  and the seconds spent ranking.
+        """
+        with self._lock:
+            rankings = list(self._rankings.values())
+        nbytes = sum(positions.nbytes + offsets.nbytes for positions, offsets in rankings)
+        return {'profiles': len(rankings),
+                'of_profiles': len(ALL_PROFILES),
+                'bytes': nbytes,
+                'bytes_per_profile': nbytes // len(rankings) if rankings else 0,
+                'rows': len(self.catalogue),
+                'build_seconds': round(self.build_seconds, 4)}
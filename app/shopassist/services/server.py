@@ -0,0 +1,785 @@
+"""
+server.py
+=========
+
+A pre-forked HTTP service exposing the stage 1 -> 2 -> 3 conversation as a session-based JSON API.
+
+Process model:
+- The parent process imports the pipeline and loads the laptop catalogue (`stage2.get_catalogue()`, the spec index
+  of `stage3.get_spec_index()`, and the profile table if `SHOPASSIST_PROFILE_TABLE` enables it) once, freezes the
+  loaded objects out of the garbage collector (`gc.freeze()`) and forks the workers, one per CPU core by default.
+  The workers inherit the catalogue copy-on-write instead of each holding their own copy; with the memory-mapped
+  binary catalogue (`create_laptop_feature.py --binary`, or written on the first start with
+  `SHOPASSIST_CATALOGUE_SNAPSHOT=1`) the product records stay in shared pages too. `GET /status` reports the
+  private and shared memory of every worker.
+- The parent accepts the connections, reads the request line without consuming it and passes the connection to a
+  worker over a Unix socket. Each request of a session goes to the worker that started it (its id begins with the
+  worker's number); new sessions are spread round-robin. Each connection carries one request
+  (`Connection: close`).
+- Each worker serves its connections with a `DialogueEngine` on an asyncio loop (which batches the moderation
+  checks of its sessions, `--moderation-window` / `--moderation-max-batch`), and keeps its sessions as compact
+  records in a session store (`shopassist.services.session_store`, `--session-store`), which expires them after
+  `session_ttl` idle seconds. With the default in-memory store, a session lives in its worker and is lost if the
+  worker is restarted. With a SQLite store (`--session-store sqlite:data/sessions.sqlite`) the workers share the
+  sessions: when a session's worker is restarting or overloaded, another worker serves it, and sessions survive
+  restarts of the service. Each turn is saved only if the session is still at the version it was read at, so of
+  two turns of a session served at the same time by different workers, the later one is answered
+  409 Conflict instead of overwriting the other.
+- A worker that exits unexpectedly is restarted.
+- SIGTERM or SIGINT drains the service: `/readyz` reports it unavailable, the parent keeps dispatching for
+  `drain_delay` seconds (so a load balancer can stop routing to it), then stops accepting connections and asks
+  the workers to finish the requests they are serving. Workers still busy after `drain_timeout` seconds are
+  killed. A second signal skips the wait.
+
+Endpoints (JSON):
+- `GET /healthz`: The parent process is running.
+- `GET /readyz`: 200 once the catalogue is loaded and every worker is up, 503 before that and while draining.
+  Reports the catalogue (`stage2.get_catalogue_status()` and its load time) and the workers.
+- `GET /status`: `/readyz` plus the memory of every worker.
+- `POST /sessions`: Starts a session; returns its `session_id` and the assistant's introduction (`reply`).
+- `POST /sessions/<session_id>/messages` with `{"message": "..."}`: One turn (`TurnResult.to_dict()`); 409 if
+  another turn of the session was saved meanwhile, in which case the message can be sent again.
+- `DELETE /sessions/<session_id>`: Ends a session.
+- `GET /stats`: Sessions, presentation cache, moderation batching and upstream call metrics of the worker that
+  answers.
+
+Usage (from the `app` directory):
+    `python -m shopassist.services.server --host 0.0.0.0 --port 8000 --workers 4`
+    `python -m shopassist.services.server --backend stub`  (offline, against the stub backend)
+"""
+
+
+import os
+import gc
+import json
+import time
+import uuid
+import signal
+import socket
+import asyncio
+import logging
+import weakref
+import argparse
+import selectors
+import contextlib
+from shopassist.services import stage2
+from shopassist.services.backend import BACKENDS, create_backend
+from shopassist.services.moderation import DEFAULT_BATCH_WINDOW, DEFAULT_MAX_BATCH
+from shopassist.services.dialogue import DialogueEngine, SessionState, UNAVAILABLE_MESSAGE
+from shopassist.services.session_store import DEFAULT_SESSION_TTL, SessionConflict, create_session_store
+from shopassist.services.stage3 import get_presentation_cache, get_spec_index
+from shopassist.services.upstream import UpstreamUnavailable, get_upstream_stats
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8000
+DEFAULT_DRAIN_DELAY = 0.0
+DEFAULT_DRAIN_TIMEOUT = 30.0
+
+LISTEN_BACKLOG = 1024
+MAX_REQUEST_LINE = 8192
+MAX_HEADER_BYTES = 65536
+MAX_BODY_BYTES = 1 << 20
+
+# Seconds a client may take to send its request line (parent) and its whole request (worker)
+REQUEST_LINE_TIMEOUT = 10.0
+REQUEST_TIMEOUT = 30.0
+
+# Minimum seconds between two restarts of the same worker
+RESTART_INTERVAL = 1.0
+
+PARENT_PATHS = ('/healthz', '/readyz', '/status')
+
+HTTP_REASONS = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                409: 'Conflict', 413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+logger = logging.getLogger(__name__)
+
+
+def http_response(status, payload):
+    """
+    Encodes a JSON response that closes the connection.
+    """
+    body = json.dumps(payload).encode('utf-8')
+    head = ("HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n"
+            "Connection: close\r\n\r\n").format(status, HTTP_REASONS.get(status, ''), len(body))
+    return head.encode('ascii') + body
+
+
+def session_path(path):
+    """
+    Splits `/sessions/<session_id>[/messages]` into the session id and the action ('messages' or `None`).
+
+    Returns:
+        tuple: `(session_id, action)`, or `(None, None)` for other paths.
+    """
+    parts = path.strip('/').split('/')
+    if len(parts) == 2 and parts[0] == 'sessions':
+        return parts[1], None
+    if len(parts) == 3 and parts[0] == 'sessions' and parts[2] == 'messages':
+        return parts[1], 'messages'
+    return None, None
+
+
+def session_worker(session_id):
+    """
+    Returns the number of the worker that owns a session id, or `None` if the id is not one of ours.
+    """
+    prefix, _, rest = session_id.partition('.')
+    try:
+        return int(prefix, 16) if rest else None
+    except ValueError:
+        return None
+
+
+def memory_usage(pid='self'):
+    """
+    Reads the memory of a process from `/proc/<pid>/smaps_rollup` (Linux).
+
+    Returns:
+        dict: Resident (`rss_mb`), proportional (`pss_mb`), shared and private memory in MB; empty if unavailable.
+    """
+    fields = {}
+    try:
+        with open('/proc/{0}/smaps_rollup'.format(pid)) as file:
+            for line in file:
+                name, _, value = line.partition(':')
+                if value.strip().endswith('kB'):
+                    fields[name] = int(value.split()[0])
+    except (OSError, ValueError):
+        return {}
+    megabytes = lambda *names: round(sum(fields.get(name, 0) for name in names) / 1024, 1)
+    return {'rss_mb': megabytes('Rss'),
+            'pss_mb': megabytes('Pss'),
+            'shared_mb': megabytes('Shared_Clean', 'Shared_Dirty'),
+            'private_mb': megabytes('Private_Clean', 'Private_Dirty')}
+
+
+class Worker:
+    """
+    A worker process: serves the connections passed by the parent with a `DialogueEngine`.
+    """
+
+    def __init__(self, index, control, store, backend=None, moderation_window=DEFAULT_BATCH_WINDOW,
+                 moderation_max_batch=DEFAULT_MAX_BATCH):
+        """
+        Args:
+            index (int): The worker's number; the prefix of its session ids.
+            control (socket.socket): The Unix datagram socket the parent passes connections over.
+            store (MemorySessionStore or SQLiteSessionStore): The session store.
+            backend (str, optional): Name of the LLM backend (default: `SHOPASSIST_LLM_BACKEND`).
+            moderation_window (float): Seconds a moderation batch waits for the checks of other sessions.
+            moderation_max_batch (int): Maximum number of texts per moderation call.
+        """
+        self.index = index
+        self.control = control
+        self.store = store
+        self.backend = backend
+        self.moderation_window = moderation_window
+        self.moderation_max_batch = moderation_max_batch
+        self.locks = weakref.WeakValueDictionary()
+        self.connections = set()
+        self.requests = 0
+
+    async def serve(self):
+        """
+        Serves connections until the parent asks the worker to stop (SIGTERM) or goes away, then waits for the
+        requests in progress.
+        """
+        loop = asyncio.get_running_loop()
+        self.engine = DialogueEngine(backend=create_backend(self.backend),
+                                     moderation_batch_window=self.moderation_window,
+                                     moderation_max_batch=self.moderation_max_batch)
+        self.stopping = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, self.stopping.set)
+
+        self.control.setblocking(False)
+        loop.add_reader(self.control.fileno(), self._receive)
+        expiry = asyncio.create_task(self._expire_sessions())
+        try:
+            await self.stopping.wait()
+        finally:
+            loop.remove_reader(self.control.fileno())
+            expiry.cancel()
+            if self.connections:
+                await asyncio.wait(list(self.connections))
+            self.store.close()
+
+    def _receive(self):
+        """
+        Accepts the connections the parent passed over the control socket.
+        """
+        while True:
+            try:
+                message, fds, _, _ = socket.recv_fds(self.control, 16, 8)
+            except BlockingIOError:
+                return
+            except OSError:
+                self.stopping.set()
+                return
+            if not message and not fds:
+                # The parent closed its end
+                self.stopping.set()
+                return
+            for fd in fds:
+                task = asyncio.get_running_loop().create_task(self._handle(socket.socket(fileno=fd)))
+                self.connections.add(task)
+                task.add_done_callback(self.connections.discard)
+
+    async def _handle(self, connection):
+        """
+        Reads one request from a connection, answers it and closes the connection.
+        """
+        connection.setblocking(False)
+        reader, writer = await asyncio.open_connection(sock=connection, limit=MAX_HEADER_BYTES)
+        try:
+            try:
+                status, payload = await asyncio.wait_for(self._read_request(reader), REQUEST_TIMEOUT)
+                if status is None:
+                    status, payload = await self.route(*payload)
+            except UpstreamUnavailable:
+                status, payload = 503, {'error': UNAVAILABLE_MESSAGE}
+            except asyncio.TimeoutError:
+                status, payload = 400, {'error': "The request was not received in time"}
+            except Exception:
+                logger.exception("Worker %d failed to answer a request", self.index)
+                status, payload = 500, {'error': "Internal error"}
+            self.requests += 1
+            writer.write(http_response(status, payload))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def _read_request(self, reader):
+        """
+        Reads the request head and body.
+
+        Returns:
+            tuple: `(None, (method, path, body))`, or `(status, error payload)` for a malformed request.
+        """
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            return 400, {'error': "Malformed request"}
+        lines = head.decode('latin-1').split('\r\n')
+        request_line = lines[0].split(' ')
+        if len(request_line) != 3:
+            return 400, {'error': "Malformed request line"}
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            return 400, {'error': "Invalid Content-Length"}
+        if length > MAX_BODY_BYTES:
+            return 413, {'error': "The request body is too large"}
+        body = await reader.readexactly(length) if length else b''
+        return None, (request_line[0].upper(), request_line[1].split('?')[0], body)
+
+    async def route(self, method, path, body):
+        """
+        Answers a request.
+
+        Returns:
+            tuple[int, dict]: The HTTP status and the JSON payload.
+        """
+        if path == '/stats':
+            return (200, self.stats()) if method == 'GET' else (405, {'error': "Use GET"})
+
+        if path.rstrip('/') == '/sessions':
+            if method != 'POST':
+                return 405, {'error': "Use POST to start a session"}
+            session_id = '{0:x}.{1}'.format(self.index, uuid.uuid4().hex)
+            state, introduction = await self.engine.start_session(session_id)
+            self.store.put(session_id, state.to_record())
+            return 201, {'session_id': session_id, 'reply': introduction, 'stage': state.stage}
+
+        session_id, action = session_path(path)
+        if session_id is None:
+            return 404, {'error': "Unknown path {0}".format(path)}
+        unknown = 404, {'error': "Unknown or expired session {0}".format(session_id)}
+
+        if action is None:
+            if method != 'DELETE':
+                return 405, {'error': "Use DELETE to end a session"}
+            async with self._lock(session_id):
+                if self.store.get(session_id) is None:
+                    return unknown
+                self.store.delete(session_id)
+            return 200, {'session_id': session_id, 'closed': True}
+
+        if method != 'POST':
+            return 405, {'error': "Use POST to send a message"}
+        try:
+            message = json.loads(body or b'{}').get('message')
+        except (ValueError, AttributeError):
+            return 400, {'error': "The body must be a JSON object"}
+        if not isinstance(message, str):
+            return 400, {'error': "The body must have a 'message' string"}
+
+        # Turns of a session run one at a time in a worker, each on the state the previous one saved. A turn that
+        # another worker served meanwhile (shared store) changed the version, and this one is not saved over it
+        async with self._lock(session_id):
+            record, version = self.store.get_versioned(session_id)
+            if record is None:
+                return unknown
+            state = SessionState.from_record(record)
+            result = await self.engine.handle_turn(state, message)
+            try:
+                if state.closed:
+                    self.store.delete(session_id, expected_version=version)
+                else:
+                    self.store.put(session_id, state.to_record(), expected_version=version)
+            except SessionConflict:
+                return 409, {'error': "Another message of session {0} was answered at the same time; "
+                                      "send this one again".format(session_id)}
+        return 200, dict(result.to_dict(), session_id=session_id)
+
+    def _lock(self, session_id):
+        """
+        Returns the lock serialising the requests of a session in this worker.
+        """
+        lock = self.locks.get(session_id)
+        if lock is None:
+            lock = self.locks[session_id] = asyncio.Lock()
+        return lock
+
+    async def _expire_sessions(self):
+        """
+        Drops the sessions that were idle for longer than the store's `ttl`.
+        """
+        while True:
+            await asyncio.sleep(min(60.0, self.store.ttl / 4))
+            self.store.purge()
+
+    def stats(self):
+        """
+        Returns the worker's sessions, requests, presentation cache, moderation batching, upstream metrics and
+        catalogue status.
+        """
+        return {'worker': self.index,
+                'pid': os.getpid(),
+                'sessions': self.store.stats(),
+                'connections': len(self.connections),
+                'requests': self.requests,
+                'catalogue': stage2.get_catalogue_status(),
+                'presentation_cache': get_presentation_cache().stats(),
+                'moderation': self.engine.moderation_stats(),
+                'upstream': get_upstream_stats()}
+
+
+class Server:
+    """
+    The parent process: loads the catalogue, forks and supervises the workers, and dispatches connections.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, workers=None, backend=None,
+                 drain_delay=DEFAULT_DRAIN_DELAY, drain_timeout=DEFAULT_DRAIN_TIMEOUT,
+                 session_store=None, session_ttl=DEFAULT_SESSION_TTL, moderation_window=DEFAULT_BATCH_WINDOW,
+                 moderation_max_batch=DEFAULT_MAX_BATCH):
+        """
+        Args:
+            host (str): Address to listen on.
+            port (int): Port to listen on (0 picks a free port; see `port` after `bind()`).
+            workers (int, optional): Number of worker processes. Defaults to the number of CPU cores.
+            backend (str, optional): Name of the LLM backend (default: `SHOPASSIST_LLM_BACKEND`).
+            drain_delay (float): Seconds the parent keeps dispatching after SIGTERM while reporting not ready.
+            drain_timeout (float): Seconds the workers get to finish their requests before they are killed.
+            session_store (str, optional): Spec of the session store, `memory` or `sqlite:<path>` (default:
+                                           `SHOPASSIST_SESSION_STORE`, or `memory`).
+            session_ttl (float): Seconds after which an idle session is dropped.
+            moderation_window (float): Seconds a worker's moderation batch waits for the checks of other sessions.
+            moderation_max_batch (int): Maximum number of texts per moderation call.
+        """
+        self.host = host
+        self.port = port
+        self.worker_count = workers or os.cpu_count() or 1
+        self.backend = backend
+        self.drain_delay = drain_delay
+        self.drain_timeout = drain_timeout
+        self.moderation_window = moderation_window
+        self.moderation_max_batch = moderation_max_batch
+        # Workers inherit the store; a SQLite store opens one connection per process
+        self.store = create_session_store(session_store, ttl=session_ttl)
+
+        self.workers = [{'index': index, 'pid': None, 'control': None, 'restarts': 0, 'started': None}
+                        for index in range(self.worker_count)]
+        self.catalogue_load_s = None
+        self.listener = None
+        self.selector = None
+        self.started = time.monotonic()
+        self.draining = False
+        self._signals = 0
+        self._drain_started = None
+        self._stop_started = None
+        self._pending = {}
+        self._waiting = set()
+        self._next_worker = 0
+
+    def load(self):
+        """
+        Loads the catalogue, the spec index of stage 3 and the profile table (if enabled) into the parent, to be
+        shared by the workers.
+        """
+        start = time.perf_counter()
+        stage2.get_catalogue()
+        if stage2.PROFILE_TABLE_MODE != 'off':
+            stage2.get_profile_table()
+        get_spec_index()
+        self.catalogue_load_s = round(time.perf_counter() - start, 4)
+        logger.info("Catalogue loaded in %.3f s: %s", self.catalogue_load_s, stage2.get_catalogue_status())
+
+    def bind(self):
+        """
+        Opens the listening socket.
+        """
+        self.listener = socket.create_server((self.host, self.port), backlog=LISTEN_BACKLOG)
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+        return self
+
+    def serve_forever(self):
+        """
+        Loads the catalogue, starts the workers and dispatches connections until the service is drained.
+        """
+        self.load()
+        if self.listener is None:
+            self.bind()
+
+        # Objects loaded so far are never collected; the collector then leaves their pages shared
+        gc.collect()
+        gc.freeze()
+
+        self.selector = selectors.DefaultSelector()
+        wakeup, self._wakeup_writer = socket.socketpair()
+        for end in (wakeup, self._wakeup_writer):
+            end.setblocking(False)
+        signal.set_wakeup_fd(self._wakeup_writer.fileno())
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_signal)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        for worker in self.workers:
+            self._spawn(worker)
+        self.selector.register(self.listener, selectors.EVENT_READ, 'listen')
+        self.selector.register(wakeup, selectors.EVENT_READ, 'wakeup')
+        logger.info("Serving on %s:%d with %d workers", self.host, self.port, self.worker_count)
+
+        try:
+            while not self._finished():
+                for key, _ in self.selector.select(0.005 if self._waiting else 0.5):
+                    if key.data == 'listen':
+                        self._accept()
+                    elif key.data == 'wakeup':
+                        with contextlib.suppress(BlockingIOError):
+                            while wakeup.recv(512):
+                                pass
+                    else:
+                        self._peek(key.fileobj)
+                for connection in list(self._waiting):
+                    self._peek(connection)
+                self._reap()
+                self._expire_pending()
+        finally:
+            signal.set_wakeup_fd(-1)
+            for connection in list(self._pending):
+                self._close(connection)
+            self.selector.close()
+            wakeup.close()
+            self._wakeup_writer.close()
+            if self.listener is not None:
+                self.listener.close()
+        logger.info("Drained; exiting")
+
+    def _on_signal(self, signum, frame):
+        self._signals += 1
+        if not self.draining:
+            self.draining = True
+            self._drain_started = time.monotonic()
+            logger.info("Draining (signal %d)", signum)
+        elif self._signals > 1:
+            # A second signal: stop waiting
+            self.drain_delay = 0.0
+            self.drain_timeout = 0.0
+
+    def _spawn(self, worker):
+        """
+        Forks a worker process.
+        """
+        parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                parent_end.close()
+                self._close_in_child()
+                asyncio.run(Worker(worker['index'], child_end, self.store, backend=self.backend,
+                                   moderation_window=self.moderation_window,
+                                   moderation_max_batch=self.moderation_max_batch).serve())
+            except BaseException:
+                logger.exception("Worker %d failed", worker['index'])
+                code = 1
+            finally:
+                os._exit(code)
+
+        child_end.close()
+        parent_end.setblocking(False)
+        worker.update(pid=pid, control=parent_end, started=time.monotonic())
+        logger.info("Worker %d started (pid %d)", worker['index'], pid)
+
+    def _close_in_child(self):
+        """
+        Releases the parent's sockets and signal handling in a newly forked worker.
+        """
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        # The parent coordinates the shutdown on Ctrl-C
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for worker in self.workers:
+            if worker['control'] is not None:
+                worker['control'].close()
+        for connection in list(self._pending):
+            connection.close()
+        self.listener.close()
+        self.selector.close()
+        self._wakeup_writer.close()
+
+    def _reap(self):
+        """
+        Collects exited workers and restarts them unless the service is draining.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            for worker in self.workers:
+                if worker['pid'] == pid:
+                    worker['pid'] = None
+                    worker['control'].close()
+                    worker['control'] = None
+                    if not self.draining:
+                        logger.warning("Worker %d (pid %d) exited with status %d; restarting",
+                                       worker['index'], pid, status)
+        if self.draining:
+            return
+        for worker in self.workers:
+            if worker['pid'] is None and time.monotonic() - (worker['started'] or 0) >= RESTART_INTERVAL:
+                worker['restarts'] += 1
+                self._spawn(worker)
+
+    def _finished(self):
+        """
+        Advances the drain and tells whether it is complete.
+        """
+        if not self.draining:
+            return False
+        now = time.monotonic()
+        if self._stop_started is None:
+            if now - self._drain_started < self.drain_delay:
+                return False
+            self.selector.unregister(self.listener)
+            self.listener.close()
+            self.listener = None
+            for connection in list(self._pending):
+                self._respond(connection, 503, {'error': "The service is shutting down"})
+            for worker in self.workers:
+                if worker['pid'] is not None:
+                    with contextlib.suppress(ProcessLookupError):
+                        os.kill(worker['pid'], signal.SIGTERM)
+            self._stop_started = now
+        if all(worker['pid'] is None for worker in self.workers):
+            return True
+        if now - self._stop_started >= self.drain_timeout:
+            for worker in self.workers:
+                if worker['pid'] is not None:
+                    logger.warning("Worker %d did not drain in time; killing it", worker['index'])
+                    with contextlib.suppress(ProcessLookupError):
+                        os.kill(worker['pid'], signal.SIGKILL)
+            self._stop_started = float('inf') if self.drain_timeout <= 0 else now
+        return False
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                logger.exception("accept() failed")
+                return
+            connection.setblocking(False)
+            self._pending[connection] = time.monotonic()
+            self.selector.register(connection, selectors.EVENT_READ, 'connection')
+
+    def _close(self, connection):
+        self._pending.pop(connection, None)
+        self._waiting.discard(connection)
+        with contextlib.suppress(KeyError, ValueError):
+            self.selector.unregister(connection)
+        connection.close()
+
+    def _respond(self, connection, status, payload):
+        """
+        Answers a connection from the parent and closes it.
+        """
+        try:
+            connection.settimeout(1.0)
+            connection.sendall(http_response(status, payload))
+        except OSError:
+            pass
+        self._close(connection)
+
+    def _expire_pending(self):
+        cutoff = time.monotonic() - REQUEST_LINE_TIMEOUT
+        for connection, accepted in list(self._pending.items()):
+            if accepted < cutoff:
+                self._close(connection)
+
+    def _peek(self, connection):
+        """
+        Reads the request line of a connection without consuming it, then answers or dispatches the connection.
+        """
+        try:
+            data = connection.recv(MAX_REQUEST_LINE, socket.MSG_PEEK)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._close(connection)
+            return
+        if not data:
+            self._close(connection)
+            return
+
+        end = data.find(b'\r\n')
+        if end < 0:
+            if len(data) >= MAX_REQUEST_LINE:
+                self._respond(connection, 400, {'error': "The request line is too long"})
+            elif connection not in self._waiting:
+                # Part of the request line arrived; poll until the rest does instead of spinning on readability
+                self.selector.unregister(connection)
+                self._waiting.add(connection)
+            return
+
+        parts = data[:end].decode('latin-1').split(' ')
+        method, path = parts[0].upper(), (parts[1] if len(parts) > 1 else '/').split('?')[0]
+        if path in PARENT_PATHS:
+            self._answer(connection, method, path)
+        else:
+            self._dispatch(connection, path)
+
+    def _answer(self, connection, method, path):
+        """
+        Answers the health, readiness and status endpoints.
+        """
+        with contextlib.suppress(OSError):
+            connection.recv(MAX_HEADER_BYTES)
+        if method != 'GET':
+            self._respond(connection, 405, {'error': "Use GET"})
+        elif path == '/healthz':
+            self._respond(connection, 200, {'status': 'ok', 'pid': os.getpid(), 'draining': self.draining})
+        else:
+            ready, status = self.status(memory=path == '/status')
+            self._respond(connection, 200 if ready else 503, status)
+
+    def _dispatch(self, connection, path):
+        """
+        Passes a connection to the worker owning its session, or to the next worker for other requests.
+
+        With a shared session store, a session whose worker is restarting or overloaded goes to another worker.
+        """
+        session_id, _ = session_path(path)
+        owner = session_worker(session_id) if session_id else None
+        if owner is not None and owner < self.worker_count:
+            candidates = [owner]
+            if self.store.shared:
+                start = self._round_robin()
+                candidates += [(start + offset) % self.worker_count for offset in range(self.worker_count)
+                               if (start + offset) % self.worker_count != owner]
+        else:
+            candidates = [self._round_robin()]
+
+        for index in candidates:
+            control = self.workers[index]['control']
+            if control is None:
+                continue
+            try:
+                socket.send_fds(control, [b'c'], [connection.fileno()])
+            except OSError:
+                continue
+            self._close(connection)
+            return
+        self._respond(connection, 503, {'error': "No worker can take this request; try again shortly"})
+
+    def _round_robin(self):
+        index = self._next_worker
+        self._next_worker = (self._next_worker + 1) % self.worker_count
+        return index
+
+    def status(self, memory=False):
+        """
+        Reports the readiness of the service.
+
+        Args:
+            memory (bool): Include the memory of the parent and of every worker.
+
+        Returns:
+            tuple[bool, dict]: Whether the service is ready, and the catalogue and worker details.
+        """
+        catalogue = dict(stage2.get_catalogue_status(), load_s=self.catalogue_load_s)
+        workers = []
+        for worker in self.workers:
+            details = {'index': worker['index'], 'pid': worker['pid'], 'alive': worker['pid'] is not None,
+                       'restarts': worker['restarts']}
+            if memory and worker['pid'] is not None:
+                details['memory'] = memory_usage(worker['pid'])
+            workers.append(details)
+        ready = not self.draining and catalogue['loaded'] and all(worker['alive'] for worker in workers)
+        status = {'ready': ready,
+                  'draining': self.draining,
+                  'pid': os.getpid(),
+                  'uptime_s': round(time.monotonic() - self.started, 1),
+                  'catalogue': catalogue,
+                  'session_store': self.store.stats() if self.store.shared else {'backend': 'memory'},
+                  'workers': workers}
+        if memory:
+            status['memory'] = memory_usage()
+        return ready, status
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serve ShopAssist conversations over HTTP from a pool of workers.")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="address to listen on")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="port to listen on")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: one per CPU core)")
+    parser.add_argument('--backend', choices=BACKENDS, default=None,
+                        help="LLM backend (default: $SHOPASSIST_LLM_BACKEND or openai)")
+    parser.add_argument('--drain-delay', type=float, default=DEFAULT_DRAIN_DELAY,
+                        help="seconds to keep serving after SIGTERM while reporting not ready")
+    parser.add_argument('--drain-timeout', type=float, default=DEFAULT_DRAIN_TIMEOUT,
+                        help="seconds the workers get to finish their requests when draining")
+    parser.add_argument('--session-store', default=None,
+                        help="'memory' or 'sqlite:<path>' (default: $SHOPASSIST_SESSION_STORE or memory)")
+    parser.add_argument('--session-ttl', type=float, default=DEFAULT_SESSION_TTL,
+                        help="seconds after which an idle session is dropped")
+    parser.add_argument('--moderation-window', type=float, default=DEFAULT_BATCH_WINDOW,
+                        help="seconds a moderation batch waits for the checks of other sessions")
+    parser.add_argument('--moderation-max-batch', type=int, default=DEFAULT_MAX_BATCH,
+                        help="maximum number of texts per moderation call (1 disables batching)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s")
+    Server(host=args.host, port=args.port, workers=args.workers, backend=args.backend,
+           drain_delay=args.drain_delay, drain_timeout=args.drain_timeout,
+           session_store=args.session_store, session_ttl=args.session_ttl,
+           moderation_window=args.moderation_window, moderation_max_batch=args.moderation_max_batch).serve_forever()
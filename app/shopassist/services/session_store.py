@@ -0,0 +1,450 @@
+"""
+session_store.py
+================
+
+Stores for the compact session records of the dialogue engine, so a session outlives the process that served it.
+
+`SessionState.to_record()` reduces a session to what cannot be rebuilt: the stage, the confirmed (or partially
+filled) six-key profile, the ids of the recommended laptops instead of their details, and the tail of the
+current history without its prompt messages. A record is a few kilobytes of compact JSON, encoded and decoded in
+microseconds; `SessionState.from_record()` rebuilds the session from it.
+
+Both stores expire a session `ttl` seconds after it was last saved and bound their size; beyond the bound the least
+recently used sessions are dropped.
+
+Every save increments the session's version. `get_versioned()` returns a record with its version, and `put()` or
+`delete()` with `expected_version` only write if the session is still at that version, raising `SessionConflict`
+otherwise. Processes sharing a SQLite store use it to detect two turns of the same session that ran concurrently
+(e.g. on two workers of `shopassist.services.server`): the second save fails instead of overwriting the first.
+
+Key Components:
+- `encode_record()` / `decode_record()`: The byte encoding of a record.
+- `SessionConflict`: A conditional save found the session at another version.
+- `MemorySessionStore`: An in-process LRU store, bounded by entries and bytes. Sessions live as long as the process.
+- `SQLiteSessionStore`: A store in a local SQLite file, shared by the processes of a host (e.g. the workers of
+  `shopassist.services.server`) and kept across restarts.
+- `create_session_store()`: A store from a spec, `memory` or `sqlite:<path>` (default: `SHOPASSIST_SESSION_STORE`).
+
+Usage:
+    store = create_session_store('sqlite:data/sessions.sqlite')
+    store.put(state.session_id, state.to_record())
+    record, version = store.get_versioned(session_id)
+    state = SessionState.from_record(record)
+    ...
+    store.put(session_id, state.to_record(), expected_version=version)  # raises SessionConflict if changed since
+"""
+
+
+import os
+import json
+import time
+import sqlite3
+import threading
+import collections
+
+
+DEFAULT_SESSION_TTL = 1800.0
+DEFAULT_MAX_SESSIONS = 100000
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# The SQLite store drops expired sessions and enforces `max_entries` once every this many writes
+SQLITE_PURGE_INTERVAL = 256
+
+SESSION_STORE_ENV = 'SHOPASSIST_SESSION_STORE'
+
+
+class SessionConflict(Exception):
+    """
+    Raised when a session was saved (or deleted) since the version a conditional `put()` or `delete()` expected.
+    """
+
+
+def encode_record(record):
+    """
+    Encodes a session record as compact UTF-8 JSON.
+    """
+    return json.dumps(record, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def decode_record(data):
+    """
+    Decodes a record encoded with `encode_record()`.
+    """
+    return json.loads(data)
+
+
+class MemorySessionStore:
+    """
+    An in-process, thread-safe store of session records.
+
+    Records are kept encoded, so `max_bytes` bounds the memory they take. Beyond `max_entries` sessions or
+    `max_bytes`, the least recently used sessions are evicted.
+
+    Attributes:
+        shared (bool): Whether other processes see the sessions (`False`).
+        hits (int): Number of lookups that found a session.
+        misses (int): Number of lookups that found nothing (including expired sessions).
+        evictions (int): Number of sessions evicted to respect the bounds.
+        expirations (int): Number of sessions dropped because they outlived `ttl`.
+        conflicts (int): Number of conditional saves that found the session at another version.
+    """
+
+    shared = False
+
+    def __init__(self, ttl=DEFAULT_SESSION_TTL, max_entries=DEFAULT_MAX_SESSIONS, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Args:
+            ttl (float): Seconds a session is kept after it was last saved.
+            max_entries (int): Maximum number of sessions kept.
+            max_bytes (int): Maximum total size of the encoded records.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.conflicts = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, session_id):
+        """
+        Looks up a session and marks it as recently used.
+
+        Returns:
+            dict or None: The record, or `None` if the session is unknown or expired.
+        """
+        return self.get_versioned(session_id)[0]
+
+    def get_versioned(self, session_id):
+        """
+        Looks up a session and its version, and marks it as recently used.
+
+        Returns:
+            tuple: `(record, version)`, or `(None, None)` if the session is unknown or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._drop(session_id)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None, None
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+        return decode_record(entry[1]), entry[2]
+
+    def _check_version(self, session_id, expected_version):
+        entry = self._entries.get(session_id)
+        if expected_version is not None and (entry[2] if entry is not None else None) != expected_version:
+            self.conflicts += 1
+            raise SessionConflict("Session {0} was changed by another request".format(session_id))
+        return entry[2] if entry is not None else 0
+
+    def put(self, session_id, record, expected_version=None):
+        """
+        Saves a session, evicting the least recently used ones if the store is over its bounds.
+
+        Args:
+            session_id (str): The session id.
+            record (dict): The record (`SessionState.to_record()`).
+            expected_version (int, optional): Only save if the session is at this version (`get_versioned()`).
+
+        Returns:
+            int: The new version of the session.
+
+        Raises:
+            SessionConflict: The session is at another version, or was deleted.
+        """
+        data = encode_record(record)
+        with self._lock:
+            version = self._check_version(session_id, expected_version) + 1
+            if session_id in self._entries:
+                self._drop(session_id)
+            self._entries[session_id] = (time.monotonic() + self.ttl, data, version)
+            self._bytes += len(data)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+        return version
+
+    def _drop(self, session_id):
+        self._bytes -= len(self._entries.pop(session_id)[1])
+
+    def delete(self, session_id, expected_version=None):
+        """
+        Removes a session, if present.
+
+        Raises:
+            SessionConflict: `expected_version` is given and the session is at another version, or was deleted.
+        """
+        with self._lock:
+            self._check_version(session_id, expected_version)
+            if session_id in self._entries:
+                self._drop(session_id)
+
+    def purge(self):
+        """
+        Drops the expired sessions.
+
+        Returns:
+            int: Number of sessions dropped.
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [session_id for session_id, (expires, _, _) in self._entries.items() if expires <= now]
+            for session_id in expired:
+                self._drop(session_id)
+            self.expirations += len(expired)
+        return len(expired)
+
+    def stats(self):
+        """
+        Returns the store counters.
+
+        Returns:
+            dict: Hits, misses, hit rate, evictions, expirations, conflicts, sessions and total bytes of the records.
+        """
+        lookups = self.hits + self.misses
+        return {'backend': 'memory',
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'conflicts': self.conflicts,
+                'entries': len(self),
+                'bytes': self._bytes}
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore:
+    """
+    A store of session records in a SQLite file, shared by every process that opens the same file.
+
+    Each process (and each fork) opens its own connection on first use. Expired sessions are never returned; they
+    are deleted, and the least recently saved sessions beyond `max_entries` evicted, once every
+    `SQLITE_PURGE_INTERVAL` writes of a process.
+
+    Attributes:
+        shared (bool): Whether other processes see the sessions (`True`).
+        hits, misses, evictions, expirations, conflicts (int): As for `MemorySessionStore`, counted by this
+                                                               process.
+    """
+
+    shared = True
+
+    def __init__(self, path, ttl=DEFAULT_SESSION_TTL, max_entries=DEFAULT_MAX_SESSIONS):
+        """
+        Args:
+            path (str): SQLite database file. Its directory is created if needed.
+            ttl (float): Seconds a session is kept after it was last saved.
+            max_entries (int): Maximum number of sessions kept.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.conflicts = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self._writes = 0
+
+    def _connect(self):
+        """
+        Returns the connection of this process, opening it on first use.
+        """
+        if self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                                      id TEXT PRIMARY KEY,
+                                      record BLOB NOT NULL,
+                                      saved REAL NOT NULL,
+                                      version INTEGER NOT NULL DEFAULT 0)""")
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(sessions)")]
+            if 'version' not in columns:
+                # A file written before sessions had versions
+                connection.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            connection.execute("CREATE INDEX IF NOT EXISTS sessions_saved ON sessions (saved)")
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def get(self, session_id):
+        """
+        Looks up a session.
+
+        Returns:
+            dict or None: The record, or `None` if the session is unknown or expired.
+        """
+        return self.get_versioned(session_id)[0]
+
+    def get_versioned(self, session_id):
+        """
+        Looks up a session and its version.
+
+        Returns:
+            tuple: `(record, version)`, or `(None, None)` if the session is unknown or expired.
+        """
+        with self._lock:
+            row = self._connect().execute("SELECT record, saved, version FROM sessions WHERE id = ?",
+                                          (session_id,)).fetchone()
+            if row is not None and row[1] + self.ttl <= time.time():
+                self.expirations += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None, None
+            self.hits += 1
+        return decode_record(row[0]), row[2]
+
+    def put(self, session_id, record, expected_version=None):
+        """
+        Saves a session. With `expected_version`, the row is only updated if it still has that version, in the same
+        statement, so two processes cannot both save over the same version.
+
+        Args:
+            session_id (str): The session id.
+            record (dict): The record (`SessionState.to_record()`).
+            expected_version (int, optional): Only save if the session is at this version (`get_versioned()`).
+
+        Returns:
+            int: The new version of the session.
+
+        Raises:
+            SessionConflict: The session is at another version, or was deleted.
+        """
+        data = encode_record(record)
+        with self._lock:
+            connection = self._connect()
+            if expected_version is None:
+                version = connection.execute(
+                    """INSERT INTO sessions (id, record, saved, version) VALUES (?, ?, ?, 1)
+                       ON CONFLICT (id) DO UPDATE SET record = excluded.record, saved = excluded.saved,
+                                                      version = sessions.version + 1
+                       RETURNING version""", (session_id, data, time.time())).fetchone()[0]
+            else:
+                updated = connection.execute(
+                    """UPDATE sessions SET record = ?, saved = ?, version = version + 1
+                       WHERE id = ? AND version = ?""",
+                    (data, time.time(), session_id, expected_version)).rowcount
+                if not updated:
+                    self.conflicts += 1
+                    raise SessionConflict("Session {0} was changed by another request".format(session_id))
+                version = expected_version + 1
+            self._writes += 1
+            purge = self._writes % SQLITE_PURGE_INTERVAL == 0
+        if purge:
+            self.purge()
+        return version
+
+    def delete(self, session_id, expected_version=None):
+        """
+        Removes a session, if present.
+
+        Raises:
+            SessionConflict: `expected_version` is given and the session is at another version, or was deleted.
+        """
+        with self._lock:
+            if expected_version is None:
+                self._connect().execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+                return
+            deleted = self._connect().execute("DELETE FROM sessions WHERE id = ? AND version = ?",
+                                              (session_id, expected_version)).rowcount
+            if not deleted:
+                self.conflicts += 1
+                raise SessionConflict("Session {0} was changed by another request".format(session_id))
+
+    def purge(self):
+        """
+        Deletes the expired sessions, then the least recently saved ones beyond `max_entries`.
+
+        Returns:
+            int: Number of sessions deleted.
+        """
+        with self._lock:
+            connection = self._connect()
+            expired = connection.execute("DELETE FROM sessions WHERE saved <= ?", (time.time() - self.ttl,)).rowcount
+            excess = connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_entries
+            if excess > 0:
+                connection.execute("""DELETE FROM sessions WHERE id IN (
+                                          SELECT id FROM sessions ORDER BY saved LIMIT ?)""", (excess,))
+            self.expirations += expired
+            self.evictions += max(0, excess)
+        return expired + max(0, excess)
+
+    def stats(self):
+        """
+        Returns the store counters.
+
+        Returns:
+            dict: Hits, misses, hit rate, evictions, expirations and conflicts of this process, and the sessions and
+                  bytes in the file.
+        """
+        with self._lock:
+            entries, size = self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(record)), 0) FROM sessions").fetchone()
+        lookups = self.hits + self.misses
+        return {'backend': 'sqlite',
+                'path': self.path,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'conflicts': self.conflicts,
+                'entries': entries,
+                'bytes': size}
+
+    def close(self):
+        """
+        Closes this process's connection.
+        """
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection, self._pid = None, None
+
+
+def create_session_store(spec=None, ttl=DEFAULT_SESSION_TTL, max_entries=DEFAULT_MAX_SESSIONS):
+    """
+    Creates a session store from a spec.
+
+    Args:
+        spec (str, optional): 'memory', or 'sqlite:<path>' (e.g. 'sqlite:data/sessions.sqlite'). Defaults to the
+                              `SHOPASSIST_SESSION_STORE` environment variable, or 'memory'.
+        ttl (float): Seconds a session is kept after it was last saved.
+        max_entries (int): Maximum number of sessions kept.
+
+    Returns:
+        MemorySessionStore or SQLiteSessionStore: The store.
+    """
+    spec = spec or os.environ.get(SESSION_STORE_ENV) or 'memory'
+    if spec == 'memory':
+        return MemorySessionStore(ttl=ttl, max_entries=max_entries)
+    if spec.startswith('sqlite:'):
+        return SQLiteSessionStore(spec[len('sqlite:'):], ttl=ttl, max_entries=max_entries)
+    raise ValueError("Unknown session store {0!r}: expected 'memory' or 'sqlite:<path>'".format(spec))
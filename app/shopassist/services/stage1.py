@@ -23,24 +23,119 @@ requirements in the form of Python dictionaries.
 4. **dictionary_present**:
     Extracts and validates a Python dictionary from the chatbot's response 
     that represents the user's preferences for a laptop.
+
+5. **confirm_user_profile**:
+    Confirms and extracts the user profile in one step, parsing the response locally
+    and calling the two layers above only when the local parse is ambiguous.
+
+6. **stream_chat_completions**:
+    Streaming variant of `get_chat_completions` that yields the reply as it is generated,
+    moderating it in chunks along the way (see `shopassist.services.streaming`).
+
+The prompts and request arguments are built by separate functions (`chat_completion_request`,
+`intent_confirmation_request`, `dictionary_present_messages`), so the asynchronous dialogue engine
+in `shopassist.services.dialogue` sends exactly the same requests. The system prompts do not depend on
+the input, so they are rendered once and cached; request building never modifies the caller's messages.
+The token usage of every call is kept in `CALL_USAGE` (see `get_call_usage`).
+
+Every request goes to the backend returned by `shopassist.services.backend.get_backend()`: the OpenAI API,
+or the offline stub when `SHOPASSIST_LLM_BACKEND=stub`. Each call, retries included, is bounded by a deadline and
+guarded by a per-endpoint circuit breaker (`shopassist.services.upstream`); both raise `UpstreamUnavailable`.
 """
 
 
-import openai
 import json
-from tenacity import (retry, 
-                      wait_random_exponential, 
-                      stop_after_attempt)
+import time
+import threading
+import collections
+import functools
+from shopassist.utils.features import LEVELS
+from shopassist.services.backend import get_backend
+from shopassist.services.moderation import get_moderation_cache
+from shopassist.services.upstream import call_deadline, retry_policy, upstream_call
+from shopassist.services.streaming import ChatStream, DEFAULT_MODERATION_CHARS
+from shopassist.utils.tracing import traced, span_add, span_set
+from shopassist.utils.profile import (PROFILE_COMPLETE,
+                                     PROFILE_ABSENT,
+                                     extract_user_profile)
+from tenacity import retry
 
 
+MODEL = 'gpt-3.5-turbo'
 
+# Running totals of the chat completion calls made through `get_chat_completions` (shared by all threads)
+API_USAGE = {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'retries': 0}
+_API_USAGE_LOCK = threading.Lock()
 
 
-def initialize_conversation():
+# Token usage of the most recent calls, one record per call, so a growing prompt shows up call by call
+CALL_USAGE = collections.deque(maxlen=1000)
+
+
+def _record_usage(completion):
     """
-    Initialize the conversation with a system message defining the assistant's role and instructions.
+    Adds the token usage reported by a chat completion to `API_USAGE` and `CALL_USAGE`.
+    """
+    usage = getattr(completion, 'usage', None)
+    prompt_tokens = (usage.prompt_tokens or 0) if usage is not None else None
+    completion_tokens = (usage.completion_tokens or 0) if usage is not None else None
+    if usage is not None:
+        span_add(calls=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    with _API_USAGE_LOCK:
+        API_USAGE['calls'] += 1
+        if usage is not None:
+            API_USAGE['prompt_tokens'] += prompt_tokens
+            API_USAGE['completion_tokens'] += completion_tokens
+        CALL_USAGE.append({'call': API_USAGE['calls'],
+                           'model': getattr(completion, 'model', None),
+                           'prompt_tokens': prompt_tokens,
+                           'completion_tokens': completion_tokens})
+
+
+def _record_retry(retry_state):
+    """
+    `tenacity` hook counting every retried chat completion in `API_USAGE` (and in the current tracing span).
+    """
+    span_add(retries=1)
+    with _API_USAGE_LOCK:
+        API_USAGE['retries'] += 1
+
+
+# How the intent of each assistant response was decided: parsed locally (confirmed or rejected) or by the LLM
+INTENT_STATS = {'local_confirmed': 0, 'local_rejected': 0, 'llm': 0}
+
+
+def get_api_usage():
+    """
+    Returns a snapshot of the chat completion usage counters.
     Returns:
-        list: Initial conversation messages containing the system's role and system message.
+        dict: Number of calls, prompt tokens, completion tokens and retries so far.
+    """
+    with _API_USAGE_LOCK:
+        return dict(API_USAGE)
+
+
+def get_call_usage(last = None):
+    """
+    Returns the token usage of individual chat completion calls, oldest first.
+    Args:
+        last (int, optional): Only return the `last` most recent calls.
+    Returns:
+        list: One dict per call with its sequence number, model, prompt tokens and completion tokens.
+    """
+    with _API_USAGE_LOCK:
+        calls = list(CALL_USAGE)
+    return calls[-last:] if last else calls
+
+
+
+@functools.lru_cache(maxsize=None)
+def initialize_conversation_prompt():
+    """
+    Build the system message of the stage 1 conversation.
+    The prompt does not depend on any input, so it is rendered once and shared by every conversation.
+    Returns:
+        str: The system message.
     """
 
     delimiter = "####"
@@ -118,17 +213,78 @@ def initialize_conversation():
 
     Start with a short welcome message and encourage the user to share their requirements.
     """
-    conversation = [{"role": "system", "content": system_message}]
-    # conversation = system_message
+    return system_message
+
+
+@traced('stage1.initialize_conversation')
+def initialize_conversation():
+    """
+    Initialize the conversation with a system message defining the assistant's role and instructions.
+    Returns:
+        list: Initial conversation messages containing the system's role and system message.
+    """
+    conversation = [{"role": "system", "content": initialize_conversation_prompt()}]
     return conversation
 
 
+SYSTEM_MESSAGE_JSON_OUTPUT = """<<. Return output in JSON format to the key output.>>"""
+
+
+def chat_completion_request(input, json_format = False):
+    """
+    Build the keyword arguments of a chat completion request.
+    Shared by `get_chat_completions` and the asynchronous dialogue engine, so both send identical requests.
+    The caller's messages are never modified, so a message list can be reused (or a call retried)
+    without the system prompt growing.
+    Args:
+        input (list): List of conversation messages.
+        json_format (bool): Flag to determine if JSON response is required.
+    Returns:
+        dict: Keyword arguments for `chat.completions.create`.
+    """
+
+    # If the output is required to be in JSON format
+    if json_format:
+        # Send the system prompt with the JSON instruction required by OpenAI, leaving the caller's message untouched
+        system_message = input[0]
+        if not system_message['content'].endswith(SYSTEM_MESSAGE_JSON_OUTPUT):
+            system_message = {**system_message, 'content': system_message['content'] + SYSTEM_MESSAGE_JSON_OUTPUT}
+
+        # JSON return type specified
+        return dict(model = MODEL,
+                    messages = [system_message] + input[1:],
+                    response_format = { "type": "json_object"},
+                    seed = 1234)
+
+    # No JSON return type specified
+    return dict(model = MODEL,
+                messages = input,
+                seed = 2345)
+
+
+def chat_completion_output(chat_completion, json_format = False):
+    """
+    Extract the output of a chat completion and record its token usage.
+    Args:
+        chat_completion: The API response.
+        json_format (bool): Flag to determine if the response content is JSON.
+    Returns:
+        dict or str: The response content, decoded if it is JSON.
+    """
+    _record_usage(chat_completion)
+    content = chat_completion.choices[0].message.content
+    return json.loads(content) if json_format else content
+
+
 # Define a Chat Completions API call
-# Retry up to 6 times with exponential backoff, starting at 1 second and maxing out at 20 seconds delay
-@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
+# Retry up to 6 times with exponential backoff, starting at 1 second and maxing out at 20 seconds delay,
+# within the call's deadline (`upstream.CALL_DEADLINE`)
+@traced('stage1.get_chat_completions')
+@call_deadline
+@retry(before_sleep=_record_retry, **retry_policy())
 def get_chat_completions(input, json_format = False):
     """
-    Interact with OpenAI's chat completion API to get a response.
+    Interact with the chat completion API of the current backend (`shopassist.services.backend`) to get a response.
     Args:
         input_messages (list): List of conversation messages.
         json_format (bool): Flag to determine if JSON response is required.
@@ -136,61 +292,88 @@ def get_chat_completions(input, json_format = False):
         dict or str: API response, either as a JSON object or a string.
     """
 
-    MODEL = 'gpt-3.5-turbo'
-
-    system_message_json_output = """<<. Return output in JSON format to the key output.>>"""
+    with upstream_call('chat'):
+        chat_completion = get_backend().chat_completion(**chat_completion_request(input, json_format))
 
-    # If the output is required to be in JSON format
-    if json_format:
-        # Append the input prompt to include JSON response as specified by OpenAI
-        input[0]['content'] += system_message_json_output
+    return chat_completion_output(chat_completion, json_format)
 
-        # JSON return type specified
-        chat_completion_json = openai.chat.completions.create(
-            model = MODEL,
-            messages = input,
-            response_format = { "type": "json_object"},
-            seed = 1234)
 
-        output = json.loads(chat_completion_json.choices[0].message.content)
 
-    # No JSON return type specified
-    else:
-        chat_completion = openai.chat.completions.create(
-            model = MODEL,
-            messages = input,
-            seed = 2345)
-
-        output = chat_completion.choices[0].message.content
+@call_deadline
+@retry(before_sleep=_record_retry, **retry_policy())
+def _open_chat_stream(request):
+    """
+    Opens a streamed chat completion. Failures before the first chunk (connection errors, rate limits)
+    are retried like `get_chat_completions`; a stream that fails midway is not restarted.
+    """
+    with upstream_call('chat'):
+        return get_backend().chat_completion_stream(**request)
 
-    return output
 
+def stream_chat_completions(input, moderation_chars = DEFAULT_MODERATION_CHARS):
+    """
+    Streaming variant of `get_chat_completions` for text replies (stage 1 questions, stage 3 presentations).
+    Args:
+        input (list): List of conversation messages.
+        moderation_chars (int): The reply is moderated every `moderation_chars` characters (`None` disables it).
+    Returns:
+        ChatStream: Iterate over it for the text deltas. Afterwards `text` is the whole reply, `flagged` tells
+                    whether moderation stopped it and `ttft` is the time to the first token in seconds.
+    """
+    started = time.perf_counter()
+    chunks = _open_chat_stream(chat_completion_request(input))
+    moderate = (lambda text: moderation_check(text) == 'Flagged') if moderation_chars else None
+    return ChatStream(chunks, moderate, 'stage1.stream_chat_completions',
+                      moderation_chars = moderation_chars or DEFAULT_MODERATION_CHARS,
+                      on_finish = _record_usage, started = started)
 
 
+@traced('stage1.moderation_check')
+@call_deadline
 def moderation_check(user_input):
     """
-    Check user input for moderation flags using OpenAI's moderation API.
+    Check user input for moderation flags using the backend's moderation endpoint.
+    Short texts already checked (e.g. "yes") are answered from the backend's `ModerationCache`.
     Args:
         user_input (str): The user's input message.
     Returns:
         str: "Flagged" if input is inappropriate, otherwise "Not Flagged".
     """
-    response = openai.Moderation.create(input=user_input)
-    return "Flagged" if response.results[0].flagged else "Not Flagged"
+    backend = get_backend()
+    cache = get_moderation_cache(backend)
+    flagged = cache.get(user_input)
+    span_set(cache_hit=flagged is not None)
+    if flagged is None:
+        with upstream_call('moderation'):
+            response = backend.moderation(user_input)
+        flagged = response.results[0].flagged
+        cache.put(user_input, flagged)
+    return "Flagged" if flagged else "Not Flagged"
 
 
 
-def intent_confirmation_layer(response_assistant):
+def intent_confirmation_messages(response_assistant):
     """
-    Evaluate whether the user's intent is correctly captured in the assistant's response.
+    Build the messages that `intent_confirmation_layer` sends to evaluate the assistant's response.
     Args:
         response_assistant (str): The assistant's response containing user requirements.
     Returns:
-        dict: JSON result indicating if intent confirmation is successful.
+        list: The system and user messages of the evaluation prompt.
     """
+    messages=[{"role": "system", "content":intent_confirmation_prompt() },
+              {"role": "user", "content":f"""Here is the input: {response_assistant}""" }]
 
+    return messages
 
-    allowed_values = {'low','medium','high'}
+
+@functools.lru_cache(maxsize=None)
+def intent_confirmation_prompt():
+    """
+    Build the system prompt of `intent_confirmation_layer` (rendered once, as it does not depend on the input).
+    """
+
+    # A tuple rather than a set, so the prompt text is identical in every process
+    allowed_values = LEVELS
 
     prompt = f"""
     You are a senior evaluator who has an eye for detail.The input text will contain a user requirement captured through 6 keys.
@@ -211,63 +394,57 @@ def intent_confirmation_layer(response_assistant):
     Thought 2 - If the answer is No, mention the reason in the key 'reason'.
     THought 3 - Think carefully before the answering.
     """
+    return prompt
 
-    messages=[{"role": "system", "content":prompt },
-              {"role": "user", "content":f"""Here is the input: {response_assistant}""" }]
 
-    response = openai.chat.completions.create(
-                                    model="gpt-3.5-turbo",
-                                    messages = messages,
-                                    response_format={ "type": "json_object" },
-                                    seed = 1234
-                                    # n = 5
-                                    )
+def intent_confirmation_request(response_assistant):
+    """
+    Build the keyword arguments of the chat completion request made by `intent_confirmation_layer`.
+    """
+    return dict(model = MODEL,
+                messages = intent_confirmation_messages(response_assistant),
+                response_format = { "type": "json_object" },
+                seed = 1234)
+
+
+@traced('stage1.intent_confirmation_layer')
+@call_deadline
+def intent_confirmation_layer(response_assistant):
+    """
+    Evaluate whether the user's intent is correctly captured in the assistant's response.
+    Args:
+        response_assistant (str): The assistant's response containing user requirements.
+    Returns:
+        dict: JSON result indicating if intent confirmation is successful.
+    """
+
+    with upstream_call('chat'):
+        response = get_backend().chat_completion(**intent_confirmation_request(response_assistant))
 
+    _record_usage(response)
     json_output = json.loads(response.choices[0].message.content)
 
     return json_output
 
 
-def dictionary_present(response):
+def dictionary_present_messages(response):
     """
-    Extracts and validates if a Python dictionary is present in the chatbot's response. 
-    Ensures the dictionary format aligns with specific user profile requirements.
-
+    Build the messages that `dictionary_present` sends to extract the user profile dictionary.
     Args:
         response (str): The chatbot's response string that may or may not contain a Python dictionary.
-
     Returns:
-        dict or None: 
-            - A Python dictionary extracted from the response if it matches the specified format. 
-            - Returns `None` if no valid dictionary is found or if the extraction fails.
+        list: The system and user messages of the extraction prompt.
+    """
+    messages = [{"role": "system", "content":dictionary_present_prompt() },
+                {"role": "user", "content":f"""Here is the user input: {response}""" }]
 
-    Format Requirements:
-        The extracted dictionary must have the following keys and values:
-        - 'GPU intensity': A string with values 'low', 'medium', or 'high'.
-        - 'Display quality': A string with values 'low', 'medium', or 'high'.
-        - 'Portability': A string with values 'low', 'medium', or 'high'.
-        - 'Multitasking': A string with values 'low', 'medium', or 'high'.
-        - 'Processing speed': A string with values 'low', 'medium', or 'high'.
-        - 'Budget': A numerical value (can include currency symbols, e.g., '50000 INR').
+    return messages
 
-    Notes:
-        - The function relies on OpenAI-like completions to process the input.
-        - Budget values are cleaned to retain only numerical data (e.g., '50,000 INR' becomes '50000').
-        - If the input does not contain a valid dictionary, the function gracefully returns `None`.
 
-    Example:
-        Input:
-            response = "Here is your user profile: {'GPU intensity': 'high', 'Display quality': 'medium', 'Portability': 'low', 'Multitasking': 'high', 'Processing speed': 'high', 'Budget': '70000 INR'}"
-        
-        Output:
-            {
-                'GPU intensity': 'high',
-                'Display quality': 'medium',
-                'Portability': 'low',
-                'Multitasking': 'high',
-                'Processing speed': 'high',
-                'Budget': '70000'
-            }
+@functools.lru_cache(maxsize=None)
+def dictionary_present_prompt():
+    """
+    Build the system prompt of `dictionary_present` (rendered once, as it does not depend on the input).
     """
     delimiter = "####"
 
@@ -308,9 +485,117 @@ def dictionary_present(response):
             output 3: {{'GPU intensity': 'high','Display quality': 'high','Portability': 'medium','Multitasking': 'high','Processing speed': 'high','Budget': '200000'}}
             {delimiter}
             """
-    messages = [{"role": "system", "content":prompt },
-                {"role": "user", "content":f"""Here is the user input: {response}""" }]
+    return prompt
+
+
+@traced('stage1.dictionary_present')
+def dictionary_present(response):
+    """
+    Extracts and validates if a Python dictionary is present in the chatbot's response. 
+    Ensures the dictionary format aligns with specific user profile requirements.
+
+    Args:
+        response (str): The chatbot's response string that may or may not contain a Python dictionary.
+
+    Returns:
+        dict or None: 
+            - A Python dictionary extracted from the response if it matches the specified format. 
+            - Returns `None` if no valid dictionary is found or if the extraction fails.
+
+    Format Requirements:
+        The extracted dictionary must have the following keys and values:
+        - 'GPU intensity': A string with values 'low', 'medium', or 'high'.
+        - 'Display quality': A string with values 'low', 'medium', or 'high'.
+        - 'Portability': A string with values 'low', 'medium', or 'high'.
+        - 'Multitasking': A string with values 'low', 'medium', or 'high'.
+        - 'Processing speed': A string with values 'low', 'medium', or 'high'.
+        - 'Budget': A numerical value (can include currency symbols, e.g., '50000 INR').
+
+    Notes:
+        - The function relies on OpenAI-like completions to process the input.
+        - Budget values are cleaned to retain only numerical data (e.g., '50,000 INR' becomes '50000').
+        - If the input does not contain a valid dictionary, the function gracefully returns `None`.
+
+    Example:
+        Input:
+            response = "Here is your user profile: {'GPU intensity': 'high', 'Display quality': 'medium', 'Portability': 'low', 'Multitasking': 'high', 'Processing speed': 'high', 'Budget': '70000 INR'}"
+        
+        Output:
+            {
+                'GPU intensity': 'high',
+                'Display quality': 'medium',
+                'Portability': 'low',
+                'Multitasking': 'high',
+                'Processing speed': 'high',
+                'Budget': '70000'
+            }
+    """
+
+    messages = dictionary_present_messages(response)
 
     confirmation = get_chat_completions(messages, json_format = True)
 
-    return confirmation
\ No newline at end of file
+    return confirmation
+
+
+def local_profile_confirmation(response_assistant):
+    """
+    Confirm the user's intent and extract the profile without an LLM call, when the response is unambiguous.
+    Args:
+        response_assistant (str): The assistant's response.
+    Returns:
+        tuple[dict or None, dict or None]:
+            - ({'result': 'Yes'}, profile) if the response contains the complete six-key profile.
+            - ({'result': 'No', 'reason': ...}, None) if the response mentions none of the profile keys.
+            - (None, None) if the response is ambiguous and the LLM layers have to decide.
+    """
+    status, profile = extract_user_profile(response_assistant)
+
+    if status == PROFILE_COMPLETE:
+        with _API_USAGE_LOCK:
+            INTENT_STATS['local_confirmed'] += 1
+        return {'result': 'Yes'}, profile
+
+    if status == PROFILE_ABSENT:
+        with _API_USAGE_LOCK:
+            INTENT_STATS['local_rejected'] += 1
+        return {'result': 'No', 'reason': 'The response does not contain the user profile.'}, None
+
+    with _API_USAGE_LOCK:
+        INTENT_STATS['llm'] += 1
+    return None, None
+
+
+@traced('stage1.confirm_user_profile')
+def confirm_user_profile(response_assistant):
+    """
+    Confirms the user's intent and extracts the user profile in one step.
+
+    The response is parsed locally first (`local_profile_confirmation`); `intent_confirmation_layer` and
+    `dictionary_present` are only called when the local parse is ambiguous.
+
+    Args:
+        response_assistant (str): The assistant's response.
+
+    Returns:
+        tuple[dict, dict or None]: The intent confirmation ({'result': 'Yes'/'No', ...}) and, if confirmed,
+                                   the user profile in the format returned by `dictionary_present`.
+    """
+    confirmation, profile = local_profile_confirmation(response_assistant)
+    span_set(local=confirmation is not None)
+    if confirmation is not None:
+        return confirmation, profile
+
+    confirmation = intent_confirmation_layer(response_assistant)
+    if "No" in confirmation.get('result'):
+        return confirmation, None
+
+    return confirmation, dictionary_present(response_assistant)
+
+
+def get_intent_stats():
+    """
+    Returns a snapshot of how many responses were confirmed or rejected locally and how many needed the LLM.
+    """
+    with _API_USAGE_LOCK:
+        return dict(INTENT_STATS)
@@ -11,27 +11,295 @@ Stage 2 is responsible for:
 
 The key functions included in this module are:
 - `product_map_layer()`: Extracts key features from laptop descriptions and maps them to user-defined categories such as GPU Intensity, Display Quality, Portability, Multitasking, Processing Speed, and Budget.
+- `get_catalogue()`: Loads the laptop catalogue into memory once per process, memory-mapping the binary
+  catalogue (`updated_laptop.npcat`, see `shopassist.services.catalogue_store`) when it is up to date.
+- `write_catalogue_snapshot()`: Saves a catalogue parsed from the CSV as the binary catalogue
+  (`SHOPASSIST_CATALOGUE_SNAPSHOT=1` does it on load), so later processes start without parsing the CSV.
+- `get_catalogue_status()`: Whether the catalogue is loaded, its size and source, and whether it is up to date.
+- `get_profile_table()`: The optional precomputed ranking of the catalogue for all 243 profiles
+  (`SHOPASSIST_PROFILE_TABLE=lazy|eager`, or `set_profile_table_mode()`).
+- `select_laptops_for_user()`: The rows and scores of the top laptops, for callers that keep their ids.
 - `compare_laptops_with_user()`: Compares the extracted features of laptops with the user's requirements and identifies the top 3 recommendations.
 - `recommendation_validation()`: Validates the recommendations by ensuring they meet the user's minimum requirements.
+- `get_feature_parse_stats()`: Reports how many stored `laptop_feature` values were parsed locally and how many needed the LLM fallback.
 
 This module interacts with the user requirements dictionary generated in Stage 1, processes the dataset of laptops, and outputs validated recommendations for use in the next stage.
 
 Dependencies:
-- pandas: For data manipulation and filtering.
+- shopassist.services.catalogue: For the in-memory, vectorised laptop catalogue.
+- shopassist.services.catalogue_store: For the memory-mapped binary catalogue.
+- shopassist.services.profile_table: For the precomputed per-profile rankings.
 - json: For handling and formatting JSON objects.
 """
 
 
-import pandas as pd
 import os
 import json
+import time
+import logging
+from shopassist.services.catalogue import LaptopCatalogue
+from shopassist.services.catalogue_store import META_FILE, binary_path, read_binary_catalogue, write_binary_catalogue
+from shopassist.services.profile_table import ProfileRankingTable
 from shopassist.services.stage1 import dictionary_present
+from shopassist.utils.features import parse_laptop_feature
+from shopassist.utils.tracing import traced, span_set
 
 
 UPDATED_DATA_PATH = os.path.join('data', 'updated_laptop.csv')
 
+logger = logging.getLogger(__name__)
 
-def compare_laptops_with_user(user_req_dict):
+# Counters for the stored `laptop_feature` values parsed while loading the catalogue
+FEATURE_PARSE_STATS = {'parsed': 0, 'llm_fallback': 0, 'unparsed': 0}
+
+# Catalogues already loaded in this process, keyed by absolute file path, with the file signature they were read from
+_CATALOGUES = {}
+
+PROFILE_TABLE_ENV_VAR = 'SHOPASSIST_PROFILE_TABLE'
+
+# When set, a catalogue parsed from the CSV is saved as the binary catalogue next to it, so the next process to
+# start memory-maps it in milliseconds instead of parsing the CSV
+CATALOGUE_SNAPSHOT_ENV_VAR = 'SHOPASSIST_CATALOGUE_SNAPSHOT'
+WRITE_CATALOGUE_SNAPSHOT = os.environ.get(CATALOGUE_SNAPSHOT_ENV_VAR, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+# 'off': score every request; 'lazy': rank each profile on its first request; 'eager': rank all 243 after loading
+PROFILE_TABLE_MODES = ('off', 'lazy', 'eager')
+PROFILE_TABLE_MODE = os.environ.get(PROFILE_TABLE_ENV_VAR, 'off').strip().lower() or 'off'
+
+# Profile tables, keyed like `_CATALOGUES`
+_PROFILE_TABLES = {}
+
+
+def parse_stored_features(laptop_feature):
+    """
+    Converts a stored `laptop_feature` value into a feature dictionary.
+
+    The value is parsed locally first. Only rows that the local parser rejects are sent to
+    `dictionary_present`, and every such fallback is counted in `FEATURE_PARSE_STATS`.
+
+    Args:
+        laptop_feature (str): The `laptop_feature` value of a row in `updated_laptop.csv`.
+
+    Returns:
+        dict: The laptop's features. Empty if neither the local parser nor the LLM could recover them.
+    """
+    laptop_values = parse_laptop_feature(laptop_feature)
+    if laptop_values is not None:
+        FEATURE_PARSE_STATS['parsed'] += 1
+        return laptop_values
+
+    FEATURE_PARSE_STATS['llm_fallback'] += 1
+    logger.warning("Falling back to the LLM for laptop_feature value: %r", laptop_feature)
+    response = dictionary_present(laptop_feature)
+    laptop_values = parse_laptop_feature(response)
+    if laptop_values is None:
+        FEATURE_PARSE_STATS['unparsed'] += 1
+        return response if isinstance(response, dict) else {}
+    return laptop_values
+
+
+def get_feature_parse_stats():
+    """
+    Returns a copy of the `laptop_feature` parse counters.
+
+    Returns:
+        dict: Number of values parsed locally (`parsed`), sent to the LLM (`llm_fallback`)
+              and not recovered even by the LLM (`unparsed`).
+    """
+    return dict(FEATURE_PARSE_STATS)
+
+
+def _catalogue_source(path):
+    """
+    Chooses the file to load a catalogue from: the binary catalogue next to `path` if it is at least as new as the
+    CSV (or the CSV is missing), otherwise the CSV.
+
+    Returns:
+        tuple[bool, tuple]: Whether the binary catalogue is used, and the signature of the file it is read from.
+    """
+    meta_path = os.path.join(binary_path(path), META_FILE)
+    try:
+        meta_stat = os.stat(meta_path)
+    except FileNotFoundError:
+        meta_stat = None
+    try:
+        csv_stat = os.stat(path)
+    except FileNotFoundError:
+        if meta_stat is None:
+            raise
+        csv_stat = None
+
+    binary = meta_stat is not None and (csv_stat is None or meta_stat.st_mtime_ns >= csv_stat.st_mtime_ns)
+    stat = meta_stat if binary else csv_stat
+    return binary, (binary, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+@traced('stage2.get_catalogue')
+def get_catalogue(path=UPDATED_DATA_PATH, reload=False):
+    """
+    Returns the in-memory laptop catalogue, loading it on first use.
+
+    The catalogue is parsed once per process and per path; later calls return the same object
+    until the file is replaced (e.g. by an incremental refresh), in which case it is loaded again.
+    If `create_laptop_feature.py --binary` wrote the binary catalogue next to the CSV and it is up to date,
+    it is memory-mapped instead of parsing the CSV. With `SHOPASSIST_CATALOGUE_SNAPSHOT=1`, a catalogue parsed
+    from the CSV is written as the binary catalogue (see `write_catalogue_snapshot`), so only the first start after
+    the CSV changes parses it.
+
+    Args:
+        path (str): Path of the enriched dataset. Defaults to `updated_laptop.csv`.
+        reload (bool): Re-read the file even if it was already loaded.
+
+    Returns:
+        LaptopCatalogue: The parsed catalogue.
+    """
+    key = os.path.abspath(path)
+    binary, signature = _catalogue_source(path)
+
+    cached = not reload and key in _CATALOGUES and _CATALOGUES[key][0] == signature
+    span_set(cache_hit=cached, binary=binary)
+    if not cached:
+        llm_fallbacks = FEATURE_PARSE_STATS['llm_fallback']
+        if binary:
+            catalogue = read_binary_catalogue(binary_path(path))
+        else:
+            catalogue = LaptopCatalogue.from_csv(path, feature_parser=parse_stored_features)
+            if WRITE_CATALOGUE_SNAPSHOT:
+                catalogue, signature = write_catalogue_snapshot(path, catalogue, signature)
+        _CATALOGUES[key] = (signature, catalogue)
+        llm_fallbacks = FEATURE_PARSE_STATS['llm_fallback'] - llm_fallbacks
+        if llm_fallbacks:
+            logger.warning("%d of %d laptop_feature values needed the LLM fallback", llm_fallbacks, len(catalogue))
+    return _CATALOGUES[key][1]
+
+
+def write_catalogue_snapshot(path, catalogue, signature):
+    """
+    Writes a catalogue parsed from the CSV as the binary catalogue next to it, and memory-maps it back, so this
+    process shares the pages of the snapshot (e.g. with its forked workers) like a later process would.
+
+    Nothing is written if an up-to-date snapshot already exists (e.g. another replica wrote it while this one was
+    parsing the CSV); it is loaded instead. A snapshot that cannot be written (e.g. a read-only data directory) is
+    only logged.
+
+    Args:
+        path (str): Path of the CSV.
+        catalogue (LaptopCatalogue): The catalogue parsed from it.
+        signature (tuple): The CSV's signature (see `_catalogue_source`).
+
+    Returns:
+        tuple[LaptopCatalogue, tuple]: The catalogue to use and the signature of the file it now comes from.
+    """
+    try:
+        start = time.perf_counter()
+        binary, snapshot_signature = _catalogue_source(path)
+        if binary:
+            return read_binary_catalogue(binary_path(path)), snapshot_signature
+        write_binary_catalogue(catalogue, binary_path(path))
+        binary, snapshot_signature = _catalogue_source(path)
+        if not binary:
+            return catalogue, signature
+        snapshot = read_binary_catalogue(binary_path(path))
+    except OSError as error:
+        logger.warning("Could not write the catalogue snapshot %s: %s", binary_path(path), error)
+        return catalogue, signature
+    logger.info("Catalogue snapshot written to %s in %.3f s", binary_path(path), time.perf_counter() - start)
+    return snapshot, snapshot_signature
+
+
+def get_catalogue_status(path=UPDATED_DATA_PATH):
+    """
+    Reports the state of a catalogue in this process, without loading it.
+
+    Returns:
+        dict: The path, whether it is loaded, its number of laptops, whether it was read from the binary catalogue,
+              and whether it still matches the files on disk (`up_to_date`; `None` if the files are missing).
+    """
+    key = os.path.abspath(path)
+    status = {'path': path, 'loaded': key in _CATALOGUES, 'rows': None, 'binary': None, 'up_to_date': None}
+    if key in _CATALOGUES:
+        signature, catalogue = _CATALOGUES[key]
+        status.update(rows=len(catalogue), binary=signature[0])
+        try:
+            status['up_to_date'] = _catalogue_source(path)[1] == signature
+        except FileNotFoundError:
+            pass
+    return status
+
+
+def set_profile_table_mode(mode):
+    """
+    Turns the precomputed profile table on or off.
+
+    Args:
+        mode (str): 'off', 'lazy' or 'eager'.
+
+    Returns:
+        str: The previous mode.
+    """
+    global PROFILE_TABLE_MODE
+    if mode not in PROFILE_TABLE_MODES:
+        raise ValueError("Unknown profile table mode {0!r}; expected one of {1}".format(mode, PROFILE_TABLE_MODES))
+    previous, PROFILE_TABLE_MODE = PROFILE_TABLE_MODE, mode
+    return previous
+
+
+@traced('stage2.get_profile_table')
+def get_profile_table(path=UPDATED_DATA_PATH, eager=None, catalogue=None):
+    """
+    Returns the precomputed profile table of the catalogue, building it after the catalogue is loaded.
+
+    When the catalogue file changes, the table is rebuilt for the new catalogue, re-ranking only the profiles
+    that had been requested (see `ProfileRankingTable.rebuild`).
+
+    Args:
+        path (str): Path of the enriched dataset. Defaults to `updated_laptop.csv`.
+        eager (bool, optional): Rank all 243 profiles now. Defaults to `PROFILE_TABLE_MODE == 'eager'`.
+        catalogue (LaptopCatalogue, optional): The catalogue the caller already holds (from `get_catalogue(path)`),
+                                               instead of reading it again. The table is only switched to it if it
+                                               is still the loaded catalogue of `path`.
+
+    Returns:
+        ProfileRankingTable: The table.
+    """
+    eager = PROFILE_TABLE_MODE == 'eager' if eager is None else eager
+    catalogue = get_catalogue(path) if catalogue is None else catalogue
+    key = os.path.abspath(path)
+
+    table = _PROFILE_TABLES.get(key)
+    if table is None:
+        table = _PROFILE_TABLES[key] = ProfileRankingTable(catalogue, eager=eager)
+        logger.info("Profile table built: %s", table.memory_usage())
+    elif table.catalogue is not catalogue and _CATALOGUES.get(key, (None, None))[1] is catalogue:
+        table.rebuild(catalogue)
+        if eager:
+            table.build()
+        logger.info("Profile table rebuilt: %s", table.memory_usage())
+    return table
+
+
+def select_laptops_for_user(user_req_dict, k=3, min_price=None, brands=None):
+    """
+    Selects the top laptops for the user's requirements, as `compare_laptops_with_user` does, without
+    serialising them.
+
+    Returns:
+        tuple[LaptopCatalogue, np.ndarray, np.ndarray]: The catalogue the laptops were selected from, their rows
+                                                        in it and their scores, best first.
+    """
+    # The catalogue is read once: the rows are selected from, and returned with, the same catalogue even if the
+    # file is refreshed meanwhile
+    catalogue = get_catalogue()
+    if PROFILE_TABLE_MODE == 'off':
+        top_laptops, scores = catalogue.top_k(user_req_dict, k=k, min_price=min_price, brands=brands)
+    else:
+        top_laptops, scores = get_profile_table(catalogue=catalogue).top_k(
+            user_req_dict, k=k, min_price=min_price, brands=brands, catalogue=catalogue)
+    return catalogue, top_laptops, scores
+
+
+@traced('stage2.compare_laptops_with_user')
+def compare_laptops_with_user(user_req_dict, k=3, min_price=None, brands=None):
     """
     Compares user requirements with a dataset of laptops and recommends the top 3 laptops based on feature matching.
 
@@ -41,70 +309,36 @@ def compare_laptops_with_user(user_req_dict):
     Args:
         user_req_dict (dict): A dictionary containing the user's requirements, 
                                such as budget and feature preferences.
+        k (int): Number of laptops to recommend.
+        min_price (int, optional): Only recommend laptops costing at least this much.
+        brands (iterable of str, optional): Only recommend laptops of these brands (case-insensitive).
 
     Returns:
         str: A JSON-formatted string containing the top 3 laptop recommendations. 
              Each recommendation includes laptop details and a score indicating how well it matches the user's needs.
 
     Process:
-        1. Reads the laptop dataset from a CSV file (`updated_laptop.csv`).
+        1. Loads the in-memory laptop catalogue (`updated_laptop.csv` is read only once per process).
         2. Extracts and cleans the user's budget from the input dictionary.
-        3. Filters laptops within the user's budget.
-        4. Matches user requirements with laptop features (stored in the `laptop_feature` column).
-        5. Calculates a score for each laptop based on how well it matches the user's requirements.
-        6. Sorts laptops by score in descending order and selects the top 3 recommendations.
+        3. Filters laptops within the user's budget (and above `min_price`) with a binary search of the price index.
+        4. Matches user requirements with laptop features (stored in the `laptop_feature` column),
+           pre-encoded as a matrix of levels when the catalogue is loaded.
+        5. Calculates a score for each laptop based on how well it matches the user's requirements,
+           starting from the laptops closest to the budget and stopping once the best `k` are certain.
+           With the profile table enabled, the profile's precomputed ranking is cut at the budget instead.
+        6. Selects the top 3 recommendations by score in descending order (ties go to the laptop priced
+           closest to the budget, then to catalogue order).
         7. Returns the recommendations as a JSON-formatted string.
     """
 
-    laptop_df = pd.read_csv(UPDATED_DATA_PATH)
-
-    # Extracting user requirements from the input string (assuming it's a dictionary)
-
-    # Extracting the budget value from user_requirements and converting it to an integer
-    budget = int(user_req_dict.get('Budget', '0').replace(',', '').split()[0])
-    # budget
-    # # Creating a copy of the DataFrame and filtering laptops based on the budget
-    filtered_laptops = laptop_df.copy()
-    filtered_laptops['Price'] = filtered_laptops['Price'].str.replace(',', '').astype(int)
-    filtered_laptops = filtered_laptops[filtered_laptops['Price'] <= budget].copy()
-    # filtered_laptops
-    # # # Mapping string values 'low', 'medium', 'high' to numerical scores 0, 1, 2
-    mappings = {'low': 0, 'medium': 1, 'high': 2}
-
-    # # # Creating a new column 'Score' in the filtered DataFrame and initializing it to 0
-    filtered_laptops['Score'] = 0
-
-    # # # Iterating over each laptop in the filtered DataFrame to calculate scores based on user requirements
-    for index, row in filtered_laptops.iterrows():
-        user_product_match_str = row['laptop_feature']
-        laptop_values = user_product_match_str
-        laptop_values = dictionary_present(user_product_match_str)
-        score = 0
-
-    #     # Comparing user requirements with laptop features and updating scores
-        for key, user_value in user_req_dict.items():
-            # if key.lower() == 'budget':
-            if key == 'Budget':
-                continue  # Skipping budget comparison
-            laptop_value = laptop_values.get(key, None)
-            # print(key, laptop_value)
-            laptop_mapping = mappings.get(laptop_value, -1)
-            user_mapping = mappings.get(user_value, -1)
-            if laptop_mapping >= user_mapping:
-                score += 1  # Incrementing score if laptop value meets or exceeds user value
-
-        filtered_laptops.loc[index, 'Score'] = score  # Updating the 'Score' column in the DataFrame
-
-    # Sorting laptops by score in descending order and selecting the top 3 products
-    top_laptops = filtered_laptops.drop('laptop_feature', axis=1)
-    top_laptops = top_laptops.sort_values('Score', ascending=False).head(3)
-    top_laptops_json = top_laptops.to_json(orient='records')  # Converting the top laptops DataFrame to JSON format
-
-    # top_laptops
+    catalogue, top_laptops, scores = select_laptops_for_user(user_req_dict, k=k, min_price=min_price, brands=brands)
+    top_laptops_json = catalogue.to_json(top_laptops, scores)  # Converting the top laptops to JSON format
+
     return top_laptops_json
 
 
 
+@traced('stage2.recommendation_validation')
 def recommendation_validation(laptop_recommendation):
     """
     Validates the laptop recommendations by filtering those that meet a minimum score threshold.
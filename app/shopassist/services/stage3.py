@@ -9,19 +9,95 @@ Stage 3 is responsible for:
 2. Initializing a conversation context that leverages the recommendations to interact with the user.
 3. Supporting user queries about the recommended products based on their profile and preferences.
 
-The key function included in this module is:
+The key functions included in this module are:
+- `presentation_system_prompt()`: The system message of the opening presentation, rendered once.
 - `initialize_conv_reco()`: Initializes the conversation with system-level guidelines and presents the top recommendations in a user-friendly format.
+- `presentation_key()`: The cache key of an opening presentation: the recommended laptops and the normalised profile.
+- `PresentationCache`: An in-memory cache of opening presentations with a time-to-live, least-recently-used
+  eviction and hit/miss counters (`get_presentation_cache()` returns the one shared by the process).
+- `initialize_conv_followup()`: The context of the follow-up questions: the names and prices of the recommended
+  laptops and the user profile, without their full records.
+- `get_spec_index()`: The BM25 statistics of the catalogue's spec and description snippets
+  (`shopassist.utils.retrieval.SpecIndex`), computed once per catalogue.
+- `spec_context_message()`: The snippets of the recommended laptops relevant to a follow-up question, as a message.
+- `answer_from_specs()`: Answers "which one is the lightest?"-style questions from the product columns, without the LLM.
+
+Many shoppers end up with the same validated recommendations and near-identical profiles, and the opening
+presentation ("1. <Laptop Name> : <specs>, <Price>") then only depends on those. The cache key is built from the
+full catalogue row of every recommended laptop (in any order) and the six profile keys (levels in lower case,
+budget rounded down to `PRESENTATION_BUDGET_STEP`), together with the model and the prompt. A catalogue refresh
+that changes any column of a recommended laptop (e.g. its price) therefore changes the key, so a presentation is
+never served for data it was not generated from; entries for rows that changed are no longer reachable and age out.
+Only presentations that passed moderation are stored.
+
+Follow-up questions do not resend the full records: `initialize_conv_followup()` only lists the laptops, and each
+question is sent with the few spec and description snippets that match it (`spec_context_message()`, ranked with
+BM25 over snippets of the whole catalogue), or with the laptops' spec lines when nothing matches.
 
 This stage builds upon the output from Stage 2 (validated recommendations) and prepares a chatbot interface to provide interactive and personalized assistance to the user.
 
 Dependencies:
 - json: For handling and passing product data in a structured format.
+- shopassist.utils.cache: For the content-addressed cache keys.
 
 Usage:
 - Call `initialize_conv_reco()` with the top 3 laptop recommendations as input to create a conversational context for user interaction.
+- Look the presentation up with `get_presentation_cache().get(presentation_key(validated_reco, user_profile))` before
+  generating it, and `put()` it afterwards.
 """
 
 
+import os
+import json
+import time
+import functools
+import threading
+import collections
+from shopassist.services import stage2
+from shopassist.services.catalogue import parse_budget
+from shopassist.services.stage1 import MODEL
+from shopassist.utils.cache import content_key
+from shopassist.utils.features import FEATURE_KEYS
+from shopassist.utils.retrieval import SpecIndex, answer_superlative, laptop_name, spec_snippets
+from shopassist.utils.tracing import traced, span_set
+
+
+PRESENTATION_CACHE_TTL = 3600.0
+PRESENTATION_CACHE_MAX_ENTRIES = 1024
+
+# Budgets are rounded down to this step in the cache key; the presentation does not depend on the exact amount
+PRESENTATION_BUDGET_STEP = 5000
+
+# Snippets of each recommended laptop sent with a follow-up question
+FOLLOWUP_SNIPPETS_PER_LAPTOP = 4
+
+# Spec indexes, keyed by the path of the catalogue, with the catalogue they were computed for
+_SPEC_INDEXES = {}
+_SPEC_INDEX_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def presentation_system_prompt():
+    """
+    Build the system message of the opening presentation (rendered once, as it does not depend on the input).
+
+    Returns:
+        str: The system message.
+    """
+    system_message = """
+    You are an intelligent laptop gadget expert and you are tasked with the objective to \
+    solve the user queries about any product from the catalogue in the user message \
+    You should keep the user profile in mind while answering the questions.\
+
+    Start with a brief summary of each laptop in the following format, in decreasing order of price of laptops:
+    1. <Laptop Name> : <Major specifications of the laptop>, <Price in Rs>
+    2. <Laptop Name> : <Major specifications of the laptop>, <Price in Rs>
+
+    """
+    return system_message
+
+
+@traced('stage3.initialize_conv_reco')
 def initialize_conv_reco(products):
     """
     Initializes a conversation context for presenting laptop recommendations to the user.
@@ -39,18 +115,226 @@ def initialize_conv_reco(products):
         list[dict]: A list of dictionaries representing the conversation initialization.
                     Each dictionary contains the role (`system` or `user`) and the corresponding content.
     """
+    user_message = f""" These are the user's products: {products}"""
+    conversation = [{"role": "system", "content": presentation_system_prompt()},
+                    {"role":"user","content":user_message}]
+    
+    return conversation
+
+
+@traced('stage3.initialize_conv_followup')
+def initialize_conv_followup(products, user_profile):
+    """
+    Initializes the context of the follow-up questions about the recommended laptops.
+
+    Unlike `initialize_conv_reco`, the laptops are only listed by name and price; the details relevant to each
+    question are sent with it (`spec_context_message`).
+
+    Args:
+        products (list[dict]): The validated recommendations.
+        user_profile (dict): The user profile.
+
+    Returns:
+        list[dict]: The system message, the list of laptops and the user profile.
+    """
     system_message = """
-    You are an intelligent laptop gadget expert and you are tasked with the objective to \
-    solve the user queries about any product from the catalogue in the user message \
-    You should keep the user profile in mind while answering the questions.\
+    You are an intelligent laptop gadget expert. You recommended the laptops in the user message to the user \
+    and you now answer their questions about them, keeping the user profile in mind. \
+    The details of the laptops that are relevant to a question are given just before it.
+    """
+    laptops = '\n'.join('{0}. {1} (Price: {2})'.format(number, laptop_name(product),
+                                                        '{0:,}'.format(product['Price'])
+                                                        if isinstance(product.get('Price'), int) else product.get('Price'))
+                        for number, product in enumerate(products, start=1))
+    return [{"role": "system", "content": system_message},
+            {"role": "user", "content": "These are the recommended laptops:\n" + laptops},
+            {"role": "user", "content": "This is my user profile" + str(user_profile)}]
 
-    Start with a brief summary of each laptop in the following format, in decreasing order of price of laptops:
-    1. <Laptop Name> : <Major specifications of the laptop>, <Price in Rs>
-    2. <Laptop Name> : <Major specifications of the laptop>, <Price in Rs>
 
+def get_spec_index(path=stage2.UPDATED_DATA_PATH):
     """
-    user_message = f""" These are the user's products: {products}"""
-    conversation = [{"role": "system", "content": system_message },
-                    {"role":"user","content":user_message}]
-    
-    return conversation
\ No newline at end of file
+    Returns the BM25 statistics of the catalogue, computed once per catalogue (and again when the file changes).
+
+    Returns:
+        SpecIndex: The index.
+    """
+    catalogue = stage2.get_catalogue(path)
+    key = os.path.abspath(path)
+    with _SPEC_INDEX_LOCK:
+        entry = _SPEC_INDEXES.get(key)
+        if entry is None or entry[0] is not catalogue:
+            entry = _SPEC_INDEXES[key] = (catalogue, SpecIndex(catalogue.records, catalogue.columns))
+    return entry[1]
+
+
+@traced('stage3.spec_context_message')
+def spec_context_message(question, products, index=None, per_laptop=FOLLOWUP_SNIPPETS_PER_LAPTOP):
+    """
+    Builds the message carrying the details of the recommended laptops that are relevant to a follow-up question.
+
+    Args:
+        question (str): The user's question.
+        products (list[dict]): The validated recommendations.
+        index (SpecIndex, optional): Defaults to `get_spec_index()`.
+        per_laptop (int): Maximum number of snippets per laptop.
+
+    Returns:
+        dict: A system message with the best matching snippets of every laptop. When no snippet matches the
+              question (e.g. "tell me more about the first one"), it holds every spec line of the laptops instead.
+    """
+    index = index if index is not None else get_spec_index()
+    matches = index.search(question, products, per_laptop=per_laptop)
+    retrieved = any(matches)
+    if not retrieved:
+        matches = [[(0, snippet) for snippet in spec_snippets(product)] for product in products]
+    span_set(snippets=sum(len(snippets) for snippets in matches), retrieved=retrieved)
+    lines = ['- {0}: {1}'.format(laptop_name(product), '; '.join(snippet for _, snippet in snippets))
+             for product, snippets in zip(products, matches) if snippets]
+    return {"role": "system",
+            "content": "Details of the recommended laptops relevant to the next question:\n" + '\n'.join(lines)}
+
+
+def answer_from_specs(question, products):
+    """
+    Answers a follow-up question that only asks which recommended laptop is the lightest, cheapest, etc.
+    See `shopassist.utils.retrieval.answer_superlative`.
+
+    Returns:
+        str or None: The answer, or `None` if the question needs the LLM.
+    """
+    return answer_superlative(question, products)
+
+
+def presentation_key(products, user_profile, budget_step=PRESENTATION_BUDGET_STEP):
+    """
+    Builds the cache key of the opening presentation of a set of recommendations.
+
+    The presentation prompt sends the user profile along with the laptops (`dialogue.recommendation_prompt`), and the
+    system prompt asks the model to keep it in mind, so the normalised profile is part of the key: a shopper who asked
+    for portability is not served a presentation written for a gaming profile. The budget is rounded, as the exact
+    amount rarely changes the text.
+
+    Args:
+        products (list[dict]): The validated recommendations (`recommendation_validation()`), in any order.
+        user_profile (dict): The user's six-key profile.
+        budget_step (int): The budget is rounded down to a multiple of this amount.
+
+    Returns:
+        str: A key built with `content_key`.
+    """
+    # Every column of every laptop except its score, which is derived from the profile
+    laptops = sorted(json.dumps({name: value for name, value in product.items() if name != 'Score'},
+                                sort_keys=True, default=str)
+                     for product in products)
+    profile = [str(user_profile.get(key, '')).strip().lower() for key in FEATURE_KEYS]
+    budget = parse_budget(user_profile)
+    if budget_step:
+        budget -= budget % budget_step
+    return content_key(MODEL, presentation_system_prompt(), json.dumps(laptops), json.dumps(profile), budget)
+
+
+class PresentationCache:
+    """
+    An in-memory, thread-safe cache of stage 3 opening presentations.
+
+    Entries expire `ttl` seconds after they were stored; beyond `max_entries`, the least recently used entries are
+    evicted. `max_entries=0` disables the cache.
+
+    Attributes:
+        hits (int): Number of lookups answered from the cache.
+        misses (int): Number of lookups that found nothing (including expired entries).
+        evictions (int): Number of entries evicted to respect `max_entries`.
+        expirations (int): Number of entries dropped because they outlived `ttl`.
+    """
+
+    def __init__(self, ttl=PRESENTATION_CACHE_TTL, max_entries=PRESENTATION_CACHE_MAX_ENTRIES):
+        """
+        Args:
+            ttl (float): Seconds an entry stays valid.
+            max_entries (int): Maximum number of entries kept.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @traced('stage3.presentation_cache')
+    def get(self, key):
+        """
+        Looks up a presentation and marks it as recently used.
+
+        Args:
+            key (str): A key built with `presentation_key`.
+
+        Returns:
+            str or None: The presentation, or `None` on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        span_set(cache_hit=entry is not None)
+        return None if entry is None else entry[1]
+
+    def put(self, key, presentation):
+        """
+        Stores a presentation, evicting the least recently used entries if the cache is over its bound.
+
+        Args:
+            key (str): A key built with `presentation_key`.
+            presentation (str): The moderated presentation.
+        """
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, presentation)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Drops every entry (e.g. after the prompt or the catalogue format changed). The counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: Hits, misses, hit rate, evictions, expirations and current number of entries.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self)}
+
+
+_PRESENTATION_CACHE = PresentationCache()
+
+
+def get_presentation_cache():
+    """
+    Returns the presentation cache shared by the process.
+    """
+    return _PRESENTATION_CACHE
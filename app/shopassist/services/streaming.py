@@ -0,0 +1,269 @@
+"""
+streaming.py
+============
+
+Streamed chat completions with incremental output moderation.
+
+A complete stage 1 follow-up question or stage 3 presentation takes seconds to generate, and without streaming
+the user sees nothing until the last token has arrived. The streams in this module yield the text as the backend
+generates it, so a frontend can render it incrementally, and moderate it on the way:
+- Every `moderation_chars` characters, the new text (plus the last `MODERATION_OVERLAP_CHARS` characters before
+  it, so a flagged phrase split across two segments is still seen whole) is sent to the moderation endpoint.
+- Moderation runs alongside the stream instead of pausing it. As soon as a segment is flagged the stream stops
+  and `flagged` is set; the text shown so far is at most one segment (plus one moderation round trip) ahead of
+  the moderation, and a frontend should replace it with the flagged message.
+- When the completion ends, the remaining text is moderated and the stream waits for all pending checks, so a
+  fully consumed stream has been moderated exactly like a complete reply.
+
+After iteration, `text` holds the whole reply for the conversation history, `ttft` the time to the first token
+and `duration` the total time. Both are also recorded as tracing spans (`<name>` and `<name>.ttft`).
+
+Key Components:
+- `ChatStream`: Iterates over the text deltas of a blocking stream (`stage1.stream_chat_completions`).
+- `AsyncChatStream`: Async counterpart (`DialogueEngine.stream_chat_completions`).
+"""
+
+
+import time
+import asyncio
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from shopassist.utils.tracing import record_span
+
+
+DEFAULT_MODERATION_CHARS = 400
+
+# Characters of already moderated text resent with every segment
+MODERATION_OVERLAP_CHARS = 100
+
+MODERATION_WORKERS = 8
+
+_MODERATION_POOL = None
+_MODERATION_POOL_LOCK = threading.Lock()
+
+
+def _moderation_pool():
+    """
+    Returns the thread pool running the moderation of blocking streams, created on first use.
+    """
+    global _MODERATION_POOL
+    with _MODERATION_POOL_LOCK:
+        if _MODERATION_POOL is None:
+            _MODERATION_POOL = ThreadPoolExecutor(max_workers=MODERATION_WORKERS,
+                                                  thread_name_prefix='shopassist-moderation')
+    return _MODERATION_POOL
+
+
+def chunk_content(chunk):
+    """
+    Returns the text delta of a streamed chunk ('' for chunks without content, such as the final usage chunk).
+    """
+    choices = getattr(chunk, 'choices', None)
+    if not choices:
+        return ''
+    return getattr(choices[0].delta, 'content', None) or ''
+
+
+class _StreamBase:
+    """
+    The state shared by the blocking and the async stream: the text so far, timings, usage and moderation segments.
+    """
+
+    def __init__(self, chunks, moderate, name, moderation_chars=DEFAULT_MODERATION_CHARS, on_finish=None,
+                 started=None):
+        """
+        Args:
+            chunks (iterable or async iterable): The chunks returned by the backend.
+            moderate (callable): `moderate(text)` returning `True` if the text is flagged (a coroutine function
+                                 for `AsyncChatStream`). `None` disables moderation.
+            name (str): Name of the tracing spans.
+            moderation_chars (int): Number of new characters after which the text is moderated.
+            on_finish (callable, optional): Called with the stream once the backend reported the usage
+                                            (e.g. `stage1._record_usage`).
+            started (float, optional): `time.perf_counter()` when the request was sent. Defaults to now.
+        """
+        self._chunks = chunks
+        self._moderate = moderate
+        self.name = name
+        self.moderation_chars = moderation_chars
+        self._on_finish = on_finish
+        self._started = time.perf_counter() if started is None else started
+
+        self._parts = []
+        self._length = 0
+        self._checked = 0
+        self.model = None
+        self.usage = None
+        self.flagged = False
+        self.finished = False
+        self.ttft = None
+        self.duration = None
+        self.moderation_calls = 0
+
+    @property
+    def text(self):
+        """
+        The text received so far (the whole reply once the stream is exhausted).
+        """
+        return ''.join(self._parts)
+
+    def _add(self, chunk):
+        """
+        Records a chunk and returns its text delta.
+        """
+        self.model = getattr(chunk, 'model', None) or self.model
+        if getattr(chunk, 'usage', None) is not None:
+            self.usage = chunk.usage
+        delta = chunk_content(chunk)
+        if delta:
+            if self.ttft is None:
+                self.ttft = time.perf_counter() - self._started
+            self._parts.append(delta)
+            self._length += len(delta)
+        return delta
+
+    def _segment(self, final=False):
+        """
+        Returns the next text to moderate, or `None` if fewer than `moderation_chars` new characters arrived
+        (any new characters at all if `final`).
+        """
+        if self._moderate is None:
+            return None
+        new_chars = self._length - self._checked
+        if new_chars <= 0 or (new_chars < self.moderation_chars and not final):
+            return None
+        segment = self.text[max(0, self._checked - MODERATION_OVERLAP_CHARS):]
+        self._checked = self._length
+        self.moderation_calls += 1
+        return segment
+
+    def _finish(self, error=None):
+        self.finished = True
+        self.duration = time.perf_counter() - self._started
+        record_span(self.name, self.duration, error, flagged=self.flagged, moderation_calls=self.moderation_calls)
+        if self.ttft is not None:
+            record_span(self.name + '.ttft', self.ttft)
+        if self.usage is not None and self._on_finish is not None:
+            self._on_finish(self)
+
+
+class ChatStream(_StreamBase):
+    """
+    A streamed chat completion. Iterating yields the text deltas; moderation runs in a thread pool.
+
+    Usage:
+        stream = stream_chat_completions(conversation.messages())
+        for delta in stream:
+            print(delta, end='', flush=True)
+        if not stream.flagged:
+            conversation.append({"role": "assistant", "content": stream.text})
+    """
+
+    def __iter__(self):
+        pending = []
+        error = None
+        try:
+            for chunk in self._chunks:
+                delta = self._add(chunk)
+                segment = self._segment()
+                if segment is not None:
+                    pending.append(_moderation_pool().submit(self._moderate, segment))
+                pending = self._check(pending)
+                if self.flagged:
+                    return
+                if delta:
+                    yield delta
+
+            segment = self._segment(final=True)
+            if segment is not None:
+                pending.append(_moderation_pool().submit(self._moderate, segment))
+            self.flagged = any([future.result() for future in pending])
+        except BaseException as exception:
+            error = exception
+            raise
+        finally:
+            for future in pending:
+                future.cancel()
+            close = getattr(self._chunks, 'close', None)
+            if close is not None:
+                close()
+            self._finish(None if isinstance(error, GeneratorExit) else error)
+
+    def _check(self, pending):
+        """
+        Sets `flagged` if a finished moderation flagged its segment; returns the moderations still running.
+        """
+        running = []
+        for future in pending:
+            if not future.done():
+                running.append(future)
+            elif future.result():
+                self.flagged = True
+        return running
+
+    def read(self):
+        """
+        Consumes the stream and returns the whole text.
+        """
+        for _ in self:
+            pass
+        return self.text
+
+
+class AsyncChatStream(_StreamBase):
+    """
+    Async counterpart of `ChatStream`; `async for` yields the text deltas and moderation runs in tasks.
+    """
+
+    async def __aiter__(self):
+        pending = []
+        error = None
+        try:
+            async for chunk in self._chunks:
+                delta = self._add(chunk)
+                segment = self._segment()
+                if segment is not None:
+                    pending.append(asyncio.ensure_future(self._moderate(segment)))
+                pending = self._check(pending)
+                if self.flagged:
+                    return
+                if delta:
+                    yield delta
+
+            segment = self._segment(final=True)
+            if segment is not None:
+                pending.append(asyncio.ensure_future(self._moderate(segment)))
+            self.flagged = any(await asyncio.gather(*pending))
+        except BaseException as exception:
+            error = exception
+            raise
+        finally:
+            for task in pending:
+                task.cancel()
+            close = getattr(self._chunks, 'aclose', None) or getattr(self._chunks, 'close', None)
+            if close is not None:
+                result = close()
+                if inspect.isawaitable(result):
+                    await result
+            self._finish(None if isinstance(error, GeneratorExit) else error)
+
+    def _check(self, pending):
+        """
+        Sets `flagged` if a finished moderation flagged its segment; returns the moderations still running.
+        """
+        running = []
+        for task in pending:
+            if not task.done():
+                running.append(task)
+            elif task.result():
+                self.flagged = True
+        return running
+
+    async def read(self):
+        """
+        Consumes the stream and returns the whole text.
+        """
+        async for _ in self:
+            pass
+        return self.text
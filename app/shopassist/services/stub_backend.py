@@ -0,0 +1,411 @@
+"""
+stub_backend.py
+===============
+
+A local, deterministic stand-in for the OpenAI API, used to run the pipeline offline for load tests and benchmarks.
+
+The stub recognises each request of the pipeline by its system prompt and answers it the way the model would:
+- Stage 1 conversation: asks follow-up questions, then outputs the user profile dictionary, with levels inferred
+  from keywords in the user's messages (e.g. 'gaming', 'editor', 'travel') and the budget they mentioned.
+- Intent confirmation and dictionary extraction: parse the profile with `shopassist.utils.profile`.
+- `product_map_layer`: classifies the laptop description with the rules of `shopassist.utils.spec_rules`.
+- Stage 3: summarises the recommended laptops and answers follow-up questions about them.
+- Moderation: flags texts containing any of the configured terms, one result per input of a list request.
+
+Replies and latencies depend only on the request, so runs are reproducible. Token usage is estimated from the
+text length (about four characters per token).
+
+Key Functionality:
+- `StubBackend`: The backend. `latency` / `jitter` / `moderation_latency` add a simulated round trip, `script`
+  queues fixed replies (or exceptions to raise), and `responder` hooks custom replies in front of the built-in ones.
+  Streamed completions deliver the first chunk after `first_token_latency` and the rest word by word, finishing
+  after the same total latency as a complete one. A call that would outlast the current deadline
+  (`shopassist.services.upstream.deadline`) waits until the deadline and raises `DeadlineExceeded`, like a
+  request timing out.
+"""
+
+
+import re
+import ast
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import threading
+import collections
+from types import SimpleNamespace
+from shopassist.services.backend import LLMBackend
+from shopassist.services.upstream import DeadlineExceeded, remaining_time
+from shopassist.utils.features import FEATURE_KEYS, LEVELS
+from shopassist.utils.history import estimate_tokens
+from shopassist.utils.profile import (PROFILE_COMPLETE, extract_partial_profile, extract_user_profile, find_budget,
+                                     parse_budget_text)
+from shopassist.utils.spec_rules import (classify_gpu,
+                                         classify_display,
+                                         classify_portability,
+                                         classify_multitasking,
+                                         classify_processing)
+
+
+STUB_MODEL = 'stub-1'
+
+DEFAULT_BUDGET = 100000
+
+# Keywords in the user's messages and the profile levels they imply
+PROFILE_KEYWORDS = (
+    (('gaming', 'game', 'rtx', '3d', 'render', 'after effects', 'video edit', 'machine learning', 'deep learning'),
+     {'GPU intensity': 'high', 'Processing speed': 'high', 'Multitasking': 'high'}),
+    (('editor', 'editing', 'design', 'photo', '4k', 'color', 'colour'),
+     {'Display quality': 'high', 'Multitasking': 'high'}),
+    (('programming', 'developer', 'coding', 'data', 'analyst'),
+     {'Processing speed': 'high', 'Multitasking': 'medium'}),
+    (('travel', 'portable', 'light', 'carry', 'commute', 'on the go'),
+     {'Portability': 'high'}),
+    (('stationary', 'desk', 'home', 'do not carry'),
+     {'Portability': 'low'}),
+    (('student', 'browsing', 'office', 'basic', 'email', 'netflix'),
+     {'GPU intensity': 'low', 'Processing speed': 'medium'}),
+)
+
+FOLLOW_UP_QUESTIONS = (
+    "Great! What will you primarily use the laptop for?",
+    "Thank you. Do you often travel with your laptop, or do you mostly work from one place?",
+    "Could you kindly let me know your budget for the laptop?",
+)
+
+WELCOME_MESSAGE = ("Hello! I am ShopAssist, your laptop expert. Tell me about your needs and I will find "
+                   "the best laptop for you.")
+
+
+def _fraction(text):
+    """
+    Maps a text to a number in [0, 1), the same in every process.
+    """
+    return int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16) / 0x100000000
+
+
+def _after(text, marker):
+    """
+    Returns the part of a text after a marker (the whole text if the marker is missing).
+    """
+    index = text.find(marker)
+    return text[index + len(marker):] if index >= 0 else text
+
+
+def _request_kind(messages):
+    """
+    Identifies which pipeline request a list of messages is, from its system prompt.
+    """
+    system = messages[0]['content'] if messages and messages[0].get('role') == 'system' else ''
+    if 'Laptop Specifications Classifier' in system:
+        return 'product_map'
+    if 'senior evaluator' in system:
+        return 'intent_confirmation'
+    if 'You are a python expert' in system:
+        return 'dictionary_extraction'
+    if 'user queries about any product' in system:
+        return 'recommendation'
+    if 'laptop gadget expert' in system:
+        return 'conversation'
+    return 'other'
+
+
+def _user_messages(messages):
+    """
+    Returns the user's messages, including those folded into a `ConversationHistory` summary.
+    """
+    user_messages = []
+    for message in messages[1:]:
+        content = str(message.get('content', ''))
+        if message.get('role') == 'user':
+            user_messages.append(content)
+        elif message.get('role') == 'system' and content.startswith('Summary of the earlier part'):
+            # The summary's budget stands for a user message that may have been dropped from the notes
+            budget = extract_partial_profile(content).get('Budget')
+            if budget:
+                user_messages.append('my budget is {0}'.format(budget))
+            notes = _after(content, 'What the user said earlier:').splitlines()
+            user_messages.extend(note[2:] for note in notes if note.startswith('- '))
+    return user_messages
+
+
+def infer_profile(user_messages):
+    """
+    Infers a user profile from the user's messages with `PROFILE_KEYWORDS`.
+
+    Args:
+        user_messages (list[str]): The user's messages, oldest first.
+
+    Returns:
+        dict: The six-key profile; features without a matching keyword are 'medium', and the budget is the
+              last amount the user mentioned (or `DEFAULT_BUDGET`).
+    """
+    text = ' '.join(user_messages).lower()
+    profile = {key: 'medium' for key in FEATURE_KEYS}
+    for keywords, levels in PROFILE_KEYWORDS:
+        if any(keyword in text for keyword in keywords):
+            profile.update(levels)
+
+    budget = DEFAULT_BUDGET
+    for message in reversed(user_messages):
+        amount = find_budget(message)
+        if amount is not None:
+            budget = amount
+            break
+    profile['Budget'] = str(budget)
+    return profile
+
+
+def classify_description(description):
+    """
+    Classifies a laptop description into the five features with the rules of `spec_rules`.
+    Features the rules cannot decide get a level derived from a hash of the description.
+    """
+    text = description.lower()
+    gpu = re.search(r'(?:nvidia|geforce|rtx|gtx|amd radeon|radeon|intel (?:uhd|iris|hd)|integrated|apple m1)[^,.;]*', text)
+    weight = re.search(r'(\d+(?:\.\d+)?)\s*(kg|lbs?)\b', text)
+    ram = re.search(r'(\d+)\s*gb\s*(?:of\s*)?(?:ddr\d\s*)?ram', text) or re.search(r'(\d+)\s*gb', text)
+
+    features = {'GPU intensity': classify_gpu(gpu.group()) if gpu else None,
+                'Display quality': classify_display(text, text),
+                'Portability': classify_portability(' '.join(weight.groups())) if weight else None,
+                'Multitasking': classify_multitasking(ram.group(1) + ' GB') if ram else None,
+                'Processing speed': classify_processing(text)}
+
+    for key in FEATURE_KEYS:
+        if features[key] is None:
+            features[key] = LEVELS[int(_fraction(key + description) * len(LEVELS))]
+    return features
+
+
+class StubBackend(LLMBackend):
+    """
+    Answers the pipeline's requests locally and deterministically.
+    """
+
+    name = 'stub'
+
+    def __init__(self, latency=0.0, jitter=0.0, moderation_latency=None, profile_after=len(FOLLOW_UP_QUESTIONS) + 1,
+                 flagged_terms=(), script=None, responder=None, first_token_latency=None):
+        """
+        Args:
+            latency (float): Simulated duration of a chat completion, in seconds.
+            jitter (float): Extra duration of up to `jitter` seconds, derived from a hash of the request.
+            moderation_latency (float, optional): Simulated duration of a moderation call (default: `latency` / 4).
+            profile_after (int): Number of user messages after which the stage 1 conversation outputs the profile.
+            flagged_terms (iterable of str): Moderation flags texts containing any of these (case-insensitive).
+            script (iterable, optional): Replies returned, in order, before the built-in ones. An exception
+                                         instance in the script is raised instead (e.g. to exercise retries).
+            responder (callable, optional): `responder(kind, messages)` returning a reply (str or dict),
+                                            or `None` to fall back to the built-in replies.
+            first_token_latency (float, optional): Delay before the first chunk of a streamed completion
+                                                   (default: `latency` / 4, capped at the completion's duration).
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.moderation_latency = latency / 4 if moderation_latency is None else moderation_latency
+        self.first_token_latency = latency / 4 if first_token_latency is None else first_token_latency
+        self.profile_after = profile_after
+        self.flagged_terms = tuple(term.lower() for term in flagged_terms)
+        self.script = collections.deque(script or ())
+        self.responder = responder
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """
+        Returns the number of requests answered so far, by kind.
+        """
+        with self._lock:
+            return dict(self.calls)
+
+    def _delay(self, key):
+        """
+        Returns the simulated duration of a chat completion for a request.
+        """
+        return self.latency + self.jitter * _fraction(key)
+
+    def _reply(self, request):
+        """
+        Builds the completion for a chat request.
+        """
+        messages = request['messages']
+        kind = _request_kind(messages)
+        json_format = (request.get('response_format') or {}).get('type') == 'json_object'
+
+        with self._lock:
+            self.calls[kind] += 1
+            scripted = self.script.popleft() if self.script else None
+        if isinstance(scripted, BaseException):
+            raise scripted
+
+        reply = scripted
+        if reply is None and self.responder is not None:
+            reply = self.responder(kind, messages)
+        if reply is None:
+            reply = self._builtin_reply(kind, messages)
+
+        if isinstance(reply, (dict, list)):
+            content = json.dumps(reply)
+        elif json_format and not reply.lstrip().startswith('{'):
+            content = json.dumps({'output': reply})
+        else:
+            content = reply
+
+        prompt_tokens = sum(estimate_tokens(str(message.get('content', ''))) for message in messages)
+        return SimpleNamespace(
+            id='stub-' + uuid.uuid4().hex[:12],
+            model=STUB_MODEL,
+            choices=[SimpleNamespace(index=0, finish_reason='stop',
+                                     message=SimpleNamespace(role='assistant', content=content))],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens,
+                                  completion_tokens=estimate_tokens(content),
+                                  total_tokens=prompt_tokens + estimate_tokens(content)))
+
+    def _builtin_reply(self, kind, messages):
+        """
+        The built-in reply to each kind of pipeline request.
+        """
+        last = str(messages[-1].get('content', ''))
+
+        if kind == 'product_map':
+            return classify_description(_after(last, 'for the following laptop '))
+
+        if kind == 'intent_confirmation':
+            status, _ = extract_user_profile(_after(last, 'Here is the input: '))
+            if status == PROFILE_COMPLETE:
+                return {'result': 'Yes'}
+            return {'result': 'No', 'reason': 'The profile is incomplete.'}
+
+        if kind == 'dictionary_extraction':
+            _, profile = extract_user_profile(_after(last, 'Here is the user input: '))
+            return profile or {}
+
+        if kind == 'conversation':
+            user_messages = _user_messages(messages)
+            if not user_messages:
+                return WELCOME_MESSAGE
+            if len(user_messages) < self.profile_after:
+                return FOLLOW_UP_QUESTIONS[min(len(user_messages), len(FOLLOW_UP_QUESTIONS)) - 1]
+            return "Thank you for the information. Here is your profile: {0}".format(infer_profile(user_messages))
+
+        if kind == 'recommendation':
+            return self._recommendation_reply(messages)
+
+        return "I am sorry, I can only help you find a laptop."
+
+    def _recommendation_reply(self, messages):
+        """
+        Summarises the recommended laptops (first turn) or answers a follow-up question about them.
+        """
+        # `initialize_conv_reco` formats the validated recommendations as a Python literal
+        try:
+            products = ast.literal_eval(_after(str(messages[1]['content']), "These are the user's products: ").strip())
+        except (ValueError, SyntaxError, IndexError, KeyError):
+            products = []
+        if not isinstance(products, list):
+            products = []
+
+        # The stage 3 prompt lists the laptops in decreasing order of price
+        products = sorted((product for product in products if isinstance(product, dict)),
+                          key=lambda product: -(parse_budget_text(product.get('Price', 0)) or 0))
+        names = ['{0} {1}'.format(product.get('Brand', ''), product.get('Model Name', '')).strip()
+                 for product in products]
+
+        if sum(message.get('role') == 'assistant' for message in messages) == 0:
+            lines = ['{0}. {1} : {2}, {3} RAM, {4}, Rs {5}'.format(
+                         index + 1, name, product.get('Core', ''), product.get('RAM Size', ''),
+                         product.get('Graphics Processor', ''), product.get('Price', ''))
+                     for index, (name, product) in enumerate(zip(names, products))]
+            return '\n'.join(['Here are the laptops that best match your profile:'] + lines)
+
+        if not names:
+            return "I do not have any laptops to compare for your profile."
+        return "Based on your profile, the {0} is the best fit among the recommended laptops.".format(names[0])
+
+    def _moderation_response(self, text):
+        texts = [str(item).lower() for item in (text if isinstance(text, list) else [text])]
+        with self._lock:
+            self.calls['moderation'] += 1
+            self.calls['moderation_inputs'] += len(texts)
+        return SimpleNamespace(id='stub-' + uuid.uuid4().hex[:12], model=STUB_MODEL,
+                               results=[SimpleNamespace(flagged=any(term in item for term in self.flagged_terms))
+                                        for item in texts])
+
+    def _wait(self, delay):
+        """
+        Simulates a round trip of `delay` seconds, timing out at the current deadline.
+        """
+        remaining = remaining_time()
+        if remaining is not None and delay > remaining:
+            time.sleep(max(remaining, 0))
+            raise DeadlineExceeded("The stub call timed out at its deadline")
+        if delay:
+            time.sleep(delay)
+
+    async def _async_wait(self, delay):
+        """
+        Async counterpart of `_wait()`.
+        """
+        remaining = remaining_time()
+        if remaining is not None and delay > remaining:
+            await asyncio.sleep(max(remaining, 0))
+            raise DeadlineExceeded("The stub call timed out at its deadline")
+        if delay:
+            await asyncio.sleep(delay)
+
+    def chat_completion(self, **request):
+        self._wait(self._delay(json.dumps(request['messages'][-1:], default=str)))
+        return self._reply(request)
+
+    def _stream_plan(self, request):
+        """
+        Builds the chunks of a streamed completion and the delay before each of them.
+        The reply is built (and scripted exceptions raised) before the first chunk is requested.
+        """
+        delay = self._delay(json.dumps(request['messages'][-1:], default=str))
+        completion = self._reply(request)
+        pieces = re.findall(r'\s*\S+', completion.choices[0].message.content) or ['']
+
+        first = min(self.first_token_latency, delay)
+        rest = (delay - first) / len(pieces)
+        chunks = [(first if index == 0 else rest,
+                   SimpleNamespace(model=STUB_MODEL, usage=None,
+                                   choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=piece),
+                                                            finish_reason=None)]))
+                  for index, piece in enumerate(pieces)]
+        chunks.append((rest, SimpleNamespace(model=STUB_MODEL, usage=completion.usage, choices=[])))
+        return chunks
+
+    def chat_completion_stream(self, **request):
+        plan = self._stream_plan(request)
+
+        def chunks():
+            for delay, chunk in plan:
+                if delay:
+                    time.sleep(delay)
+                yield chunk
+        return chunks()
+
+    def moderation(self, text):
+        self._wait(self.moderation_latency)
+        return self._moderation_response(text)
+
+    async def achat_completion(self, **request):
+        await self._async_wait(self._delay(json.dumps(request['messages'][-1:], default=str)))
+        return self._reply(request)
+
+    async def achat_completion_stream(self, **request):
+        plan = self._stream_plan(request)
+
+        async def chunks():
+            for delay, chunk in plan:
+                if delay:
+                    await asyncio.sleep(delay)
+                yield chunk
+        return chunks()
+
+    async def amoderation(self, text):
+        await self._async_wait(self.moderation_latency)
+        return self._moderation_response(text)
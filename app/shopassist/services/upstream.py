@@ -0,0 +1,397 @@
+"""
+upstream.py
+===========
+
+Deadlines, circuit breaking and call metrics for the requests sent to the LLM backend.
+
+Without them a slow or failing upstream could hold a turn for minutes: `get_chat_completions` retried up to six
+times with waits of up to 20 seconds, and no single request had a time limit. Every backend call of `stage1` and
+the dialogue engine now runs inside `upstream_call()`, which:
+- Enforces the current deadline. `deadline(seconds)` bounds everything that runs inside it, retries and the waits
+  between them included. Deadlines nest and the earliest one wins, so every call has its own deadline
+  (`CALL_DEADLINE`, 30 s by default, `SHOPASSIST_CALL_DEADLINE`) and the dialogue engine adds one per turn.
+  The backends pass the remaining time to the HTTP client as the request timeout, and `retry_policy()` shortens
+  its waits and stops retrying at the deadline, raising `DeadlineExceeded`.
+- Applies a circuit breaker per endpoint ('chat' and 'moderation'). After `failure_threshold` consecutive upstream
+  failures (timeouts, connection errors, 429 and 5xx responses) the circuit opens and calls fail immediately with
+  `CircuitOpenError` for `reset_timeout` seconds. Then a single probe call is let through; its outcome closes or
+  re-opens the circuit. Other errors (e.g. a rejected request) show that the upstream is answering and count as
+  successes.
+- Counts calls, failures, timeouts and rejected calls, and the calls in flight per endpoint (a streamed
+  completion until it is opened). `get_upstream_stats()` reports them with the connection pool of the backend
+  (`OpenAIBackend.pool_stats()`).
+
+Key Components:
+- `deadline()` / `remaining_time()`: Bound the time of a block of calls.
+- `call_deadline()`: Decorator running a function within `CALL_DEADLINE`.
+- `retry_policy()`: The `tenacity` arguments of the retried calls (6 attempts, exponential waits, deadline-aware).
+- `CircuitBreaker`: The breaker of one endpoint.
+- `upstream_call()`: Wraps a single backend call.
+- `UpstreamUnavailable`: Base class of `DeadlineExceeded` and `CircuitOpenError`.
+- `get_upstream_stats()` / `reset_upstream()`: Metrics and state of every endpoint.
+"""
+
+
+import os
+import time
+import asyncio
+import functools
+import threading
+import contextlib
+import contextvars
+from tenacity import (RetryError,
+                      retry_if_not_exception_type,
+                      stop_after_attempt,
+                      stop_any,
+                      wait_random_exponential)
+from shopassist.utils.tracing import span_add
+
+
+CALL_DEADLINE_ENV_VAR = 'SHOPASSIST_CALL_DEADLINE'
+CALL_DEADLINE = float(os.environ.get(CALL_DEADLINE_ENV_VAR) or 30.0)
+
+RETRY_ATTEMPTS = 6
+RETRY_MIN_WAIT = 1
+RETRY_MAX_WAIT = 20
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+
+# Responses that show the upstream is overloaded or failing, as opposed to a request it rejected
+_UPSTREAM_STATUS_CODES = (408, 409, 429)
+
+# `time.monotonic()` at which the innermost deadline expires
+_DEADLINE = contextvars.ContextVar('shopassist_deadline', default=None)
+
+
+class UpstreamUnavailable(Exception):
+    """
+    The upstream could not be asked in time: the deadline passed or the circuit is open.
+    """
+
+
+class DeadlineExceeded(UpstreamUnavailable, TimeoutError):
+    """
+    The deadline of a call (or of the turn it belongs to) passed.
+    """
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    """
+    The circuit of the endpoint is open after repeated upstream failures; the call was not sent.
+    """
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Bounds the calls made inside the block to `seconds` (`None` adds no bound). An enclosing deadline that
+    expires earlier still applies.
+    """
+    if seconds is None:
+        yield
+        return
+    expires = time.monotonic() + seconds
+    current = _DEADLINE.get()
+    token = _DEADLINE.set(expires if current is None else min(current, expires))
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+def remaining_time():
+    """
+    Returns the seconds left until the current deadline (negative once it passed), or `None` without a deadline.
+    """
+    expires = _DEADLINE.get()
+    return None if expires is None else expires - time.monotonic()
+
+
+def _expired():
+    remaining = remaining_time()
+    return remaining is not None and remaining <= 0
+
+
+def set_call_deadline(seconds):
+    """
+    Changes the deadline of every call decorated with `call_deadline` (`None` removes it).
+
+    Returns:
+        float or None: The previous deadline.
+    """
+    global CALL_DEADLINE
+    previous = CALL_DEADLINE
+    CALL_DEADLINE = seconds
+    return previous
+
+
+def call_deadline(function):
+    """
+    Runs a function (or coroutine function) within `CALL_DEADLINE`, retries included.
+    """
+    if asyncio.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            with deadline(CALL_DEADLINE):
+                return await function(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with deadline(CALL_DEADLINE):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def _stop_at_deadline(retry_state):
+    return _expired()
+
+
+class _WaitWithinDeadline:
+    """
+    A `tenacity` wait strategy that never waits past the current deadline.
+    """
+
+    def __init__(self, wait):
+        self.wait = wait
+
+    def __call__(self, retry_state):
+        wait = self.wait(retry_state)
+        remaining = remaining_time()
+        return wait if remaining is None else max(0.0, min(wait, remaining))
+
+
+def retry_policy(attempts=RETRY_ATTEMPTS, reraise=False):
+    """
+    Returns the `tenacity` arguments of a retried upstream call: up to `attempts` attempts with random exponential
+    waits between `RETRY_MIN_WAIT` and `RETRY_MAX_WAIT` seconds, but never past the current deadline.
+
+    `UpstreamUnavailable` errors are not retried. When the deadline ends the retries, `DeadlineExceeded` is raised.
+
+    Args:
+        attempts (int): Maximum number of attempts.
+        reraise (bool): When the attempts run out, raise the last error instead of `tenacity.RetryError`.
+
+    Returns:
+        dict: Keyword arguments for `tenacity.retry` / `tenacity.AsyncRetrying`.
+    """
+    def retry_error(retry_state):
+        error = retry_state.outcome.exception()
+        if _expired():
+            raise DeadlineExceeded("The call did not succeed before its deadline") from error
+        if reraise:
+            raise error
+        raise RetryError(retry_state.outcome) from error
+
+    return dict(wait=_WaitWithinDeadline(wait_random_exponential(min=RETRY_MIN_WAIT, max=RETRY_MAX_WAIT)),
+                stop=stop_any(stop_after_attempt(attempts), _stop_at_deadline),
+                retry=retry_if_not_exception_type(UpstreamUnavailable),
+                retry_error_callback=retry_error)
+
+
+def _outcome(error):
+    """
+    Classifies the error of a call for the circuit breaker: 'failure' (the upstream is degraded), 'success'
+    (the upstream answered, e.g. with a 400) or `None` (the call was abandoned, e.g. cancelled).
+    """
+    if isinstance(error, (asyncio.CancelledError, GeneratorExit, KeyboardInterrupt, SystemExit)):
+        return None
+    status = getattr(error, 'status_code', None)
+    if isinstance(status, int) and 400 <= status < 500 and status not in _UPSTREAM_STATUS_CODES:
+        return 'success'
+    return 'failure'
+
+
+def _is_timeout(error):
+    return isinstance(error, TimeoutError) or 'Timeout' in type(error).__name__
+
+
+class CircuitBreaker:
+    """
+    A circuit breaker for one upstream endpoint.
+
+    States: 'closed' (calls pass), 'open' (calls fail with `CircuitOpenError` until `reset_timeout` has passed)
+    and 'half_open' (one probe call passes; the others fail until it finished).
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        """
+        Args:
+            name (str): The endpoint, used in error messages.
+            failure_threshold (int): Consecutive upstream failures that open the circuit.
+            reset_timeout (float): Seconds the circuit stays open before a probe call is let through.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.times_opened = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Lets a call through, or raises `CircuitOpenError`.
+
+        Returns:
+            bool: Whether the call is the probe of a half-open circuit.
+        """
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            retry_after = max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+        raise CircuitOpenError("The {0} endpoint is failing; not calling it for another {1:.0f} s".format(
+            self.name, retry_after))
+
+    def record(self, outcome, probe=False):
+        """
+        Records the outcome of a call let through by `allow()` ('success', 'failure' or `None` if abandoned).
+        """
+        with self._lock:
+            if probe:
+                self._probing = False
+            if outcome == 'success':
+                self.state = self.CLOSED
+                self.consecutive_failures = 0
+            elif outcome == 'failure':
+                self.consecutive_failures += 1
+                if self.state == self.HALF_OPEN or (self.state == self.CLOSED
+                                                    and self.consecutive_failures >= self.failure_threshold):
+                    self.state = self.OPEN
+                    self._opened_at = time.monotonic()
+                    self.times_opened += 1
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state,
+                    'consecutive_failures': self.consecutive_failures,
+                    'times_opened': self.times_opened}
+
+
+class _Endpoint:
+    """
+    The circuit breaker and the counters of one endpoint.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.counters = {'calls': 0, 'failures': 0, 'timeouts': 0, 'rejected': 0, 'deadline_exceeded': 0}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, in_flight=self.in_flight, peak_in_flight=self.peak_in_flight,
+                        circuit=self.breaker.stats())
+
+
+_ENDPOINTS = {}
+_ENDPOINTS_LOCK = threading.Lock()
+
+
+def _endpoint(name):
+    with _ENDPOINTS_LOCK:
+        if name not in _ENDPOINTS:
+            _ENDPOINTS[name] = _Endpoint(name, DEFAULT_FAILURE_THRESHOLD, DEFAULT_RESET_TIMEOUT)
+        return _ENDPOINTS[name]
+
+
+def configure_circuit(endpoint, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+    """
+    Replaces the circuit breaker of an endpoint ('chat' or 'moderation').
+
+    Returns:
+        CircuitBreaker: The new breaker.
+    """
+    state = _endpoint(endpoint)
+    state.breaker = CircuitBreaker(endpoint, failure_threshold, reset_timeout)
+    return state.breaker
+
+
+@contextlib.contextmanager
+def upstream_call(endpoint):
+    """
+    Wraps one backend call: checks the deadline and the circuit, tracks the call in flight and records its outcome.
+
+    Usage:
+        with upstream_call('chat'):
+            completion = get_backend().chat_completion(**request)
+
+    Raises:
+        DeadlineExceeded: The deadline already passed.
+        CircuitOpenError: The circuit of the endpoint is open.
+    """
+    state = _endpoint(endpoint)
+    if _expired():
+        state.count('deadline_exceeded')
+        span_add(deadline_exceeded=1)
+        raise DeadlineExceeded("The deadline passed before the {0} call was sent".format(endpoint))
+    try:
+        probe = state.breaker.allow()
+    except CircuitOpenError:
+        state.count('rejected')
+        span_add(circuit_rejected=1)
+        raise
+
+    with state.lock:
+        state.counters['calls'] += 1
+        state.in_flight += 1
+        state.peak_in_flight = max(state.peak_in_flight, state.in_flight)
+    outcome = 'success'
+    try:
+        yield
+    except BaseException as error:
+        outcome = _outcome(error)
+        if outcome == 'failure':
+            state.count('failures')
+            if _is_timeout(error):
+                state.count('timeouts')
+        raise
+    finally:
+        with state.lock:
+            state.in_flight -= 1
+        state.breaker.record(outcome, probe)
+
+
+def get_upstream_stats():
+    """
+    Returns the metrics of every endpoint and of the backend's connection pool.
+
+    Returns:
+        dict: Per endpoint, the calls, upstream failures, timeouts, calls rejected by an open circuit, calls
+              refused because the deadline had passed, calls in flight (current and peak) and the circuit state;
+              under 'pool', the connections of the backend's HTTP clients (empty for backends without a pool).
+    """
+    from shopassist.services.backend import get_backend
+
+    with _ENDPOINTS_LOCK:
+        endpoints = dict(_ENDPOINTS)
+    stats = {name: endpoint.stats() for name, endpoint in sorted(endpoints.items())}
+    stats['pool'] = get_backend().pool_stats()
+    return stats
+
+
+def reset_upstream():
+    """
+    Closes every circuit and clears the counters (e.g. between benchmark runs).
+    """
+    with _ENDPOINTS_LOCK:
+        _ENDPOINTS.clear()
@@ -0,0 +1,161 @@
+"""
+cache.py
+========
+
+Persistent caching for LLM results that are pure functions of their input.
+
+Key Functionality:
+- `content_key()`: Builds a content-addressed key from the parts that determine an LLM result
+  (for example the model, the prompt version and the laptop description).
+- `FeatureCache`: A SQLite-backed cache with hit/miss counters and least-recently-used eviction
+  once the number of entries exceeds a configured bound.
+"""
+
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+DEFAULT_MAX_ENTRIES = 100000
+
+
+def content_key(*parts):
+    """
+    Hashes the given parts into a single cache key.
+
+    Args:
+        *parts (str): Everything the cached value depends on, e.g. model, prompt version and input text.
+
+    Returns:
+        str: A hex SHA-256 digest. Any change in any part yields a different key.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        encoded = str(part).encode('utf-8')
+        digest.update(str(len(encoded)).encode('ascii') + b':' + encoded)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    A SQLite-backed, size-bounded cache of JSON-serialisable values.
+
+    The cache is safe to share between threads. When it grows beyond `max_entries`, the least recently
+    used entries are deleted.
+
+    Attributes:
+        hits (int): Number of lookups answered from the cache.
+        misses (int): Number of lookups that found nothing.
+        evictions (int): Number of entries deleted to respect `max_entries`.
+    """
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        Args:
+            path (str): SQLite database file. Its directory is created if needed.
+            max_entries (int): Maximum number of entries kept on disk.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                        key TEXT PRIMARY KEY,
+                                        value TEXT NOT NULL,
+                                        last_used REAL NOT NULL)""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self._connection.commit()
+        self._entries = self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __len__(self):
+        return self._entries
+
+    def __contains__(self, key):
+        """
+        Checks for a key without counting a hit or miss.
+        """
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def get(self, key):
+        """
+        Looks up a value and marks it as recently used.
+
+        Args:
+            key (str): A key built with `content_key`.
+
+        Returns:
+            The cached value, or `None` on a miss.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """
+        Stores a value, evicting the least recently used entries if the cache is over its bound.
+
+        Args:
+            key (str): A key built with `content_key`.
+            value: Any JSON-serialisable value.
+        """
+        with self._lock:
+            exists = self._connection.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone()
+            self._connection.execute("INSERT OR REPLACE INTO entries (key, value, last_used) VALUES (?, ?, ?)",
+                                     (key, json.dumps(value), time.time()))
+            if exists is None:
+                self._entries += 1
+            excess = self._entries - self.max_entries
+            if excess > 0:
+                self._connection.execute("""DELETE FROM entries WHERE key IN (
+                                                SELECT key FROM entries ORDER BY last_used LIMIT ?)""", (excess,))
+                self._entries -= excess
+                self.evictions += excess
+            self._connection.commit()
+
+    def delete(self, key):
+        """
+        Removes a value, if present (e.g. an answer that turned out to be unusable).
+        """
+        with self._lock:
+            deleted = self._connection.execute("DELETE FROM entries WHERE key = ?", (key,)).rowcount
+            self._entries -= deleted
+            self._connection.commit()
+
+    def stats(self):
+        """
+        Returns the cache counters.
+        Returns:
+            dict: Hits, misses, hit rate, evictions and current number of entries.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self)}
+
+    def close(self):
+        """
+        Closes the underlying database connection.
+        """
+        with self._lock:
+            self._connection.close()
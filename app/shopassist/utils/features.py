@@ -0,0 +1,163 @@
+"""
+features.py
+===========
+
+Local parsing and validation of the laptop feature dictionaries used throughout the pipeline.
+
+`product_map_layer` classifies every laptop into five features, each rated 'low', 'medium' or 'high'.
+The result is stored as a stringified dictionary in the `laptop_feature` column of `updated_laptop.csv`.
+This module turns those stored values back into dictionaries without going through the LLM.
+
+Key Functionality:
+- `normalise_feature_key()`: Maps spelling variants of a feature name (case, underscores, spacing) to its canonical key.
+- `normalise_level()`: Maps a feature value to 'low', 'medium' or 'high'.
+- `normalise_features()`: Leniently extracts whichever features can be read from a (possibly partial) dictionary.
+- `parse_laptop_feature()`: Strictly parses a stored `laptop_feature` value (JSON or Python literal) into a validated dictionary.
+"""
+
+
+import ast
+import json
+import re
+
+
+FEATURE_KEYS = ('GPU intensity',
+                'Display quality',
+                'Portability',
+                'Multitasking',
+                'Processing speed')
+
+LEVELS = ('low', 'medium', 'high')
+
+# Mapping string values 'low', 'medium', 'high' to numerical scores 0, 1, 2
+LEVEL_MAP = {level: index for index, level in enumerate(LEVELS)}
+
+_KEY_LOOKUP = {key.lower(): key for key in FEATURE_KEYS}
+
+
+def normalise_feature_key(key):
+    """
+    Map a feature name to its canonical spelling.
+
+    Args:
+        key (str): A feature name such as 'GPU Intensity', 'gpu_intensity' or ' Display  quality'.
+
+    Returns:
+        str or None: The canonical key from `FEATURE_KEYS`, or `None` if the name is not a known feature.
+    """
+    if not isinstance(key, str):
+        return None
+    return _KEY_LOOKUP.get(re.sub(r'[\s_]+', ' ', key).strip().lower())
+
+
+def normalise_level(value):
+    """
+    Map a feature value to one of the allowed levels.
+
+    Args:
+        value (str): A value such as 'High', ' medium ' or 'LOW'.
+
+    Returns:
+        str or None: 'low', 'medium' or 'high', or `None` if the value is not an allowed level.
+    """
+    if not isinstance(value, str):
+        return None
+    value = value.strip().lower()
+    return value if value in LEVEL_MAP else None
+
+
+def _load_dict(value):
+    """
+    Decode a stored dictionary string written either as JSON or as a Python literal.
+    """
+    if isinstance(value, dict):
+        return value
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    if not value.startswith('{'):
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        pass
+    try:
+        loaded = ast.literal_eval(value)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    return loaded if isinstance(loaded, dict) else None
+
+
+def _unwrap(loaded):
+    """
+    Unwrap a single outer key such as {'output': {...}} added by the JSON response format.
+    """
+    if len(loaded) == 1:
+        inner = next(iter(loaded.values()))
+        if isinstance(inner, dict):
+            return inner
+    return loaded
+
+
+def normalise_features(value):
+    """
+    Leniently extracts whichever features can be read from a feature dictionary.
+
+    Unlike `parse_laptop_feature`, missing features or invalid levels are not an error; they are simply left out.
+
+    Args:
+        value (str or dict): A feature dictionary, or its JSON / Python-literal string form.
+
+    Returns:
+        dict: Canonical feature keys mapped to 'low', 'medium' or 'high' (possibly empty).
+    """
+    loaded = _unwrap(_load_dict(value) or {})
+
+    features = {}
+    for key, level in loaded.items():
+        canonical_key = normalise_feature_key(key)
+        canonical_level = normalise_level(level)
+        if canonical_key is not None and canonical_level is not None:
+            features[canonical_key] = canonical_level
+    return features
+
+
+def parse_laptop_feature(value):
+    """
+    Strictly parse a stored `laptop_feature` value into a validated feature dictionary.
+
+    The function accepts the shapes that `product_map_layer` emits once written to CSV:
+    JSON objects, Python dictionary literals and either of those wrapped in a single
+    outer key (e.g. `{'output': {...}}` from the JSON response format).
+
+    Args:
+        value (str or dict): The stored `laptop_feature` value.
+
+    Returns:
+        dict or None:
+            - A dictionary with exactly the five canonical keys of `FEATURE_KEYS`, each mapped to 'low', 'medium' or 'high'.
+            - `None` if the value cannot be decoded, a feature is missing, or a level is not allowed.
+
+    Example:
+        >>> parse_laptop_feature("{'GPU Intensity': 'High', 'Display quality': 'medium', 'Portability': 'low', 'Multitasking': 'high', 'Processing speed': 'high'}")
+        {'GPU intensity': 'high', 'Display quality': 'medium', 'Portability': 'low', 'Multitasking': 'high', 'Processing speed': 'high'}
+    """
+    loaded = _load_dict(value)
+    if loaded is None:
+        return None
+    loaded = _unwrap(loaded)
+
+    features = {}
+    for key, level in loaded.items():
+        canonical_key = normalise_feature_key(key)
+        if canonical_key is None:
+            continue  # Skipping keys that are not laptop features (e.g. 'Budget')
+        canonical_level = normalise_level(level)
+        if canonical_level is None:
+            return None
+        features[canonical_key] = canonical_level
+
+    if len(features) != len(FEATURE_KEYS):
+        return None
+
+    return {key: features[key] for key in FEATURE_KEYS}
@@ -1,39 +1,43 @@
 """This module contains all the helper and utility functions needed to run the ShopAssist app.
 """
 
-from shopassist.services.stage1 import get_chat_completions
+import json
+import hashlib
+import functools
+from shopassist.services.stage1 import MODEL, get_chat_completions
+from shopassist.utils.cache import content_key
+from shopassist.utils.features import LEVELS
+from shopassist.utils.tracing import traced, span_set
 
 
-def product_map_layer(laptop_description):
-    """
-    product_map_layer()
+# Placeholder for the description in the cached classification prompt template
+LAPTOP_DESCRIPTION_PLACEHOLDER = '{laptop_description}'
 
-    Extracts and maps key features from laptop descriptions into a structured format for further comparison with user requirements.
 
-    This function processes a dataset of laptops, specifically the `laptop_description` column, to extract features such as GPU Intensity, Display Quality, Portability, Multitasking, Processing Speed, and Budget. It uses Few-Shot Prompting to guide the feature extraction and assigns classification values (Low, Medium, or High) to each feature.
+def product_map_messages(laptop_description):
+    """
+    Builds the chat messages that `product_map_layer` sends for one laptop description.
+    Args:
+        laptop_description (str): The laptop's description.
+    Returns:
+        list: The system and user messages of the classification prompt.
+    """
+    prompt, input = product_map_template()
 
-    Key Steps:
-    1. Assigns the role of a Laptop Specifications Classifier to extract and classify features.
-    2. Provides step-by-step instructions and rules for feature extraction and classification.
-    3. Demonstrates expected results through examples (Few-Shot Prompting).
-    4. Updates the dataset with a new column, `laptop_feature`, containing the extracted features in a dictionary format.
+    messages=[{"role": "system", "content":prompt.replace(LAPTOP_DESCRIPTION_PLACEHOLDER, laptop_description) },
+              {"role": "user","content":input.replace(LAPTOP_DESCRIPTION_PLACEHOLDER, laptop_description)}]
 
-    Output:
-    - The updated dataset with the `laptop_feature` column is saved to a file for further use in the pipeline.
+    return messages
 
-    Parameters:
-    - None directly; this function reads the dataset from a pre-defined CSV file and updates it in place.
 
+@functools.lru_cache(maxsize=None)
+def product_map_template():
+    """
+    Renders the classification prompt once, with `LAPTOP_DESCRIPTION_PLACEHOLDER` in place of the description.
     Returns:
-    - None. The processed dataset is saved back to the file.
-
-    Dependencies:
-    - pandas: For reading and manipulating the dataset.
-    - json: For formatting and storing feature data.
-
-    Usage:
-    Call this function once to process the laptop dataset and prepare it for comparison with user requirements.
+        tuple[str, str]: The system prompt and user message templates.
     """
+    laptop_description = LAPTOP_DESCRIPTION_PLACEHOLDER
 
     delimiter = "#####"
 
@@ -45,7 +49,8 @@ def product_map_layer(laptop_description):
         "Processing speed":"(CPU Type, Core, Clock Speed)"
     }
 
-    values = {'low','medium','high'}
+    # A tuple rather than a set, so the prompt text (and its cache version) is identical in every process
+    values = LEVELS
 
     prompt=f"""
     You are a Laptop Specifications Classifier whose job is to extract the key features of laptops and classify them as per their requirements.
@@ -90,10 +95,76 @@ def product_map_layer(laptop_description):
     """
     input = f"""Follow the above instructions step-by-step and output the dictionary in JSON format {lap_spec} for the following laptop {laptop_description}."""
     #see that we are using the Completion endpoint and not the Chatcompletion endpoint
-    messages=[{"role": "system", "content":prompt },{"role": "user","content":input}]
+
+    return prompt, input
+
+
+def _product_map_prompt_version():
+    """
+    Fingerprints the classification prompt template, so that any edit to it invalidates cached results.
+    """
+    template = product_map_messages(LAPTOP_DESCRIPTION_PLACEHOLDER)
+    return hashlib.sha256(json.dumps(template).encode('utf-8')).hexdigest()[:16]
+
+
+PRODUCT_MAP_PROMPT_VERSION = _product_map_prompt_version()
+
+
+def product_map_cache_key(laptop_description):
+    """
+    Returns the cache key of a `product_map_layer` result: a hash of the model, prompt version and description.
+    """
+    return content_key(MODEL, PRODUCT_MAP_PROMPT_VERSION, laptop_description)
+
+
+@traced('helper.product_map_layer')
+def product_map_layer(laptop_description, cache = None):
+    """
+    product_map_layer()
+
+    Extracts and maps key features from laptop descriptions into a structured format for further comparison with user requirements.
+
+    This function processes a dataset of laptops, specifically the `laptop_description` column, to extract features such as GPU Intensity, Display Quality, Portability, Multitasking, Processing Speed, and Budget. It uses Few-Shot Prompting to guide the feature extraction and assigns classification values (Low, Medium, or High) to each feature.
+
+    Key Steps:
+    1. Assigns the role of a Laptop Specifications Classifier to extract and classify features.
+    2. Provides step-by-step instructions and rules for feature extraction and classification.
+    3. Demonstrates expected results through examples (Few-Shot Prompting).
+    4. Updates the dataset with a new column, `laptop_feature`, containing the extracted features in a dictionary format.
+
+    Output:
+    - The updated dataset with the `laptop_feature` column is saved to a file for further use in the pipeline.
+
+    Parameters:
+    - laptop_description (str): The laptop's description.
+    - cache (FeatureCache, optional): Persistent cache of earlier results. Results are keyed by a hash of the
+      model, `PRODUCT_MAP_PROMPT_VERSION` and the description, so editing the prompt invalidates them cleanly.
+
+    Returns:
+    - dict: The feature classification returned by the model (or by the cache).
+
+    Dependencies:
+    - pandas: For reading and manipulating the dataset.
+    - json: For formatting and storing feature data.
+
+    Usage:
+    Call this function once to process the laptop dataset and prepare it for comparison with user requirements.
+    """
+
+    if cache is not None:
+        key = product_map_cache_key(laptop_description)
+        response = cache.get(key)
+        span_set(cache_hit=response is not None)
+        if response is not None:
+            return response
+
+    messages = product_map_messages(laptop_description)
 
     response = get_chat_completions(messages, json_format = True)
 
+    if cache is not None:
+        cache.put(key, response)
+
     return response
 
 def iterate_llm_response(funct, debug_response, num = 10):
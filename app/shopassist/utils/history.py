@@ -0,0 +1,200 @@
+"""
+history.py
+==========
+
+Token-bounded conversation history for long chat sessions.
+
+`dialogue_mgmt_system` resends the whole conversation on every `get_chat_completions` call, so the cost of a
+turn grows with the length of the session. `ConversationHistory` keeps what is sent within a token budget:
+- The pinned messages (the system prompt, and in stage 3 the recommended products and the user profile)
+  are always sent verbatim.
+- The latest turns are sent verbatim, always including the most recent exchange, so the assistant response
+  that `intent_confirmation_layer` evaluates is never compacted.
+- Older turns are folded into one summary message: the partially filled six-key profile found in them,
+  and what the user said (assistant replies are the bulk of the tokens and are dropped).
+
+Token counts are estimated once per message when it is added and kept as running totals, so compaction
+never re-counts the history.
+
+Key Functionality:
+- `estimate_tokens()`: Estimates the number of tokens of a text.
+- `ConversationHistory`: The history; `append()` adds a message, `messages()` returns the messages to send.
+  `to_state()` / `from_state()` save and restore everything but the pinned messages, for session stores.
+"""
+
+
+import re
+import collections
+from shopassist.utils.profile import PROFILE_KEYS, extract_partial_profile, find_budget
+
+
+DEFAULT_HISTORY_TOKENS = 1500
+
+# Tokens the chat format adds to every message (role and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# User notes kept in the summary are cut to this many characters
+MAX_NOTE_CHARS = 300
+
+_BUDGET_MENTION = re.compile(r'budget|spend|afford|inr|rs\.?\s*\d|₹|rupees|lakh|lac\b|\d\s*k\b', re.IGNORECASE)
+
+
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens of a text (about four characters per token).
+    """
+    return max(1, len(text) // 4)
+
+
+def message_tokens(message):
+    """
+    Estimates the number of tokens a chat message adds to a request.
+    """
+    return estimate_tokens(str(message.get('content', ''))) + MESSAGE_OVERHEAD_TOKENS
+
+
+class ConversationHistory:
+    """
+    A conversation whose non-pinned part is kept within a token budget.
+    """
+
+    def __init__(self, messages, pinned=None, token_budget=DEFAULT_HISTORY_TOKENS, min_recent_messages=2):
+        """
+        Args:
+            messages (list): The initial messages, e.g. `initialize_conversation()`.
+            pinned (int, optional): Number of leading messages always sent verbatim. Defaults to all of `messages`.
+            token_budget (int): Maximum estimated tokens of the summary and the verbatim turns (pinned excluded).
+            min_recent_messages (int): Number of latest messages never folded into the summary, whatever the budget.
+        """
+        pinned = len(messages) if pinned is None else pinned
+        self.pinned = list(messages[:pinned])
+        self.token_budget = token_budget
+        self.min_recent_messages = max(2, min_recent_messages)
+
+        self.profile = {}
+        self.notes = collections.deque()
+        self.folded = 0
+        self._summary = None
+        self._summary_tokens = 0
+
+        self._turns = collections.deque()
+        self._pinned_tokens = sum(message_tokens(message) for message in self.pinned)
+        self._turn_tokens = 0
+
+        for message in messages[pinned:]:
+            self.append(message)
+
+    def __len__(self):
+        return len(self.pinned) + (self._summary is not None) + len(self._turns)
+
+    @property
+    def tokens(self):
+        """
+        Estimated tokens of `messages()`.
+        """
+        return self._pinned_tokens + self._summary_tokens + self._turn_tokens
+
+    def append(self, message):
+        """
+        Adds a message, folding the oldest turns into the summary if the budget is exceeded.
+        """
+        tokens = message_tokens(message)
+        self._turns.append((message, tokens))
+        self._turn_tokens += tokens
+        if self._turn_tokens + self._summary_tokens > self.token_budget:
+            self._compact()
+
+    def to_state(self):
+        """
+        Returns the history without its pinned messages (which the caller can rebuild) as plain JSON types.
+
+        Returns:
+            dict: The verbatim turns as `[role, content]` pairs, the partial profile and user notes of the summary,
+                  and the number of folded messages.
+        """
+        return {'turns': [[message.get('role'), message.get('content')] for message, _ in self._turns],
+                'profile': dict(self.profile),
+                'notes': list(self.notes),
+                'folded': self.folded}
+
+    @classmethod
+    def from_state(cls, pinned, state, token_budget=DEFAULT_HISTORY_TOKENS, min_recent_messages=2):
+        """
+        Restores a history saved with `to_state()`.
+
+        Args:
+            pinned (list): The pinned messages, e.g. `initialize_conversation()`.
+            state (dict): The output of `to_state()`.
+            token_budget (int): See `__init__`.
+            min_recent_messages (int): See `__init__`.
+
+        Returns:
+            ConversationHistory: The history, sending the same messages as the one that was saved.
+        """
+        history = cls(pinned, token_budget=token_budget, min_recent_messages=min_recent_messages)
+        history.profile = dict(state.get('profile') or {})
+        history.notes = collections.deque(state.get('notes') or ())
+        history.folded = state.get('folded', 0)
+        if history.folded:
+            history._build_summary()
+        for role, content in state.get('turns') or ():
+            message = {"role": role, "content": content}
+            tokens = message_tokens(message)
+            history._turns.append((message, tokens))
+            history._turn_tokens += tokens
+        return history
+
+    def messages(self):
+        """
+        Returns the messages to send: the pinned messages, the summary (if any turns were folded) and the latest turns.
+        """
+        summary = [self._summary] if self._summary is not None else []
+        return self.pinned + summary + [message for message, _ in self._turns]
+
+    def _compact(self):
+        """
+        Folds the oldest turns into the summary until the summary and the remaining turns fit the budget.
+        """
+        while (self._turn_tokens + self._summary_tokens > self.token_budget
+               and len(self._turns) > self.min_recent_messages):
+            self._fold(*self._turns.popleft())
+            # Keep the verbatim window starting with a user message
+            while self._turns[0][0].get('role') == 'assistant' and len(self._turns) > self.min_recent_messages:
+                self._fold(*self._turns.popleft())
+            self._build_summary()
+
+    def _fold(self, message, tokens):
+        """
+        Moves one message into the summary state.
+        """
+        self._turn_tokens -= tokens
+        self.folded += 1
+        content = str(message.get('content', ''))
+
+        self.profile.update(extract_partial_profile(content))
+        if message.get('role') == 'user':
+            if 'Budget' not in self.profile and _BUDGET_MENTION.search(content):
+                budget = find_budget(content)
+                if budget is not None:
+                    self.profile['Budget'] = str(budget)
+            note = ' '.join(content.split())
+            self.notes.append(note if len(note) <= MAX_NOTE_CHARS else note[:MAX_NOTE_CHARS - 3] + '...')
+
+    def _build_summary(self):
+        """
+        Renders the summary message, dropping the oldest user notes if it would exceed a quarter of the budget.
+        """
+        profile = {key: self.profile.get(key, '_') for key in PROFILE_KEYS}
+        header = ("Summary of the earlier part of this conversation ({0} older messages were shortened):\n"
+                  "User profile so far ('_' = not yet known): {1}\n").format(self.folded, profile)
+
+        while True:
+            notes = ''.join('- {0}\n'.format(note) for note in self.notes)
+            content = header + ("What the user said earlier:\n" + notes if notes else '')
+            tokens = estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+            if tokens <= self.token_budget // 4 or not self.notes:
+                break
+            self.notes.popleft()
+
+        self._summary = {"role": "system", "content": content}
+        self._summary_tokens = tokens
@@ -0,0 +1,204 @@
+"""
+profile.py
+==========
+
+Local extraction of the six-key user profile from the assistant's stage 1 responses.
+
+At the end of stage 1 the assistant outputs the user's profile, e.g.
+`{'GPU intensity': 'high', 'Display quality': 'high', 'Portability': 'low', 'Multitasking': 'high', 'Processing speed': 'high', 'Budget': '150000'}`,
+or the same information as bulleted "key: value" lines. This module finds that profile without an LLM call,
+validates the values and cleans the budget, so that `intent_confirmation_layer` and `dictionary_present` are
+only needed when the response is ambiguous.
+
+Key Functionality:
+- `parse_budget_text()`: Converts budgets such as '50,000 INR', '1.5 lakh', '1.5l' or '80k' into an integer.
+- `find_budget()`: Finds the budget amount in free text.
+- `extract_user_profile()`: Scans a response for the six-key profile and classifies it as complete, absent or ambiguous.
+- `extract_partial_profile()`: Collects whichever profile keys a message fills unambiguously.
+"""
+
+
+import re
+from shopassist.utils.features import FEATURE_KEYS, _load_dict, normalise_feature_key, normalise_level
+
+
+PROFILE_COMPLETE = 'complete'
+PROFILE_ABSENT = 'absent'
+PROFILE_AMBIGUOUS = 'ambiguous'
+
+PROFILE_KEYS = FEATURE_KEYS + ('Budget',)
+
+# Amounts below this are not read as budgets in free text (no laptop is that cheap; it skips "4k", "16GB", ...)
+MIN_BUDGET = 5000
+
+_MULTIPLIERS = {'k': 1000, 'thousand': 1000,
+                'l': 100000, 'lakh': 100000, 'lakhs': 100000, 'lac': 100000, 'lacs': 100000,
+                'cr': 10000000, 'crore': 10000000, 'crores': 10000000}
+
+_BUDGET_PATTERN = re.compile(r'(\d[\d,]*(?:\.\d+)?)\s*(thousand|lakhs?|lacs?|crores?|cr|k|l)?(?![a-z])', re.IGNORECASE)
+
+# Words after which an amount is most likely the budget ("my budget is 1.5 lakh", "can spend 80k")
+_BUDGET_KEYWORD = re.compile(r'budget|spend|afford|up\s*to|upto|under|below|within|around|max(?:imum)?|rs\.?|inr|₹',
+                             re.IGNORECASE)
+
+_KEY_NAMES = '|'.join(re.escape(key).replace(r'\ ', r'[\s_]+') for key in PROFILE_KEYS)
+# Quotes and markdown (bold `**key**`, code `` `key` ``, table cells `| key | value |`) around keys and values
+_MARKUP = r"['\"*`]*"
+# The value is captured inside a lookahead so that several "key: value" pairs on one line are all found
+_LINE_PATTERN = re.compile(_MARKUP + r"\b(" + _KEY_NAMES + r")\b" + _MARKUP + r"\s*[:=\-–|]\s*" + _MARKUP
+                           + r"(?=([^\n'\"{}]*))", re.IGNORECASE)
+_KEY_MENTION = re.compile(r"\b(" + _KEY_NAMES + r")\b", re.IGNORECASE)
+_DICT_PATTERN = re.compile(r'\{[^{}]*\}')
+
+
+def parse_budget_text(value):
+    """
+    Converts a budget written by the assistant or the user into an integer number of rupees.
+
+    Args:
+        value (str or int): e.g. 150000, '1,50,000', '50,000 INR', 'Rs. 70000', '1.5 lakh', '1.5l', '80k'.
+
+    Returns:
+        int or None: The budget, or `None` if no amount can be read.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value) if value > 0 else None
+
+    match = _BUDGET_PATTERN.search(str(value))
+    if not match:
+        return None
+    try:
+        amount = float(match.group(1).replace(',', ''))
+    except ValueError:
+        return None
+    unit = (match.group(2) or '').lower()
+    amount *= _MULTIPLIERS.get(unit, 1)
+    return int(round(amount)) if amount > 0 else None
+
+
+def find_budget(text, minimum=MIN_BUDGET):
+    """
+    Finds the budget in free text such as "I edit 4k videos and my budget is 1.5 lakh".
+
+    Amounts following a budget keyword ('budget', 'spend', 'under', 'INR', ...) are preferred; otherwise the
+    first amount in the text is used.
+
+    Args:
+        text (str): A message.
+        minimum (int): Smaller amounts (e.g. counts or model numbers) are skipped.
+
+    Returns:
+        int or None: The budget, or `None` if the text contains no amount of at least `minimum`.
+    """
+    text = str(text)
+    keyword = _BUDGET_KEYWORD.search(text)
+    for start in ((keyword.start(), 0) if keyword else (0,)):
+        for match in _BUDGET_PATTERN.finditer(text, start):
+            amount = parse_budget_text(match.group())
+            if amount is not None and amount >= minimum:
+                return amount
+    return None
+
+
+def _canonical_profile_key(key):
+    """
+    Maps a profile key to its canonical spelling (the five features and 'Budget').
+    """
+    if isinstance(key, str) and key.strip().lower() == 'budget':
+        return 'Budget'
+    return normalise_feature_key(key)
+
+
+def _candidate_pairs(text):
+    """
+    Yields (key, raw value) pairs found in dictionary literals and in "key: value" lines of the text.
+    """
+    for match in _DICT_PATTERN.finditer(text):
+        loaded = _load_dict(match.group())
+        if loaded:
+            for key, value in loaded.items():
+                yield key, value
+
+    for match in _LINE_PATTERN.finditer(text):
+        yield match.group(1), match.group(2).strip()
+
+
+def _profile_values(text):
+    """
+    Collects the cleaned values found for each profile key ('Budget' as a digit string, `None` if unreadable).
+    """
+    values = {}
+    for key, raw_value in _candidate_pairs(text):
+        key = _canonical_profile_key(key)
+        if key is None:
+            continue
+        if key == 'Budget':
+            budget = parse_budget_text(raw_value)
+            value = str(budget) if budget is not None else None
+        elif isinstance(raw_value, str):
+            value = normalise_level(re.split(r'[,;|.(]', raw_value)[0].strip('*` '))
+        else:
+            value = None
+        values.setdefault(key, set()).add(value)
+    return values
+
+
+def extract_partial_profile(text):
+    """
+    Collects the profile keys that a message fills with a single valid value.
+
+    Args:
+        text (str): A user or assistant message.
+
+    Returns:
+        dict: The keys found (in `PROFILE_KEYS` order) with their cleaned values; possibly empty.
+    """
+    values = _profile_values(text if isinstance(text, str) else str(text))
+    return {key: next(iter(values[key])) for key in PROFILE_KEYS
+            if len(values.get(key, ())) == 1 and None not in values[key]}
+
+
+def extract_user_profile(response):
+    """
+    Scans an assistant response for the six-key user profile.
+
+    Args:
+        response (str or dict): The assistant's response.
+
+    Returns:
+        tuple[str, dict or None]:
+            - `PROFILE_COMPLETE` and the cleaned profile if all six keys have valid values, e.g.
+              {'GPU intensity': 'high', ..., 'Budget': '150000'} (the format `dictionary_present` returns).
+            - `PROFILE_ABSENT` and `None` if the response mentions none of the keys (an ordinary follow-up question).
+            - `PROFILE_AMBIGUOUS` and `None` otherwise (some keys, invalid or conflicting values, or keys named in a
+              format that is not parsed, such as prose); an LLM should decide.
+
+    Examples:
+        >>> extract_user_profile("**GPU intensity**: high\\n**Display quality**: medium\\n**Portability**: low\\n"
+        ...                      "**Multitasking**: high\\n**Processing speed**: high\\n**Budget**: 90000")[0]
+        'complete'
+        >>> extract_user_profile("| Feature | Level |\\n|---|---|\\n| GPU intensity | high |\\n"
+        ...                      "| Display quality | medium |\\n| Portability | low |\\n| Multitasking | high |\\n"
+        ...                      "| Processing speed | high |\\n| `Budget` | 90,000 INR |")[0]
+        'complete'
+        >>> extract_user_profile("GPU intensity is high, display quality is medium and the budget is 90000.")[0]
+        'ambiguous'
+        >>> extract_user_profile("Do you often travel with your laptop?")[0]
+        'absent'
+    """
+    text = response if isinstance(response, str) else str(response)
+    values = _profile_values(text)
+
+    if not values:
+        return (PROFILE_AMBIGUOUS if _KEY_MENTION.search(text) else PROFILE_ABSENT), None
+
+    profile = {}
+    for key in PROFILE_KEYS:
+        found = values.get(key, set())
+        if len(found) != 1 or None in found:
+            return PROFILE_AMBIGUOUS, None
+        profile[key] = next(iter(found))
+
+    return PROFILE_COMPLETE, profile
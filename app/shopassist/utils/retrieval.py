@@ -0,0 +1,309 @@
+"""
+retrieval.py
+============
+
+Local lexical retrieval over the laptop catalogue, for stage 3 follow-up questions.
+
+Stage 3 used to resend the full records of the recommended laptops, long `Description` included, with every
+follow-up question. Instead, each laptop is split into short snippets (one per spec column, e.g.
+"Laptop Weight: 2.59 kg", and one per sentence of its description) and only the snippets relevant to the question
+are sent, ranked with BM25. `SpecIndex` holds the BM25 statistics of every snippet in the catalogue (document
+frequencies and the average snippet length), computed once per catalogue (from a uniform sample of 20,000 laptops
+for larger catalogues); the snippets of the few recommended laptops are tokenised when they are searched.
+
+Questions that only ask which recommended laptop is the lightest, cheapest, has the longest battery life, etc.
+are answered from the structured columns by `answer_superlative()`, without an LLM call.
+
+Key Functionality:
+- `tokenize()`: Lower-case word and number tokens, without stop words.
+- `laptop_snippets()` / `spec_snippets()`: The snippets of a laptop record, and only its spec column snippets.
+- `SpecIndex`: BM25 statistics of a catalogue; `search()` ranks the snippets of given laptops for a question.
+- `answer_superlative()`: Answers "which one is the lightest?"-style questions from the columns, or returns `None`.
+"""
+
+
+import re
+import math
+import operator
+import collections
+
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Laptops whose snippets are counted; larger catalogues are sampled
+MAX_INDEXED_LAPTOPS = 20000
+
+# Columns that are not turned into spec snippets
+NON_SPEC_COLUMNS = ('Description', 'Score')
+
+STOP_WORDS = frozenset("""a an and are as at be but by can do does for from has have how i if in is it its
+    me my of on one or so than that the their them these they this those to was what when which who will with
+    would you your it's laptop laptops""".split())
+
+# Question words mapped to the words the catalogue uses
+QUERY_SYNONYMS = {'heavy': ('weight', 'kg'), 'light': ('weight', 'kg'), 'weigh': ('weight', 'kg'),
+                  'weighs': ('weight', 'kg'), 'battery': ('battery', 'life', 'hours'), 'charge': ('battery',),
+                  'screen': ('display', 'size', 'resolution'), 'memory': ('ram',), 'cost': ('price',),
+                  'expensive': ('price',), 'cheap': ('price',), 'gpu': ('graphics',), 'gaming': ('graphics',),
+                  'cpu': ('core', 'processor'), 'processor': ('core', 'cpu'), 'fast': ('clock', 'speed', 'ghz'),
+                  'storage': ('ssd', 'hdd', 'storage'), 'disk': ('ssd', 'hdd', 'storage'),
+                  'guarantee': ('warranty',), 'system': ('os',), 'windows': ('os', 'windows')}
+
+_TOKEN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def tokenize(text):
+    """
+    Splits a text into lower-case word and number tokens, dropping stop words.
+    """
+    return [token for token in _TOKEN.findall(str(text).lower()) if token not in STOP_WORDS]
+
+
+def laptop_name(record):
+    """
+    Returns the display name of a laptop record (brand and model name).
+    """
+    return ' '.join(str(record.get(column)) for column in ('Brand', 'Model Name') if record.get(column))
+
+
+def _snippets(record):
+    """
+    Yields the snippets of a laptop record, each with the column it comes from.
+    """
+    for column, value in record.items():
+        if column in NON_SPEC_COLUMNS or value is None or value == '':
+            continue
+        if column == 'Price' and isinstance(value, (int, float)):
+            value = '{0:,}'.format(int(value))
+        yield '{0}: {1}'.format(column, value), column
+    description = record.get('Description')
+    if description:
+        for sentence in _SENTENCE_END.split(str(description).strip()):
+            if sentence:
+                yield sentence, 'Description'
+
+
+def laptop_snippets(record):
+    """
+    Splits a laptop record into snippets: one per spec column ("<column>: <value>") and one per description sentence.
+    """
+    return [snippet for snippet, _ in _snippets(record)]
+
+
+def spec_snippets(record):
+    """
+    Returns the spec column snippets of a laptop record ("<column>: <value>"), without its description.
+    """
+    return [snippet for snippet, column in _snippets(record) if column != 'Description']
+
+
+def column_counts(records, column):
+    """
+    Counts the values of a column: from the column's codes for records that can (`value_counts()` of
+    `catalogue_store.ColumnarRecords`), otherwise in one pass over the records.
+
+    Returns:
+        dict: The number of laptops with each value.
+    """
+    if hasattr(records, 'value_counts'):
+        return records.value_counts(column)
+    return collections.Counter(map(operator.methodcaller('get', column), records))
+
+
+class SpecIndex:
+    """
+    BM25 statistics of the snippets of a laptop catalogue.
+
+    Attributes:
+        snippets (int): Number of snippets in the catalogue.
+        average_length (float): Average number of tokens of a snippet.
+        document_frequency (dict): Number of snippets containing each token.
+    """
+
+    def __init__(self, records, columns=None, k1=BM25_K1, b=BM25_B, max_laptops=MAX_INDEXED_LAPTOPS):
+        """
+        Args:
+            records (sequence of dict): The product records of the catalogue (`LaptopCatalogue.records`).
+            columns (list[str], optional): The product columns. Defaults to the keys of the first record.
+            k1 (float): BM25 term frequency saturation.
+            b (float): BM25 length normalisation.
+            max_laptops (int): Larger catalogues are sampled uniformly down to this many laptops, and the
+                               frequencies scaled back up.
+        """
+        self.k1 = k1
+        self.b = b
+        if columns is None:
+            columns = list(records[0]) if len(records) else []
+        total = len(records)
+        if total > max_laptops:
+            records = records[::math.ceil(total / max_laptops)]
+        scale = total / len(records) if len(records) else 1.0
+
+        # Spec values repeat across laptops: every distinct snippet is tokenised once, weighted by its count
+        occurrences = collections.Counter()
+        for column in columns:
+            if column == 'Score':
+                continue
+            counts = column_counts(records, column)
+            if column == 'Description':
+                for value, count in counts.items():
+                    if value:
+                        for sentence in _SENTENCE_END.split(str(value).strip()):
+                            occurrences[sentence] += count
+            else:
+                for value, count in counts.items():
+                    if value is not None and value != '':
+                        snippet = next(_snippets({column: value}))[0]
+                        occurrences[snippet] += count
+        occurrences.pop('', None)
+
+        document_frequency = collections.Counter()
+        snippets = total_length = 0
+        for snippet, count in occurrences.items():
+            tokens = tokenize(snippet)
+            snippets += count
+            total_length += len(tokens) * count
+            if count == 1:
+                document_frequency.update(set(tokens))
+            else:
+                for token in set(tokens):
+                    document_frequency[token] += count
+        self.snippets = round(snippets * scale)
+        self.average_length = total_length / snippets if snippets else 1.0
+        self.document_frequency = {token: frequency * scale for token, frequency in document_frequency.items()}
+
+    def idf(self, token):
+        """
+        The BM25 inverse document frequency of a token.
+        """
+        frequency = self.document_frequency.get(token, 0)
+        return math.log(1 + (self.snippets - frequency + 0.5) / (frequency + 0.5))
+
+    def query_terms(self, question):
+        """
+        Tokenises a question, adding the catalogue words of its synonyms.
+        """
+        terms = []
+        for token in tokenize(question):
+            terms.append(token)
+            terms.extend(QUERY_SYNONYMS.get(token, ()))
+        return list(dict.fromkeys(terms))
+
+    def search(self, question, records, per_laptop=3):
+        """
+        Ranks the snippets of the given laptops for a question.
+
+        Args:
+            question (str): The user's question.
+            records (list[dict]): The laptops to search, e.g. the validated recommendations.
+            per_laptop (int): Maximum number of snippets returned per laptop.
+
+        Returns:
+            list[list[tuple[float, str]]]: For every laptop, its best matching snippets as `(score, snippet)`,
+                                           best first (empty when nothing matches).
+        """
+        terms = [(term, self.idf(term)) for term in self.query_terms(question)]
+        results = []
+        for record in records:
+            scored = []
+            for snippet in laptop_snippets(record):
+                tokens = tokenize(snippet)
+                counts = collections.Counter(tokens)
+                norm = self.k1 * (1 - self.b + self.b * len(tokens) / self.average_length)
+                score = sum(idf * counts[term] * (self.k1 + 1) / (counts[term] + norm)
+                            for term, idf in terms if term in counts)
+                if score > 0:
+                    scored.append((round(score, 4), snippet))
+            scored.sort(key=lambda item: -item[0])
+            results.append(scored[:per_laptop])
+        return results
+
+
+def _number(value):
+    match = re.search(r"\d+(?:\.\d+)?", str(value).replace(',', ''))
+    return float(match.group()) if match else None
+
+
+def _weight_kg(value):
+    number, text = _number(value), str(value).lower()
+    if number is None:
+        return None
+    if 'lb' in text or 'pound' in text:
+        return number * 0.4536
+    if re.search(r"\d\s*g\b|gram", text) and 'kg' not in text:
+        return number / 1000
+    return number
+
+
+def _ram_gb(value):
+    number = _number(value)
+    return number * 1024 if number is not None and 'tb' in str(value).lower() else number
+
+
+def _clock_ghz(value):
+    number = _number(value)
+    return number / 1000 if number is not None and 'mhz' in str(value).lower() else number
+
+
+# (question pattern, column, highest or lowest wins, how the answer names it, how values are parsed)
+SUPERLATIVES = (
+    (r"\b(lightest|least heavy|most portable)\b", 'Laptop Weight', min, 'lightest', _weight_kg),
+    (r"\b(heaviest)\b", 'Laptop Weight', max, 'heaviest', _weight_kg),
+    (r"\b(cheapest|least expensive|most affordable|lowest price(d)?)\b", 'Price', min, 'cheapest', _number),
+    (r"\b(most expensive|priciest|costliest|highest price(d)?)\b", 'Price', max, 'most expensive', _number),
+    (r"\b(longest|best|biggest) battery\b|\bbattery lasts? (the )?longest\b", 'Average Battery Life', max,
+     'longest battery life', _number),
+    (r"\b(most|largest|biggest|highest) (ram|memory)\b", 'RAM Size', max, 'most RAM', _ram_gb),
+    (r"\b(largest|biggest) (screen|display)\b", 'Display Size', max, 'largest screen', _number),
+    (r"\b(smallest) (screen|display)\b", 'Display Size', min, 'smallest screen', _number),
+    (r"\b(fastest|highest) (clock|processor|cpu)\b", 'Clock Speed', max, 'fastest clock speed', _clock_ghz),
+)
+
+_SUPERLATIVE_QUESTION = re.compile(r"^\s*(which|what|who)\b", re.IGNORECASE)
+MAX_SUPERLATIVE_WORDS = 12
+
+
+def answer_superlative(question, records):
+    """
+    Answers a question asking which recommended laptop is the lightest, cheapest, etc., from the product columns.
+
+    Only short questions that start with "which" or "what" and ask for exactly one superlative are answered;
+    anything else (or laptops whose column cannot be read) returns `None`, for the LLM to answer.
+
+    Args:
+        question (str): The user's question.
+        records (list[dict]): The recommended laptops.
+
+    Returns:
+        str or None: The answer.
+    """
+    if len(records) < 2 or not _SUPERLATIVE_QUESTION.match(question) \
+            or len(question.split()) > MAX_SUPERLATIVE_WORDS or question.count('?') > 1:
+        return None
+    matches = [superlative for superlative in SUPERLATIVES if re.search(superlative[0], question, re.IGNORECASE)]
+    if len(matches) != 1:
+        return None
+
+    _, column, best, label, parse = matches[0]
+    values = [parse(record.get(column)) if record.get(column) is not None else None for record in records]
+    if any(value is None for value in values):
+        return None
+
+    target = best(values)
+    winners = [laptop_name(record) for record, value in zip(records, values) if value == target]
+    shown = lambda record: '{0:,}'.format(int(record[column])) if column == 'Price' else str(record[column])
+    others = ', '.join('{0}: {1}'.format(laptop_name(record), shown(record))
+                       for record, value in zip(records, values) if value != target)
+    winner_record = records[values.index(target)]
+    if len(winners) == 1:
+        answer = "The {0} of the recommended laptops is the {1} ({2}: {3}).".format(
+            label, winners[0], column, shown(winner_record))
+    else:
+        answer = "The {0} of the recommended laptops are the {1} ({2}: {3}).".format(
+            label, ' and the '.join(winners), column, shown(winner_record))
+    if others:
+        answer += " For comparison, {0}.".format(others)
+    return answer
@@ -0,0 +1,176 @@
+"""
+spec_rules.py
+=============
+
+Rule-based classification of laptop features from the structured columns of `laptop_data.csv`.
+
+The rules are the same thresholds that the `product_map_layer` prompt asks the LLM to apply:
+- GPU intensity: Nvidia RTX is high; Intel Iris, AMD Radeon and Apple M1 are medium; Intel UHD / integrated graphics are low.
+- Display quality: 4K or Retina is high; Full HD (1920x1080) or higher is medium; anything below Full HD is low.
+- Portability: under 1.51 kg is high; 1.51 kg to 2.51 kg is medium; over 2.51 kg is low.
+- Multitasking: 8 GB or 12 GB of RAM is low; 16 GB is medium; 32 GB or 64 GB is high.
+- Processing speed: Intel Core i3 / Ryzen 3 is low; i5 / Ryzen 5 is medium; i7 / Ryzen 7 or higher is high.
+
+Every rule returns `None` when the column does not clearly fall into one of its cases (e.g. an Nvidia GTX card),
+so the LLM is consulted only for those fields.
+
+Key Functionality:
+- `rule_based_features()`: Classifies the five features of one laptop row, leaving undecided features as `None`.
+- `agreement_report()`: Compares the rule-based classification with the LLM's `laptop_feature` column.
+"""
+
+
+import re
+from shopassist.utils.features import FEATURE_KEYS, normalise_features
+
+
+def _text(value):
+    """
+    Returns a column value as lower-case text ('' for missing values).
+    """
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    return str(value).strip().lower()
+
+
+def _number(value):
+    """
+    Returns the first number in a column value such as '2.3 kg' or '16GB', or `None`.
+    """
+    match = re.search(r'\d+(?:\.\d+)?', _text(value))
+    return float(match.group()) if match else None
+
+
+def classify_gpu(graphics_processor):
+    """
+    Classifies GPU intensity from the `Graphics Processor` column.
+    """
+    gpu = _text(graphics_processor)
+    if not gpu:
+        return None
+    if 'rtx' in gpu:
+        return 'high'
+    if any(name in gpu for name in ('iris', 'radeon', 'm1', 'apple')):
+        return 'medium'
+    if any(name in gpu for name in ('uhd', 'integrated', 'hd graphics')):
+        return 'low'
+    return None
+
+
+def classify_display(screen_resolution, display_type=None):
+    """
+    Classifies display quality from the `Screen Resolution` and `Display Type` columns.
+    """
+    resolution = _text(screen_resolution)
+    display = _text(display_type)
+    if '4k' in resolution or 'retina' in display or 'retina' in resolution:
+        return 'high'
+
+    match = re.search(r'(\d{3,4})\s*[x×]\s*(\d{3,4})', resolution)
+    if not match:
+        return None
+    width, height = sorted((int(match.group(1)), int(match.group(2))), reverse=True)
+    if width >= 3840 and height >= 2160:
+        return 'high'
+    if width >= 1920 and height >= 1080:
+        return 'medium'
+    return 'low'
+
+
+def classify_portability(laptop_weight):
+    """
+    Classifies portability from the `Laptop Weight` column (in kg).
+    """
+    weight = _number(laptop_weight)
+    if weight is None:
+        return None
+    if 'lb' in _text(laptop_weight):
+        weight *= 0.4536
+    if weight < 1.51:
+        return 'high'
+    if weight <= 2.51:
+        return 'medium'
+    return 'low'
+
+
+def classify_multitasking(ram_size):
+    """
+    Classifies multitasking from the `RAM Size` column (in GB).
+    """
+    ram = _number(ram_size)
+    if ram is None:
+        return None
+    if ram <= 12:
+        return 'low'
+    if ram == 16:
+        return 'medium'
+    if ram >= 32:
+        return 'high'
+    return None
+
+
+def classify_processing(core, cpu_manufacturer=None):
+    """
+    Classifies processing speed from the `Core` and `CPU Manufacturer` columns.
+    """
+    cpu = ' '.join(filter(None, (_text(cpu_manufacturer), _text(core))))
+    if re.search(r'\bi[79]\b|ryzen\s*[79]\b', cpu):
+        return 'high'
+    if re.search(r'\bi5\b|ryzen\s*5\b', cpu):
+        return 'medium'
+    if re.search(r'\bi3\b|ryzen\s*3\b|celeron|pentium|athlon', cpu):
+        return 'low'
+    return None
+
+
+def rule_based_features(laptop):
+    """
+    Classifies the five features of one laptop from its structured columns.
+
+    Args:
+        laptop (dict): A row of `laptop_data.csv`, e.g. from `DataFrame.to_dict(orient='records')`.
+
+    Returns:
+        dict: The five keys of `FEATURE_KEYS`, each mapped to 'low', 'medium', 'high' or `None` if the rules cannot decide.
+    """
+    return {'GPU intensity': classify_gpu(laptop.get('Graphics Processor')),
+            'Display quality': classify_display(laptop.get('Screen Resolution'), laptop.get('Display Type')),
+            'Portability': classify_portability(laptop.get('Laptop Weight')),
+            'Multitasking': classify_multitasking(laptop.get('RAM Size')),
+            'Processing speed': classify_processing(laptop.get('Core'), laptop.get('CPU Manufacturer'))}
+
+
+def agreement_report(laptop_df):
+    """
+    Compares the rule-based classification with the LLM's `laptop_feature` column.
+
+    Args:
+        laptop_df (pd.DataFrame): An enriched dataset (`updated_laptop.csv`).
+
+    Returns:
+        dict: For every feature, the number of rows the rules `decided`, how many of those the LLM `classified`,
+              how many `agree`, the `agreement` rate, and the most common `disagreements` as 'rule->llm' counts.
+    """
+    report = {key: {'decided': 0, 'classified': 0, 'agree': 0, 'disagreements': {}} for key in FEATURE_KEYS}
+
+    for laptop in laptop_df.to_dict(orient='records'):
+        rules = rule_based_features(laptop)
+        llm = normalise_features(laptop.get('laptop_feature'))
+        for key in FEATURE_KEYS:
+            if rules[key] is None:
+                continue
+            report[key]['decided'] += 1
+            if key not in llm:
+                continue
+            report[key]['classified'] += 1
+            if rules[key] == llm[key]:
+                report[key]['agree'] += 1
+            else:
+                pair = '{0}->{1}'.format(rules[key], llm[key])
+                report[key]['disagreements'][pair] = report[key]['disagreements'].get(pair, 0) + 1
+
+    for counts in report.values():
+        counts['agreement'] = round(counts['agree'] / counts['classified'], 4) if counts['classified'] else None
+        counts['disagreements'] = dict(sorted(counts['disagreements'].items(), key=lambda item: -item[1]))
+
+    return report
@@ -0,0 +1,345 @@
+"""
+tracing.py
+==========
+
+Opt-in tracing and metrics for the ShopAssist pipeline.
+
+The public functions of `stage1`, `stage2`, `stage3` and `helper` (and the steps of the dialogue engine) are
+decorated with `traced()`. While tracing is disabled (the default) the decorator only checks one global and
+calls the function. Once enabled, every call records a span with its duration, its parent span, and attributes
+added by the code it ran: prompt and completion tokens (`stage1._record_usage`), `tenacity` retries
+(`stage1._record_retry`) and cache hits (`product_map_layer`, `get_catalogue`).
+
+Work that outlives a function call, such as a streamed completion, reports its own spans with `record_span()`.
+
+Finished spans are passed to the enabled sinks:
+- `HistogramRegistry`: In-process latency histograms and attribute counters per span name, with a
+  Prometheus text rendering (`to_prometheus()`) and `start_metrics_server()` to serve it at `/metrics`.
+- `JSONLinesSink`: Appends every span to a JSON-lines file.
+Any object with an `emit(span)` method can be used as a sink.
+
+Usage:
+    registry = HistogramRegistry()
+    enable(registry, JSONLinesSink('spans.jsonl'))
+    ...
+    print(registry.to_prometheus())
+
+Setting the `SHOPASSIST_TRACE_JSONL` environment variable to a path enables a `JSONLinesSink` at import time.
+"""
+
+
+import os
+import json
+import time
+import bisect
+import asyncio
+import functools
+import itertools
+import threading
+import contextvars
+
+
+TRACE_JSONL_ENV_VAR = 'SHOPASSIST_TRACE_JSONL'
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# The enabled sinks; tracing is disabled while this is empty
+_SINKS = ()
+
+_CURRENT_SPAN = contextvars.ContextVar('shopassist_current_span', default=None)
+_SPAN_IDS = itertools.count(1)
+
+
+class Span:
+    """
+    One timed call of a traced function.
+    """
+
+    __slots__ = ('name', 'span_id', 'trace_id', 'parent_id', 'start', 'duration', 'error', 'attributes')
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.span_id = next(_SPAN_IDS)
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+        self.attributes = {}
+
+    def to_dict(self):
+        return {'name': self.name, 'trace_id': self.trace_id, 'span_id': self.span_id,
+                'parent_id': self.parent_id, 'start': self.start, 'duration_s': self.duration,
+                'error': self.error, 'attributes': self.attributes}
+
+
+def enable(*sinks):
+    """
+    Enables tracing.
+
+    Args:
+        *sinks: Objects with an `emit(span)` method. Defaults to a new `HistogramRegistry`.
+
+    Returns:
+        tuple: The enabled sinks.
+    """
+    global _SINKS
+    _SINKS = tuple(sinks) or (HistogramRegistry(),)
+    return _SINKS
+
+
+def disable():
+    """
+    Disables tracing (closing sinks that have a `close()` method).
+    """
+    global _SINKS
+    sinks, _SINKS = _SINKS, ()
+    for sink in sinks:
+        if hasattr(sink, 'close'):
+            sink.close()
+
+
+def is_enabled():
+    return bool(_SINKS)
+
+
+def _start(name):
+    parent = _CURRENT_SPAN.get()
+    span = Span(name, parent)
+    return span, _CURRENT_SPAN.set(span), time.perf_counter()
+
+
+def _finish(span, token, started, error=None):
+    span.duration = time.perf_counter() - started
+    if error is not None:
+        span.error = type(error).__name__
+    _CURRENT_SPAN.reset(token)
+    for sink in _SINKS:
+        sink.emit(span)
+
+
+def traced(name):
+    """
+    Decorator recording a span named `name` for every call of a function (or coroutine function)
+    while tracing is enabled.
+    """
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                if not _SINKS:
+                    return await function(*args, **kwargs)
+                span, token, started = _start(name)
+                try:
+                    result = await function(*args, **kwargs)
+                except BaseException as error:
+                    _finish(span, token, started, error)
+                    raise
+                _finish(span, token, started)
+                return result
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _SINKS:
+                return function(*args, **kwargs)
+            span, token, started = _start(name)
+            try:
+                result = function(*args, **kwargs)
+            except BaseException as error:
+                _finish(span, token, started, error)
+                raise
+            _finish(span, token, started)
+            return result
+        return wrapper
+
+    return decorator
+
+
+def record_span(name, duration, error=None, **attributes):
+    """
+    Records a span that was timed by the caller (e.g. the time to the first token of a streamed completion),
+    as a child of the current span. No-op while tracing is disabled.
+
+    Args:
+        name (str): The span name.
+        duration (float): Its duration in seconds.
+        error (BaseException, optional): The exception that ended it.
+        **attributes: Attributes of the span.
+    """
+    if not _SINKS:
+        return
+    span = Span(name, _CURRENT_SPAN.get())
+    span.start -= duration
+    span.duration = duration
+    span.error = type(error).__name__ if error is not None else None
+    span.attributes.update(attributes)
+    for sink in _SINKS:
+        sink.emit(span)
+
+
+def span_add(**counts):
+    """
+    Adds counts (e.g. `prompt_tokens=120`, `retries=1`) to the current span. No-op without a current span.
+    """
+    span = _CURRENT_SPAN.get()
+    if span is not None:
+        attributes = span.attributes
+        for key, value in counts.items():
+            attributes[key] = attributes.get(key, 0) + value
+
+
+def span_set(**attributes):
+    """
+    Sets attributes (e.g. `cache_hit=True`) of the current span. No-op without a current span.
+    """
+    span = _CURRENT_SPAN.get()
+    if span is not None:
+        span.attributes.update(attributes)
+
+
+class HistogramRegistry:
+    """
+    Aggregates spans into per-name latency histograms and attribute counters.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def emit(self, span):
+        with self._lock:
+            metric = self._metrics.get(span.name)
+            if metric is None:
+                metric = self._metrics[span.name] = {'count': 0, 'sum': 0.0, 'errors': 0,
+                                                     'buckets': [0] * (len(self.buckets) + 1), 'counters': {}}
+            metric['count'] += 1
+            metric['sum'] += span.duration
+            metric['errors'] += span.error is not None
+            metric['buckets'][bisect.bisect_left(self.buckets, span.duration)] += 1
+            counters = metric['counters']
+            for key, value in span.attributes.items():
+                if isinstance(value, (bool, int, float)):
+                    counters[key] = counters.get(key, 0) + value
+
+    def _quantile(self, buckets, count, quantile):
+        """
+        Estimates a quantile as the upper bound of the bucket containing it.
+        """
+        rank = quantile * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        """
+        Returns the aggregated metrics per span name.
+
+        Returns:
+            dict: For every span name, the number of calls, errors, total and mean duration, estimated p50, p95
+                  and p99 (bucket upper bounds, in seconds) and the summed attributes (tokens, retries, cache hits).
+        """
+        with self._lock:
+            metrics = {name: dict(metric, buckets=list(metric['buckets']), counters=dict(metric['counters']))
+                       for name, metric in self._metrics.items()}
+        return {name: {'count': metric['count'],
+                       'errors': metric['errors'],
+                       'sum_s': round(metric['sum'], 6),
+                       'mean_s': round(metric['sum'] / metric['count'], 6),
+                       'p50_s': self._quantile(metric['buckets'], metric['count'], 0.50),
+                       'p95_s': self._quantile(metric['buckets'], metric['count'], 0.95),
+                       'p99_s': self._quantile(metric['buckets'], metric['count'], 0.99),
+                       'counters': metric['counters']}
+                for name, metric in sorted(metrics.items())}
+
+    def to_prometheus(self):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = sorted((name, dict(metric, buckets=list(metric['buckets']), counters=dict(metric['counters'])))
+                             for name, metric in self._metrics.items())
+
+        lines = ['# HELP shopassist_span_duration_seconds Duration of traced pipeline calls.',
+                 '# TYPE shopassist_span_duration_seconds histogram']
+        for name, metric in metrics:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), metric['buckets']):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('shopassist_span_duration_seconds_bucket{{span="{0}",le="{1}"}} {2}'.format(
+                    name, le, cumulative))
+            lines.append('shopassist_span_duration_seconds_sum{{span="{0}"}} {1}'.format(name, metric['sum']))
+            lines.append('shopassist_span_duration_seconds_count{{span="{0}"}} {1}'.format(name, metric['count']))
+
+        lines += ['# HELP shopassist_span_errors_total Traced calls that raised an exception.',
+                  '# TYPE shopassist_span_errors_total counter']
+        lines += ['shopassist_span_errors_total{{span="{0}"}} {1}'.format(name, metric['errors'])
+                  for name, metric in metrics]
+
+        lines += ['# HELP shopassist_span_attribute_total Summed span attributes (tokens, retries, cache hits).',
+                  '# TYPE shopassist_span_attribute_total counter']
+        for name, metric in metrics:
+            for key, value in sorted(metric['counters'].items()):
+                lines.append('shopassist_span_attribute_total{{span="{0}",attribute="{1}"}} {2}'.format(
+                    name, key, float(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+class JSONLinesSink:
+    """
+    Appends every span to a JSON-lines file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def emit(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def start_metrics_server(registry, host='127.0.0.1', port=9464):
+    """
+    Serves `registry.to_prometheus()` at `http://host:port/metrics` from a daemon thread.
+
+    Returns:
+        ThreadingHTTPServer: The server (call `shutdown()` to stop it).
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='shopassist-metrics', daemon=True).start()
+    return server
+
+
+if os.environ.get(TRACE_JSONL_ENV_VAR):
+    enable(JSONLinesSink(os.environ[TRACE_JSONL_ENV_VAR]))